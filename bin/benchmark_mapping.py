@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+import argparse
+import sys
+
+from dora.benchmark import (generate_dataset, run_benchmark, write_benchmark,
+                            read_benchmark, compare_benchmarks,
+                            benchmark_downgrade_edge_qualities,
+                            benchmark_decompression)
+
+
+def _setup_argparse():
+    'It returns the argument parser'
+    description = 'Benchmark the bwa mapping pipeline with synthetic data'
+    parser = argparse.ArgumentParser(description=description)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    generate_parser = subparsers.add_parser(
+        'generate', help='Generate a synthetic reference and paired reads')
+    generate_parser.add_argument('dataset_dir',
+                                 help='Dir to write the dataset')
+    generate_parser.add_argument('-s', '--genome_size', type=int,
+                                 default=1000000, help='Reference size')
+    generate_parser.add_argument('-c', '--num_contigs', type=int, default=1,
+                                 help='Number of contigs')
+    generate_parser.add_argument('-d', '--depth', type=float, default=10,
+                                 help='Sequencing depth')
+    generate_parser.add_argument('-u', '--duplicate_rate', type=float,
+                                 default=0.05,
+                                 help='Fraction of duplicated pairs')
+    generate_parser.add_argument('-l', '--read_length', type=int,
+                                 default=150, help='Read length')
+    generate_parser.add_argument('--seed', type=int, default=1,
+                                 help='Random seed')
+
+    run_parser = subparsers.add_parser(
+        'run', help='Map the dataset with every stage combination')
+    run_parser.add_argument('dataset_dir', help='Dir with the dataset')
+    run_parser.add_argument('-w', '--work_dir', required=True,
+                            help='Dir to write the mappings')
+    run_parser.add_argument('-o', '--outfile', required=True,
+                            help='Json file to write the results')
+    run_parser.add_argument('-t', '--threads', default=1, type=int,
+                            help='Threads')
+
+    compare_parser = subparsers.add_parser(
+        'compare', help='Compare a benchmark with a previous one')
+    compare_parser.add_argument('reference', help='Previous results')
+    compare_parser.add_argument('current', help='Current results')
+    compare_parser.add_argument('--tolerance', default=0.1, type=float,
+                                help='Allowed throughput drop')
+
+    downgrade_parser = subparsers.add_parser(
+        'downgrade', help='Time the edge quality downgrade of in memory reads')
+    downgrade_parser.add_argument('-n', '--num_reads', type=int,
+                                  default=100000, help='Number of reads')
+    downgrade_parser.add_argument('-l', '--read_length', type=int,
+                                  default=150, help='Read length')
+    downgrade_parser.add_argument('-o', '--outfile',
+                                  help='Json file to write the results')
+
+    decompress_parser = subparsers.add_parser(
+        'decompress', help='Compare the mapping with parallel decompression')
+    decompress_parser.add_argument('dataset_dir', help='Dir with the dataset')
+    decompress_parser.add_argument('-w', '--work_dir', required=True,
+                                   help='Dir to write the mappings')
+    decompress_parser.add_argument('-t', '--threads', default=1, type=int,
+                                   help='Threads')
+    decompress_parser.add_argument('-d', '--decompress_threads', type=int,
+                                   help='Decompression threads per file')
+    decompress_parser.add_argument('-o', '--outfile',
+                                   help='Json file to write the results')
+    return parser
+
+
+def generate(args):
+    dataset = generate_dataset(args.dataset_dir, args.genome_size, args.depth,
+                               duplicate_rate=args.duplicate_rate,
+                               num_contigs=args.num_contigs,
+                               read_length=args.read_length, seed=args.seed)
+    sys.stdout.write('{} reads written\n'.format(dataset['reads']))
+
+
+def run(args):
+    benchmark = run_benchmark(args.dataset_dir, args.work_dir,
+                              threads=args.threads)
+    write_benchmark(benchmark, args.outfile)
+    for run_ in benchmark['runs']:
+        if run_['fail']:
+            sys.stdout.write('{}: FAIL\n'.format(run_['combination']))
+        else:
+            sys.stdout.write('{}: {:.1f} reads/s\n'.format(
+                run_['combination'], run_['reads_per_second']))
+
+
+def compare(args):
+    regressions = compare_benchmarks(read_benchmark(args.reference),
+                                     read_benchmark(args.current),
+                                     tolerance=args.tolerance)
+    for combination, reference_speed, speed in regressions:
+        msg = 'REGRESSION: {}: {:.1f} -> {:.1f} reads/s\n'
+        sys.stdout.write(msg.format(combination, reference_speed, speed))
+    if regressions:
+        sys.exit(1)
+
+
+def downgrade(args):
+    benchmark = benchmark_downgrade_edge_qualities(
+        num_reads=args.num_reads, read_length=args.read_length, seed=1)
+    if args.outfile:
+        write_benchmark(benchmark, args.outfile)
+    msg = 'python: {:.1f} reads/s, buffer: {:.1f} reads/s, '
+    msg += 'byte array tags: {:.1f} reads/s, speedup: {:.2f}\n'
+    sys.stdout.write(msg.format(benchmark['python_reads_per_second'],
+                                benchmark['buffer_reads_per_second'],
+                                benchmark['bytes_tags_reads_per_second'],
+                                benchmark['speedup']))
+
+
+def decompress(args):
+    benchmark = benchmark_decompression(
+        args.dataset_dir, args.work_dir, threads=args.threads,
+        decompress_threads=args.decompress_threads)
+    if args.outfile:
+        write_benchmark(benchmark, args.outfile)
+    if benchmark['fail']:
+        sys.stdout.write('FAIL: the mapping failed\n')
+        sys.exit(1)
+    msg = 'bwa: {:.1f} reads/s, parallel decompression: {:.1f} reads/s, '
+    msg += 'speedup: {:.2f}\n'
+    sys.stdout.write(msg.format(benchmark['bwa_reads_per_second'],
+                                benchmark['parallel_reads_per_second'],
+                                benchmark['speedup']))
+
+
+def main():
+    parser = _setup_argparse()
+    args = parser.parse_args()
+    commands = {'generate': generate, 'run': run, 'compare': compare,
+                'downgrade': downgrade, 'decompress': decompress}
+    commands[args.command](args)
+
+
+if __name__ == '__main__':
+    main()
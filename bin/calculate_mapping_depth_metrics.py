@@ -1,10 +1,11 @@
 #!/usr/bin/env python3
 import sys
 import argparse
-from collections import Counter
 
 from dora.plot import draw_histogram_in_fhand
-from dora.stats import calc_coverage_stats, write_coverage_stats
+from dora.stats import (calc_coverage_stats, write_coverage_stats,
+                        calc_depth_histogram, read_depth_histogram,
+                        calc_bam_depth_histogram)
 
 
 HEADER = ['Sample', 'Min', 'Max', 'Average depth', 'Std. DEV', 'Median', 'Bases Covered',
@@ -14,10 +15,24 @@ HEADER = ['Sample', 'Min', 'Max', 'Average depth', 'Std. DEV', 'Median', 'Bases
 
 def _setup_argparse():
     'It returns the argument parser'
-    description = 'Calculate some bam depth stats'
+    description = 'Calculate some bam depth stats from a samtools depth file '
+    description += 'or from an indexed bam'
     parser = argparse.ArgumentParser(description=description)
-    parser.add_argument('input', help='Depth file produced by samtools depth',
-                        type=argparse.FileType('rt'), default=sys.stdin)
+    parser.add_argument('input', help='Depth file produced by samtools depth '
+                                      'or a bam with --from_bam',
+                        type=argparse.FileType('rb'), default=sys.stdin)
+    parser.add_argument('-b', '--from_bam', action='store_true',
+                        help='The input is an indexed BAM or CRAM, the '
+                             'depths are calculated from its reads')
+    parser.add_argument('-q', '--min_mapq', type=int, default=0,
+                        help='min. MAPQ to consider, with --from_bam')
+    parser.add_argument('--rm_dups', action='store_true', default=False,
+                        help='remove dups from stats, with --from_bam')
+    parser.add_argument('--sample',
+                        help='Sample to consider, the SM of its read groups, '
+                             'with --from_bam')
+    parser.add_argument('-r', '--reference',
+                        help='Reference fasta used to read CRAM files')
     parser.add_argument('-o', '--outfile', default=sys.stdout,
                         help='File to write the stats',
                         type=argparse.FileType('wt'))
@@ -29,6 +44,9 @@ def _setup_argparse():
                                                               'tabular_header'])
     parser.add_argument('-s', '--samplename', default='default sample name',
                         help='Sample name')
+    parser.add_argument('-t', '--processes', default=1, type=int,
+                        help='Processes to read the depth file or the bam, '
+                             'each one reads a part of it')
     return parser
 
 
@@ -44,7 +62,12 @@ def _parse_args(parser):
 
     return {'in_fhand': in_fhand, 'out_fhand': out_fhand,
             'plot_fhand': plot_fhand, 'out_format': out_format,
-            'samplename': samplename}
+            'samplename': samplename, 'processes': parsed_args.processes,
+            'from_bam': parsed_args.from_bam,
+            'min_mapq': parsed_args.min_mapq,
+            'rm_dups': parsed_args.rm_dups,
+            'sample': parsed_args.sample,
+            'reference': parsed_args.reference}
 
 
 
@@ -56,21 +79,19 @@ def main():
     out_format = args['out_format']
     plot_fhand = args['plot_fhand']
     samplename = args['samplename']
-    count = 0
-    depths = Counter()
-    for line in in_fhand:
-        line = line.strip()
-        if not line or line[0] == '#':
-            continue
-        items = line.split()
-        depths[int(items[2])] += 1
-        # count += 1
-        # if count > 1000000:
-        #     break
-    # dps = []
-    # for dp, count in depths.items():
-    #     dps.extend([dp] * count)
-    # depths = np.array(dps)
+    processes = args['processes']
+    if args['from_bam']:
+        in_fhand.close()
+        depths = calc_bam_depth_histogram(in_fhand.name,
+                                          min_mapq=args['min_mapq'],
+                                          rm_dups=args['rm_dups'],
+                                          sample=args['sample'],
+                                          processes=processes,
+                                          reference_fpath=args['reference'])
+    elif processes > 1 and in_fhand.seekable():
+        depths = calc_depth_histogram(in_fhand.name, processes=processes)
+    else:
+        depths = read_depth_histogram(in_fhand).to_counter()
     stats = calc_coverage_stats(depths, is_counter=True)
 
 
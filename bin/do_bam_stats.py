@@ -11,7 +11,7 @@ def _setup_argparse():
     'It returns the argument parser'
     description = 'Calculate bam stats using samtools'
     parser = argparse.ArgumentParser(description=description)
-    parser.add_argument('input', help='BAM or SAM files to process',
+    parser.add_argument('input', help='BAM, CRAM or SAM files to process',
                         type=argparse.FileType('rb'), nargs='*')
     parser.add_argument('-s', '--sample', help='Sample You want to calculate')
     parser.add_argument('-q', '--min_mapq', type=int, default=0,
@@ -21,6 +21,8 @@ def _setup_argparse():
                         type=argparse.FileType('wt'))
     parser.add_argument('--rm_dups', action='store_true', default=False,
                         help='remove dups from stats')
+    parser.add_argument('-r', '--reference',
+                        help='Reference fasta used to read CRAM files')
     return parser
 
 
@@ -34,15 +36,17 @@ def _parse_args(parser):
     min_mapq = parsed_args.min_mapq
     rm_dups = parsed_args.rm_dups
     return {'in_fhands': in_fhands, 'sample': sample, 'min_mapq': min_mapq,
-            'out_fhand': out_fhand, 'rm_dups': rm_dups}
+            'out_fhand': out_fhand, 'rm_dups': rm_dups,
+            'reference': parsed_args.reference}
 
 
-def _select_rgs_by_sample(in_fhands, sample=None):
+def _select_rgs_by_sample(in_fhands, sample=None, reference_fpath=None):
     selected_rgs = []
     if sample is None:
         return selected_rgs
     for in_fhand in in_fhands:
-        samfile = pysam.AlignmentFile(in_fhand.name, "r")
+        samfile = pysam.AlignmentFile(in_fhand.name, "r",
+                                      reference_filename=reference_fpath)
         for rg in samfile.header['RG']:
             rg_sample = rg['SM']
             rg_id = rg['ID']
@@ -52,17 +56,21 @@ def _select_rgs_by_sample(in_fhands, sample=None):
 
 
 def make_stats_for_sample(in_fhands, stats_fhand, sample=None, min_mapq=None,
-                          rm_dups=False):
-    selected_rgs = _select_rgs_by_sample(in_fhands, sample)
+                          rm_dups=False, reference_fpath=None):
+    selected_rgs = _select_rgs_by_sample(in_fhands, sample,
+                                         reference_fpath=reference_fpath)
+    reference_params = []
+    if reference_fpath is not None:
+        reference_params = ['--reference', reference_fpath]
     if len(in_fhands) > 1:
-        merge_cmd = ['samtools', 'merge', '-u', '-']
+        merge_cmd = ['samtools', 'merge', '-u'] + reference_params + ['-']
         merge_cmd.extend([fhand.name for fhand in in_fhands])
         merge_cmd.append('|')
     else:
         merge_cmd = []
 
     flag = '1536' if rm_dups else '512'
-    view_cmd = ['samtools', 'view', '-u', '-F', flag]
+    view_cmd = ['samtools', 'view', '-u', '-F', flag] + reference_params
 
     if min_mapq:
         view_cmd.extend(['-q', str(min_mapq)])
@@ -119,7 +127,8 @@ def run():
     make_stats_for_sample(args['in_fhands'], stats_fhand,
                           sample=sample,
                           min_mapq=args['min_mapq'],
-                          rm_dups=args['rm_dups'])
+                          rm_dups=args['rm_dups'],
+                          reference_fpath=args['reference'])
 
 
 if __name__ == '__main__':
@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 import argparse
 import sys
+from dora.mapping.bam import (DUPLICATES_BACKENDS, PICARD, EDGE_TAG_TYPES,
+                              STRING_TAG_TYPE)
 from dora.mapping.bwa import map_mp_bwamem
+from dora.mapping.mapping_rate import MAPPING_RATE_READS
 
 
 def _setup_argparse():
@@ -21,10 +24,34 @@ def _setup_argparse():
     parser.add_argument('-g', '--read_group', help='Read group')
     parser.add_argument('-d', '--do_duplicates', help='Do duplicates?',
                         action='store_true')
+    parser.add_argument('--duplicates_backend', default=PICARD,
+                        choices=DUPLICATES_BACKENDS,
+                        help='Program used to mark duplicates')
     parser.add_argument('-e', '--do_downgrade_edges', help='Do duplicates?',
                         action='store_true')
     parser.add_argument('-c', '--downgrade_edges_conf', nargs=2, type=int,
                         help='Read start and end edges sizes to downgrade')
+    parser.add_argument('--edge_tag_type', default=STRING_TAG_TYPE,
+                        choices=EDGE_TAG_TYPES,
+                        help='Store the original edge qualities as Sanger '
+                             'strings (Z) or byte arrays (B)')
+    parser.add_argument('--downgrade_before_sort', action='store_true',
+                        help='Downgrade the edges of the unsorted reads')
+    parser.add_argument('--cram', action='store_true',
+                        help='Write a cram using the bwa index as reference, '
+                             'the output file has to end with .cram')
+    parser.add_argument('--cache_dir',
+                        help='Dir to cache the outputs of the stages')
+    parser.add_argument('--cache_size', type=int,
+                        help='Cache size in megabytes')
+    parser.add_argument('--progress_dir',
+                        help='Dir to write the mapping progress')
+    parser.add_argument('--min_mapping_rate', type=float,
+                        help='Stop if the mapping rate of the first reads '
+                             'is lower, i.e. 0.5')
+    parser.add_argument('--mapping_rate_reads', type=int,
+                        default=MAPPING_RATE_READS,
+                        help='Reads used to check the mapping rate')
     parser.add_argument('-f', '--filter_supplementary',
                         help='Filter out supplementary reads',
                         action='store_true')
@@ -55,11 +82,20 @@ def _parse_args(parser):
 
     conf['threads'] = parsed_args.threads
     conf['do_duplicates'] = parsed_args.do_duplicates
+    conf['duplicates_backend'] = parsed_args.duplicates_backend
     conf['do_downgrade_edges'] = parsed_args.do_downgrade_edges
     conf['filter_supplementary'] = parsed_args.filter_supplementary
+    conf['downgrade_before_sort'] = parsed_args.downgrade_before_sort
+    conf['do_cram'] = parsed_args.cram
+    conf['cache_dir'] = parsed_args.cache_dir
+    conf['cache_size'] = parsed_args.cache_size
+    conf['progress_dir'] = parsed_args.progress_dir
+    conf['min_mapping_rate'] = parsed_args.min_mapping_rate
+    conf['mapping_rate_reads'] = parsed_args.mapping_rate_reads
     if parsed_args.do_downgrade_edges:
         start, end = parsed_args.downgrade_edges_conf
-        downgrade_edges_conf = {'read_start_size': start, 'read_end_size': end}
+        downgrade_edges_conf = {'read_start_size': start, 'read_end_size': end,
+                                'tag_type': parsed_args.edge_tag_type}
         conf['downgrade_edges_conf'] = downgrade_edges_conf
 
     return conf
@@ -12,8 +12,10 @@ def _setup_argparse():
     'It returns the argument parser'
     description = 'Draw mapq histogram'
     parser = argparse.ArgumentParser(description=description)
-    parser.add_argument('input', help='BAM or SAM file to process',
+    parser.add_argument('input', help='BAM, CRAM or SAM file to process',
                         type=argparse.FileType('rb'))
+    parser.add_argument('-r', '--reference',
+                        help='Reference fasta used to read CRAM files')
     parser.add_argument('-o', '--outfile', dest='outfile', required=True,
                         help='Output file',
                         type=argparse.FileType('wb'))
@@ -28,12 +30,13 @@ def _parse_args(parser):
     bam_fhand = parsed_args.input
     out_fhand = getattr(parsed_args, 'outfile')
 
-    return {'bam_fhand': bam_fhand, 'out_fhand': out_fhand}
+    return {'bam_fhand': bam_fhand, 'out_fhand': out_fhand,
+            'reference': parsed_args.reference}
 
 
-def read_mapqs(fhand):
+def read_mapqs(fhand, reference_fpath=None):
     mapq_counter = Counter()
-    bam = pysam.AlignmentFile(fhand.name)
+    bam = pysam.AlignmentFile(fhand.name, reference_filename=reference_fpath)
     for read in bam:
         if not read.is_unmapped:
             mapq_counter[read.mapq] += 1
@@ -46,7 +49,8 @@ def run():
     args = _parse_args(parser)
     out_fhand = args['out_fhand']
 
-    mapq_counter = read_mapqs(args['bam_fhand'])
+    mapq_counter = read_mapqs(args['bam_fhand'],
+                              reference_fpath=args['reference'])
 
     draw_histogram_in_fhand(mapq_counter, fhand=out_fhand,
                             title='Mapq distribution', kind=BAR,
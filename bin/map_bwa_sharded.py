@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+import argparse
+import sys
+from pathlib import Path
+
+from dora.mapping.bwa import (prepare_shards, map_shards, merge_shards,
+                              READS_PER_SHARD)
+from dora.mapping.lease import LEASE_TIMEOUT
+
+
+def _setup_argparse():
+    'It returns the argument parser'
+    description = 'Map a sample with bwa in shards. The shards can be mapped '
+    description += 'by workers in several nodes sharing the shard dir'
+    parser = argparse.ArgumentParser(description=description)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    split_parser = subparsers.add_parser('split',
+                                         help='Split the reads in shards')
+    split_parser.add_argument('shard_dir', help='Dir to write the shards')
+    split_parser.add_argument('-1', '--pair1', required=True,
+                              help='pair 1 fastq path')
+    split_parser.add_argument('-2', '--pair2', help='pair 2 fastq path')
+    split_parser.add_argument('-r', '--bwa_index', required=True,
+                              help='Path to bwa index')
+    split_parser.add_argument('-s', '--sample', required=True, help='sample')
+    split_parser.add_argument('-l', '--library', help='Library')
+    split_parser.add_argument('-g', '--read_group', help='Read group')
+    split_parser.add_argument('-t', '--threads', default=1, type=int,
+                              help='Threads used to map each shard')
+    split_parser.add_argument('-m', '--sort_memory', type=int,
+                              help='Memory to sort each shard, in MB')
+    split_parser.add_argument('-n', '--reads_per_shard', type=int,
+                              default=READS_PER_SHARD,
+                              help='Reads (or pairs) in each shard')
+
+    map_parser = subparsers.add_parser('map', help='Map the shards')
+    map_parser.add_argument('shard_dir', help='Dir with the shards')
+    map_parser.add_argument('-w', '--workers', default=1, type=int,
+                            help='Shards to map at the same time')
+    map_parser.add_argument('--lease_timeout', type=int,
+                            default=LEASE_TIMEOUT,
+                            help='Seconds without heartbeat to claim a '
+                                 'shard of a dead worker again')
+
+    merge_parser = subparsers.add_parser('merge',
+                                         help='Merge the mapped shards')
+    merge_parser.add_argument('shard_dir', help='Dir with the shards')
+    merge_parser.add_argument('-o', '--outfile', required=True,
+                              help='Output file')
+    merge_parser.add_argument('-t', '--threads', default=1, type=int,
+                              help='Threads')
+    return parser
+
+
+def _get_shard_conf_fpaths(shard_dir):
+    return sorted(str(path) for path in Path(shard_dir).glob('shard*.json'))
+
+
+def split(args):
+    sample = args.sample
+    library = args.library if args.library else sample
+    read_group = args.read_group if args.read_group else sample
+    readgroup = {'ID': read_group, 'LB': library, 'SM': sample,
+                 'PL': 'illumina'}
+    bwa_conf = {'index_fpath': args.bwa_index, 'threads': args.threads,
+                'readgroup': readgroup}
+    if args.pair2:
+        bwa_conf['paired_paths'] = [args.pair1, args.pair2]
+    else:
+        bwa_conf['unpaired_path'] = args.pair1
+    sort_conf = {'threads': args.threads, 'memory': args.sort_memory}
+    shard_conf_fpaths = prepare_shards(bwa_conf, args.shard_dir,
+                                       reads_per_shard=args.reads_per_shard,
+                                       sort_conf=sort_conf)
+    sys.stdout.write('{} shards written\n'.format(len(shard_conf_fpaths)))
+
+
+def map_(args):
+    results = map_shards(_get_shard_conf_fpaths(args.shard_dir), args.workers,
+                         lease_timeout=args.lease_timeout)
+    some_fail = False
+    some_claimed = False
+    for result in results:
+        if result['fail']:
+            some_fail = True
+            sys.stdout.write('ERROR: {}, {}\n'.format(result['sample'],
+                                                      result['error_msg']))
+        elif result.get('claimed'):
+            some_claimed = True
+            sys.stdout.write('NOT MAPPED: {}, {}\n'.format(
+                result['sample'], result['error_msg']))
+        else:
+            sys.stdout.write('{}: {}\n'.format(result['sample'],
+                                               result['error_msg']))
+    if some_claimed:
+        sys.stdout.write('Some shards are being mapped by other workers, run '
+                         'map again to claim them if those workers die\n')
+    if some_fail:
+        sys.exit(1)
+
+
+def merge(args):
+    merge_shards(_get_shard_conf_fpaths(args.shard_dir), args.outfile,
+                 threads=args.threads, stderr_fhand=sys.stderr)
+
+
+def main():
+    parser = _setup_argparse()
+    args = parser.parse_args()
+    commands = {'split': split, 'map': map_, 'merge': merge}
+    commands[args.command](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,22 +2,52 @@
 import sys
 import os
 
-from dora.mapping.utils import generate_bwa_confs_from_project, run_multiprocesses
+from dora.mapping.utils import (generate_bwa_confs_from_project,
+                                run_multiprocesses_with_budget,
+                                get_total_memory, order_confs_largest_first,
+                                write_checkpoint_status,
+                                MIN_THREADS_PER_SAMPLE)
 from dora.mapping.bwa import map_mp_bwamem
+from dora.mapping.shm import shared_bwa_indexes
+from dora.mapping.orchestrator import (run_project_async,
+                                       get_default_stage_limits)
+from dora.mapping.work_queue import write_jobs, wait_for_jobs
 
 MARK_DUPLICATES = None
 DOWNGRADE_EDGES = None
+CHECKPOINT = False
+# write crams compressed against the bwa index reference
+CRAM = False
+# keep the stage outputs to reuse them when the project is mapped again
+CACHE_DIR = None
+CACHE_SIZE = None  # in megabytes
+# run the external programs of all the samples from one asyncio event loop
+ASYNC_ORCHESTRATOR = False
+# load the bwa index once in shared memory for all the samples
+SHARED_INDEX = False
+# write the samples as jobs for bin/mapping_worker.py workers in any node
+# that shares this dir, and wait for their results
+WORK_QUEUE_DIR = None
+# write the reads mapped per second and the time left of every sample, see
+# them with bin/mapping_progress.py
+PROGRESS = False
+# stop the samples with a lower mapping rate in their first reads, i.e. 0.5
+MIN_MAPPING_RATE = None
 
 
 def main():
-    threads = 20
-    processes = 6
+    threads = os.sysconf('SC_NPROCESSORS_ONLN')
+    memory = int(get_total_memory() * 0.9)  # in megabytes
     paired = True
     project_path = sys.argv[1]
     read_dir = os.path.join(project_path, 'reads/clean')
     out_dir = os.path.join(project_path, 'mapping/bams')
     tmp_dir = os.path.join(project_path, 'tmp')
     samples_path = os.path.join(project_path, 'samples.txt')
+    metrics_path = os.path.join(project_path, 'mapping/metrics.jsonl')
+    progress_dir = None
+    if PROGRESS:
+        progress_dir = os.path.join(project_path, 'mapping/progress')
     pair_def_format = ''  # how are the pair formated _1 or _R1
     downgrade_edges_conf = {'read_start_size': 3, 'read_end_size': 3}
     bwa_index = '/home/jope/genomes/tomato/S_lycopersicum_chromosomes.2.50.fa'
@@ -25,15 +55,51 @@ def main():
     if MARK_DUPLICATES is None or DOWNGRADE_EDGES is None:
         raise ValueError('You have to set the MARK_DUPLICATES and DOWNGRADE EDGES')
 
+    sample_threads = threads
+    if ASYNC_ORCHESTRATOR:
+        # the budget runner sets the threads of every sample when it starts
+        concurrent_samples = max(1, threads // MIN_THREADS_PER_SAMPLE)
+        sample_threads = max(1, threads // concurrent_samples)
     confs = generate_bwa_confs_from_project(samples_path, bwa_index,
                                             do_duplicates=MARK_DUPLICATES,
                                             do_downgrade_edges=DOWNGRADE_EDGES,
                                             tmp_dir=tmp_dir,
-                                            read_dir=read_dir, threads=threads,
+                                            read_dir=read_dir,
+                                            threads=sample_threads,
                                             downgrade_edges_conf=downgrade_edges_conf,
                                             out_dir=out_dir, paired=paired,
-                                            pair_def_format=pair_def_format)
-    run_multiprocesses(map_mp_bwamem, confs, processes, log_fhand)
+                                            pair_def_format=pair_def_format,
+                                            checkpoint=CHECKPOINT,
+                                            do_cram=CRAM,
+                                            cache_dir=CACHE_DIR,
+                                            cache_size=CACHE_SIZE,
+                                            progress_dir=progress_dir,
+                                            min_mapping_rate=MIN_MAPPING_RATE)
+    if CHECKPOINT:
+        write_checkpoint_status(confs, log_fhand)
+    confs = order_confs_largest_first(confs)
+    with open(metrics_path, 'a') as metrics_fhand:
+        if WORK_QUEUE_DIR:
+            job_ids = write_jobs(confs, WORK_QUEUE_DIR)
+            wait_for_jobs(WORK_QUEUE_DIR, job_ids, log_fhand,
+                          metrics_fhand=metrics_fhand)
+        elif ASYNC_ORCHESTRATOR:
+            run_project_async(confs, log_fhand,
+                              stage_limits=get_default_stage_limits(threads),
+                              metrics_fhand=metrics_fhand)
+        elif SHARED_INDEX:
+            with shared_bwa_indexes([bwa_index], memory=memory,
+                                    log_fhand=log_fhand) as (shared,
+                                                             shared_memory):
+                run_multiprocesses_with_budget(map_mp_bwamem, confs,
+                                               log_fhand, threads=threads,
+                                               memory=memory - shared_memory,
+                                               metrics_fhand=metrics_fhand,
+                                               shared_indexes=shared)
+        else:
+            run_multiprocesses_with_budget(map_mp_bwamem, confs, log_fhand,
+                                           threads=threads, memory=memory,
+                                           metrics_fhand=metrics_fhand)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+import argparse
+import sys
+import time
+
+from dora.mapping.progress import read_progress, write_progress, STUCK_TIME
+
+
+def _setup_argparse():
+    'It returns the argument parser'
+    description = 'Show the reads mapped per second and the time left of '
+    description += 'the samples being mapped'
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('progress_dir', help='Dir with the mapping progress')
+    parser.add_argument('-s', '--stuck_time', type=int, default=STUCK_TIME,
+                        help='Seconds without progress to show a sample as '
+                             'stuck')
+    parser.add_argument('-w', '--watch', type=int,
+                        help='Show the progress every given seconds')
+    return parser
+
+
+def main():
+    parser = _setup_argparse()
+    args = parser.parse_args()
+    out_fhand = sys.stdout
+    while True:
+        statuses = read_progress(args.progress_dir,
+                                 stuck_time=args.stuck_time)
+        out_fhand.write('sample\tstate\treads\tdone\treads/s\teta\n')
+        write_progress(statuses, out_fhand)
+        if not args.watch:
+            break
+        time.sleep(args.watch)
+        out_fhand.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+import argparse
+import sys
+
+from dora.mapping.work_queue import (run_worker, HEARTBEAT_INTERVAL,
+                                     LEASE_TIMEOUT, POLL_INTERVAL)
+
+
+def _setup_argparse():
+    'It returns the argument parser'
+    description = 'Map the samples of a work queue. Any number of workers, '
+    description += 'in any node that shares the queue dir, can run at once'
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('queue_dir', help='Work queue dir')
+    parser.add_argument('-w', '--worker_id',
+                        help='Worker name, by default host.pid')
+    parser.add_argument('--lease_timeout', type=int, default=LEASE_TIMEOUT,
+                        help='Seconds without heartbeat to claim a job again')
+    parser.add_argument('--heartbeat_interval', type=int,
+                        default=HEARTBEAT_INTERVAL,
+                        help='Seconds between heartbeats')
+    parser.add_argument('--poll_interval', type=int, default=POLL_INTERVAL,
+                        help='Seconds between looks for new jobs')
+    parser.add_argument('--no_wait', action='store_true',
+                        help='Exit when there are no jobs to claim, do not '
+                             'wait for the ones running in other workers')
+    return parser
+
+
+def main():
+    parser = _setup_argparse()
+    args = parser.parse_args()
+    run_worker(args.queue_dir, worker_id=args.worker_id,
+               log_fhand=sys.stdout, lease_timeout=args.lease_timeout,
+               heartbeat_interval=args.heartbeat_interval,
+               poll_interval=args.poll_interval, wait=not args.no_wait)
+
+
+if __name__ == '__main__':
+    main()
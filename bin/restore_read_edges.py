@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+import argparse
+import sys
+
+from dora.mapping.bam import restore_read_edges
+
+
+def _setup_argparse():
+    'It returns the argument parser'
+    description = 'Restore the read edge qualities downgraded while mapping '
+    description += 'and remove the dl and dr tags'
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-i', '--infile', required=True,
+                        help='Bam with downgraded edges')
+    parser.add_argument('-o', '--outfile', required=True, help='Output bam')
+    parser.add_argument('-t', '--threads', default=1, type=int,
+                        help='Threads to compress and decompress the bam')
+    parser.add_argument('-w', '--workers', default=1, type=int,
+                        help='Processes restoring contigs in parallel. '
+                             'The bam has to be sorted by coordinate')
+    parser.add_argument('--tmpdir', help='Dir for the temporary files')
+    return parser
+
+
+def main():
+    parser = _setup_argparse()
+    args = parser.parse_args()
+    try:
+        num_reads = restore_read_edges(args.infile, args.outfile,
+                                       threads=args.threads,
+                                       workers=args.workers,
+                                       tmp_dir=args.tmpdir)
+    except RuntimeError as error:
+        sys.stderr.write('ERROR: {}\n'.format(error))
+        sys.exit(1)
+    sys.stdout.write('{} reads restored\n'.format(num_reads))
+
+
+if __name__ == '__main__':
+    main()
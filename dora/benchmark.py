@@ -0,0 +1,310 @@
+import json
+import random
+import subprocess
+import time
+from itertools import product
+from array import array
+from functools import partial
+from pathlib import Path
+
+from pysam import AlignedSegment, AlignmentHeader
+
+import dora
+from dora.mapping.bam import (downgrade_edge_qualities,
+                              _downgrade_edge_qualities_python,
+                              BYTES_TAG_TYPE)
+from dora.mapping.bwa import map_mp_bwamem
+from dora.mapping.fastq import open_fastq
+
+COMPLEMENT = str.maketrans('ACGT', 'TGCA')
+NUCLEOTIDES = 'ACGT'
+STAGE_FLAGS = ('do_duplicates', 'filter_supplementary', 'do_downgrade_edges',
+               'do_csi_index')
+DATASET_FNAME = 'dataset.json'
+REFERENCE_FNAME = 'reference.fasta'
+READ1_FNAME = 'reads_1.fastq.gz'
+READ2_FNAME = 'reads_2.fastq.gz'
+FASTA_LINE_LENGTH = 60
+
+
+def _reverse_complement(seq):
+    return seq.translate(COMPLEMENT)[::-1]
+
+
+def generate_reference(fpath, size, num_contigs=1, seed=None):
+    'It writes a random reference and returns its sequences'
+    rnd = random.Random(seed)
+    contig_size = size // num_contigs
+    seqs = []
+    with open(str(fpath), 'w') as fhand:
+        for contig_index in range(num_contigs):
+            seq = ''.join(rnd.choice(NUCLEOTIDES) for _ in range(contig_size))
+            seqs.append(seq)
+            fhand.write('>contig{}\n'.format(contig_index + 1))
+            for start in range(0, len(seq), FASTA_LINE_LENGTH):
+                fhand.write(seq[start:start + FASTA_LINE_LENGTH] + '\n')
+    return seqs
+
+
+def _add_errors(seq, error_rate, rnd):
+    if not error_rate:
+        return seq
+    seq = list(seq)
+    for pos in range(len(seq)):
+        if rnd.random() < error_rate:
+            seq[pos] = rnd.choice(NUCLEOTIDES)
+    return ''.join(seq)
+
+
+def generate_paired_reads(seqs, read1_fpath, read2_fpath, depth,
+                          read_length=150, insert_size=350, insert_sd=30,
+                          duplicate_rate=0, error_rate=0.001, seed=None):
+    """It writes paired reads sampled from the given sequences.
+
+    A duplicate_rate fraction of the pairs are copies of previous fragments,
+    like the ones created by the PCR. It returns the number of pairs.
+    """
+    rnd = random.Random(seed)
+    genome_size = sum(len(seq) for seq in seqs)
+    num_pairs = int(depth * genome_size / (2 * read_length))
+    qual = 'I' * read_length
+    fragments = []
+    with open_fastq(read1_fpath, 'wt') as fhand1, \
+            open_fastq(read2_fpath, 'wt') as fhand2:
+        for pair_index in range(num_pairs):
+            if fragments and rnd.random() < duplicate_rate:
+                seq_index, start, length = rnd.choice(fragments)
+            else:
+                seq_index = rnd.randrange(len(seqs))
+                seq = seqs[seq_index]
+                length = int(rnd.gauss(insert_size, insert_sd))
+                length = min(max(length, read_length), len(seq))
+                start = rnd.randrange(len(seq) - length + 1)
+                fragments.append((seq_index, start, length))
+            fragment = seqs[seq_index][start:start + length]
+            if rnd.random() < 0.5:
+                fragment = _reverse_complement(fragment)
+            read1 = _add_errors(fragment[:read_length], error_rate, rnd)
+            read2 = _add_errors(_reverse_complement(fragment)[:read_length],
+                                error_rate, rnd)
+            name = 'pair{}'.format(pair_index)
+            fhand1.write('@{}/1\n{}\n+\n{}\n'.format(name, read1,
+                                                     qual[:len(read1)]))
+            fhand2.write('@{}/2\n{}\n+\n{}\n'.format(name, read2,
+                                                     qual[:len(read2)]))
+    return num_pairs
+
+
+def generate_dataset(out_dir, genome_size, depth, duplicate_rate=0,
+                     num_contigs=1, read_length=150, seed=None,
+                     index=True):
+    'It writes a reference, its bwa index and paired reads in out_dir'
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    reference_fpath = out_dir.joinpath(REFERENCE_FNAME)
+    seqs = generate_reference(reference_fpath, genome_size,
+                              num_contigs=num_contigs, seed=seed)
+    num_pairs = generate_paired_reads(seqs, out_dir.joinpath(READ1_FNAME),
+                                      out_dir.joinpath(READ2_FNAME), depth,
+                                      read_length=read_length,
+                                      duplicate_rate=duplicate_rate,
+                                      seed=seed)
+    if index:
+        subprocess.run(['bwa', 'index', str(reference_fpath)], check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    dataset = {'genome_size': genome_size, 'num_contigs': num_contigs,
+               'depth': depth, 'duplicate_rate': duplicate_rate,
+               'read_length': read_length, 'seed': seed,
+               'reads': num_pairs * 2}
+    with out_dir.joinpath(DATASET_FNAME).open('w') as fhand:
+        json.dump(dataset, fhand, indent=2)
+    return dataset
+
+
+def get_stage_combinations():
+    'It returns a conf for every combination of the optional stages'
+    return [dict(zip(STAGE_FLAGS, flags))
+            for flags in product((False, True), repeat=len(STAGE_FLAGS))]
+
+
+def get_combination_name(combination):
+    enabled = [flag for flag in STAGE_FLAGS if combination[flag]]
+    return '+'.join(enabled) if enabled else 'mapping'
+
+
+def run_benchmark(dataset_dir, out_dir, threads=1, extra_conf=None,
+                  combinations=None):
+    """It maps the dataset with every stage combination.
+
+    The throughput is given in input reads per second of wall time.
+    """
+    dataset_dir = Path(dataset_dir)
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    with dataset_dir.joinpath(DATASET_FNAME).open() as fhand:
+        dataset = json.load(fhand)
+    if combinations is None:
+        combinations = get_stage_combinations()
+
+    runs = []
+    for combination in combinations:
+        name = get_combination_name(combination)
+        out_fpath = out_dir.joinpath(name + '.bam')
+        for fpath in out_dir.glob(name + '.*'):
+            fpath.unlink()
+        conf = {'sample': 'benchmark',
+                'index': str(dataset_dir.joinpath(REFERENCE_FNAME)),
+                'read1_fpath': str(dataset_dir.joinpath(READ1_FNAME)),
+                'read2_fpath': str(dataset_dir.joinpath(READ2_FNAME)),
+                'out_fpath': str(out_fpath), 'tmpdir': str(out_dir),
+                'threads': threads,
+                'downgrade_edges_conf': {'read_start_size': 3,
+                                         'read_end_size': 3}}
+        if extra_conf:
+            conf.update(extra_conf)
+        conf.update(combination)
+        start = time.time()
+        result = map_mp_bwamem(conf)
+        wall_time = time.time() - start
+        runs.append({'combination': name, 'fail': result['fail'],
+                     'wall_time': wall_time,
+                     'reads_per_second': dataset['reads'] / wall_time,
+                     'stages': result.get('stages')})
+    return {'version': dora.__version__, 'time': time.time(),
+            'threads': threads, 'dataset': dataset, 'runs': runs}
+
+
+def write_benchmark(benchmark, fpath):
+    with open(str(fpath), 'w') as fhand:
+        json.dump(benchmark, fhand, indent=2)
+
+
+def read_benchmark(fpath):
+    with open(str(fpath)) as fhand:
+        return json.load(fhand)
+
+
+def compare_benchmarks(reference, current, tolerance=0.1):
+    """It compares the throughput of two benchmarks.
+
+    It returns the combinations whose throughput dropped more than the
+    tolerance, as (combination, reference reads/s, current reads/s).
+    """
+    if reference['dataset'] != current['dataset']:
+        raise ValueError('The benchmarks were run with different datasets')
+    reference_runs = {run['combination']: run for run in reference['runs']}
+    regressions = []
+    for run in current['runs']:
+        reference_run = reference_runs.get(run['combination'])
+        if reference_run is None or reference_run['fail'] or run['fail']:
+            continue
+        reference_speed = reference_run['reads_per_second']
+        speed = run['reads_per_second']
+        if speed < reference_speed * (1 - tolerance):
+            regressions.append((run['combination'], reference_speed, speed))
+    return regressions
+
+
+def benchmark_decompression(dataset_dir, out_dir, threads=1,
+                            decompress_threads=None):
+    """It compares the mapping throughput when bwa decompresses the reads
+    with the one given by the parallel decompressors.
+
+    Only the mapping stage is run.
+    """
+    if decompress_threads is None:
+        decompress_threads = max(threads // 4, 1)
+    mapping_only = {flag: False for flag in STAGE_FLAGS}
+    runs = {}
+    for name, threads_to_decompress in (('bwa', 0),
+                                        ('parallel', decompress_threads)):
+        benchmark = run_benchmark(
+            dataset_dir, Path(out_dir, name), threads=threads,
+            extra_conf={'decompress_threads': threads_to_decompress},
+            combinations=[mapping_only])
+        runs[name] = benchmark['runs'][0]
+    bwa_speed = runs['bwa']['reads_per_second']
+    parallel_speed = runs['parallel']['reads_per_second']
+    return {'version': dora.__version__, 'time': time.time(),
+            'threads': threads, 'decompress_threads': decompress_threads,
+            'dataset': benchmark['dataset'],
+            'fail': runs['bwa']['fail'] or runs['parallel']['fail'],
+            'bwa_reads_per_second': bwa_speed,
+            'parallel_reads_per_second': parallel_speed,
+            'speedup': parallel_speed / bwa_speed}
+
+
+def generate_aligned_reads(num_reads, read_length=150, seed=None):
+    """It returns random aligned reads, some of them soft clipped.
+
+    Half of the reads are mapped in the reverse strand.
+    """
+    rnd = random.Random(seed)
+    header = AlignmentHeader.from_dict({'SQ': [{'SN': 'contig1',
+                                                'LN': 10000000}]})
+    reads = []
+    for read_index in range(num_reads):
+        read = AlignedSegment(header)
+        read.query_name = 'read{}'.format(read_index)
+        read.query_sequence = ''.join(rnd.choice(NUCLEOTIDES)
+                                      for _ in range(read_length))
+        read.flag = 16 if rnd.random() < 0.5 else 0
+        read.reference_id = 0
+        read.reference_start = rnd.randrange(10000000 - read_length)
+        read.mapping_quality = 60
+        max_clip = max(read_length // 4, 1)
+        left_clip = rnd.choice((0, 0, rnd.randrange(max_clip)))
+        right_clip = rnd.choice((0, 0, rnd.randrange(max_clip)))
+        cigar = []
+        if left_clip:
+            cigar.append((4, left_clip))
+        cigar.append((0, read_length - left_clip - right_clip))
+        if right_clip:
+            cigar.append((4, right_clip))
+        read.cigartuples = cigar
+        read.query_qualities = array('B', (rnd.randrange(2, 42)
+                                           for _ in range(read_length)))
+        reads.append(read)
+    return reads
+
+
+def _time_downgrade(downgrade, reads, read_start_size, read_end_size,
+                    qual_to_substract):
+    reads = [AlignedSegment.fromstring(read.to_string(), read.header)
+             for read in reads]
+    start = time.perf_counter()
+    for read in reads:
+        downgrade(read, read_start_size, read_end_size, qual_to_substract)
+    return time.perf_counter() - start, reads
+
+
+def benchmark_downgrade_edge_qualities(num_reads=100000, read_length=150,
+                                       read_start_size=3, read_end_size=3,
+                                       qual_to_substract=60, seed=None):
+    """It compares the edge downgrade with the base by base implementation.
+
+    It fails if both implementations do not give the same reads. It also
+    times the downgrade storing the original qualities in byte array tags.
+    """
+    reads = generate_aligned_reads(num_reads, read_length=read_length,
+                                   seed=seed)
+    times = {}
+    downgraded_reads = {}
+    for name, downgrade in (('python', _downgrade_edge_qualities_python),
+                            ('buffer', downgrade_edge_qualities),
+                            ('bytes_tags', partial(downgrade_edge_qualities,
+                                                   tag_type=BYTES_TAG_TYPE))):
+        times[name], downgraded_reads[name] = _time_downgrade(
+            downgrade, reads, read_start_size, read_end_size,
+            qual_to_substract)
+    for python_read, read in zip(downgraded_reads['python'],
+                                 downgraded_reads['buffer']):
+        if python_read.to_string() != read.to_string():
+            msg = 'The downgraded reads differ: {}'
+            raise RuntimeError(msg.format(python_read.query_name))
+    return {'version': dora.__version__, 'reads': num_reads,
+            'read_length': read_length,
+            'python_reads_per_second': num_reads / times['python'],
+            'buffer_reads_per_second': num_reads / times['buffer'],
+            'bytes_tags_reads_per_second': num_reads / times['bytes_tags'],
+            'speedup': times['python'] / times['buffer']}
@@ -1,44 +1,248 @@
+import multiprocessing as mp
+import os
 import shutil
 import subprocess
+import sys
 from array import array
-from subprocess import CalledProcessError
-from tempfile import NamedTemporaryFile
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+from subprocess import CalledProcessError, PIPE, Popen
+from tempfile import NamedTemporaryFile, mkdtemp
 
-from pysam import index, AlignmentFile
+from pysam import cat, index, idxstats, view, AlignmentFile
+
+from dora.mapping.utils import (start_sort, wait_processes,
+                                cram_output_params, indexed_output, is_cram)
 
 LEFT_DOWNGRADED_TAG = 'dl'
 RIGTH_DOWNGRADED_TAG = 'dr'
 QUAL_TO_SUBSTRACT = 60
+PICARD = 'picard'
+SAMTOOLS = 'samtools'
+DUPLICATES_BACKENDS = (PICARD, SAMTOOLS)
+UNMAPPED_CONTIG = '*'
+REGIONS_PER_WORKER = 4
+STRING_TAG_TYPE = 'Z'
+BYTES_TAG_TYPE = 'B'
+EDGE_TAG_TYPES = (STRING_TAG_TYPE, BYTES_TAG_TYPE)
+SANGER_ENCODING = bytes((qual + 33) % 256 for qual in range(256))
+SANGER_DECODING = bytes((qual - 33) % 256 for qual in range(256))
 
 
 def index_bam(path, do_csi_index=False):
-    'It indexes a bam file'
+    'It indexes a bam file, a cram always gets a crai index'
     cmd = []
-    if do_csi_index:
+    if do_csi_index and not is_cram(path):
         cmd.append('-c')
     cmd.append(str(path))
 
     index(*cmd)
 
 
+def count_indexed_reads(path):
+    'It counts the reads of an indexed bam using its index'
+    num_reads = 0
+    for line in idxstats(str(path)).splitlines():
+        items = line.split('\t')
+        num_reads += int(items[2]) + int(items[3])
+    return num_reads
+
+
 def downgrade_read_edges(in_fpath, out_fpath, read_start_size, read_end_size,
-                         qual_to_substract=QUAL_TO_SUBSTRACT):
-    in_sam = AlignmentFile(in_fpath)
-    out_sam = AlignmentFile(out_fpath, 'wb', template=in_sam)
-    for aligned_read in in_sam:
+                         qual_to_substract=QUAL_TO_SUBSTRACT, threads=1,
+                         workers=1, tmp_dir=None, uncompressed=False,
+                         tag_type=STRING_TAG_TYPE, reference_fpath=None):
+    """It downgrades the qualities of the edges of every read in the bam.
+
+    in_fpath can also be an open file object, like the stdout of a previous
+    process, so this stage can be fed from a pipe.
+    threads are used to decompress and compress the bam.
+    out_fpath can be a file object too, with uncompressed the bam is written
+    uncompressed to feed the next process faster.
+    With a reference_fpath the output is written as a cram and the input can
+    also be a cram.
+    With more than one worker the bam, that has to be a coordinate sorted
+    file, is split by contigs that are processed in parallel.
+    It returns the number of reads processed.
+    """
+    downgrade_conf = {'read_start_size': read_start_size,
+                      'read_end_size': read_end_size,
+                      'qual_to_substract': qual_to_substract,
+                      'tag_type': tag_type}
+    return _process_bam(in_fpath, out_fpath, _downgrade_reads,
+                        downgrade_conf, threads=threads, workers=workers,
+                        tmp_dir=tmp_dir, uncompressed=uncompressed,
+                        reference_fpath=reference_fpath)
+
+
+def restore_read_edges(in_fpath, out_fpath, threads=1, workers=1,
+                       tmp_dir=None, uncompressed=False, reference_fpath=None):
+    """It restores the edge qualities of the reads and removes the dl and dr
+    tags.
+
+    in_fpath, out_fpath, threads, workers and reference_fpath work as in
+    downgrade_read_edges. The reads that were not downgraded are written
+    unchanged.
+    It returns the number of reads processed.
+    """
+    return _process_bam(in_fpath, out_fpath, _restore_reads, {},
+                        threads=threads, workers=workers, tmp_dir=tmp_dir,
+                        uncompressed=uncompressed,
+                        reference_fpath=reference_fpath)
+
+
+def _process_bam(in_fpath, out_fpath, process_reads, process_conf, threads=1,
+                 workers=1, tmp_dir=None, uncompressed=False,
+                 reference_fpath=None):
+    if workers > 1 and not mp.current_process().daemon:
+        return _process_bam_by_contigs(in_fpath, out_fpath, process_reads,
+                                       process_conf, threads, workers,
+                                       tmp_dir, reference_fpath)
+    in_sam = AlignmentFile(in_fpath, threads=threads,
+                           reference_filename=reference_fpath)
+    out_sam = _open_out_sam(out_fpath, in_sam, threads, uncompressed,
+                            reference_fpath)
+    try:
+        num_reads = process_reads(in_sam, out_sam, **process_conf)
+    finally:
+        out_sam.close()
+        in_sam.close()
+    return num_reads
+
+
+def _open_out_sam(out_fpath, template, threads, uncompressed=False,
+                  reference_fpath=None):
+    if reference_fpath is not None:
+        return AlignmentFile(out_fpath, 'wc', template=template,
+                             threads=threads,
+                             reference_filename=str(reference_fpath))
+    return AlignmentFile(out_fpath, 'wbu' if uncompressed else 'wb',
+                         template=template, threads=threads)
+
+
+def _downgrade_reads(aligned_reads, out_sam, read_start_size, read_end_size,
+                     qual_to_substract, tag_type):
+    num_reads = 0
+    for aligned_read in aligned_reads:
+        num_reads += 1
         if (aligned_read.has_tag(LEFT_DOWNGRADED_TAG) or
                 aligned_read.has_tag(RIGTH_DOWNGRADED_TAG)):
             raise RuntimeError('Edge qualities already downgraded\n')
 
         downgrade_edge_qualities(aligned_read, read_start_size, read_end_size,
-                                 qual_to_substract=qual_to_substract)
+                                 qual_to_substract=qual_to_substract,
+                                 tag_type=tag_type)
         out_sam.write(aligned_read)
+    return num_reads
 
 
-def downgrade_edge_qualities(aligned_read, read_start_size, read_end_size,
-                             qual_to_substract):
-    is_reversed = bool(aligned_read.flag & 16)
-    if is_reversed:
+def _restore_reads(aligned_reads, out_sam):
+    num_reads = 0
+    for aligned_read in aligned_reads:
+        num_reads += 1
+        restore_edge_qualities(aligned_read)
+        out_sam.write(aligned_read)
+    return num_reads
+
+
+def _process_bam_by_contigs(in_fpath, out_fpath, process_reads, process_conf,
+                            threads, workers, tmp_dir, reference_fpath=None):
+    """It processes the contigs in a pool of processes.
+
+    The contigs are grouped in consecutive regions with a similar number of
+    reads, the unmapped reads without coordinates go to the last region.
+    Every region is written to a shard and, as they are in the bam order, the
+    shards are concatenated without sorting.
+    With a reference_fpath the shards are crams.
+    """
+    shard_dir = Path(mkdtemp(prefix='dora_contigs.', dir=tmp_dir))
+    try:
+        if is_cram(in_fpath):
+            index_fpath = shard_dir.joinpath('in.cram.crai')
+            index('-@', str(threads), str(in_fpath), str(index_fpath))
+        else:
+            index_fpath = shard_dir.joinpath('in.bam.csi')
+            index('-c', '-@', str(threads), str(in_fpath), str(index_fpath))
+        with AlignmentFile(str(in_fpath), index_filename=str(index_fpath),
+                           reference_filename=reference_fpath) as in_sam:
+            if in_sam.header.get('HD', {}).get('SO') != 'coordinate':
+                raise RuntimeError('The bam is not sorted by coordinate')
+            regions = split_contigs_in_regions(
+                in_sam.get_index_statistics(),
+                num_regions=workers * REGIONS_PER_WORKER)
+            if in_sam.nocoordinate:
+                regions.append([UNMAPPED_CONTIG])
+
+        worker_threads = max(threads // workers, 1)
+        shard_fpaths = []
+        tasks = []
+        for region_index, contigs in enumerate(regions):
+            shard_fpath = shard_dir.joinpath('{:05d}.bam'.format(region_index))
+            shard_fpaths.append(shard_fpath)
+            tasks.append((str(in_fpath), str(index_fpath), str(shard_fpath),
+                          contigs, process_reads, process_conf,
+                          worker_threads, reference_fpath))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_process_contigs, *task)
+                       for task in tasks]
+            num_reads = sum(future.result() for future in futures)
+        if shard_fpaths:
+            cat('-o', str(out_fpath), *[str(fpath) for fpath in shard_fpaths])
+        else:
+            with AlignmentFile(str(in_fpath),
+                               reference_filename=reference_fpath) as in_sam:
+                _open_out_sam(str(out_fpath), in_sam, threads,
+                              reference_fpath=reference_fpath).close()
+    finally:
+        shutil.rmtree(str(shard_dir), ignore_errors=True)
+    return num_reads
+
+
+def split_contigs_in_regions(index_stats, num_regions):
+    """It groups consecutive contigs in regions with a similar number of reads.
+
+    index_stats are the (contig, mapped, unmapped, total) tuples given by
+    pysam. The contigs without reads are not included.
+    """
+    index_stats = [stats for stats in index_stats if stats.total]
+    total = sum(stats.total for stats in index_stats)
+    reads_per_region = max(total / max(num_regions, 1), 1)
+    regions = []
+    region = []
+    region_reads = 0
+    for stats in index_stats:
+        region.append(stats.contig)
+        region_reads += stats.total
+        if region_reads >= reads_per_region:
+            regions.append(region)
+            region = []
+            region_reads = 0
+    if region:
+        regions.append(region)
+    return regions
+
+
+def _process_contigs(in_fpath, index_fpath, out_fpath, contigs,
+                     process_reads, process_conf, threads,
+                     reference_fpath=None):
+    in_sam = AlignmentFile(in_fpath, index_filename=index_fpath,
+                           threads=threads, reference_filename=reference_fpath)
+    out_sam = _open_out_sam(out_fpath, in_sam, threads,
+                            reference_fpath=reference_fpath)
+    num_reads = 0
+    try:
+        for contig in contigs:
+            num_reads += process_reads(in_sam.fetch(contig), out_sam,
+                                       **process_conf)
+    finally:
+        out_sam.close()
+        in_sam.close()
+    return num_reads
+
+
+def _get_edge_limits(aligned_read, read_start_size, read_end_size):
+    if aligned_read.flag & 16:
         right_limit = aligned_read.query_alignment_end - read_start_size
         left_limit = aligned_read.query_alignment_start + read_end_size
     else:
@@ -46,6 +250,60 @@ def downgrade_edge_qualities(aligned_read, read_start_size, read_end_size,
         right_limit = aligned_read.query_alignment_end - read_end_size
     if left_limit >= right_limit:
         right_limit = left_limit + 1
+    return left_limit, right_limit
+
+
+def downgrade_edge_qualities(aligned_read, read_start_size, read_end_size,
+                             qual_to_substract, tag_type=STRING_TAG_TYPE):
+    """It downgrades the qualities of the read edges working on the buffer.
+
+    The original edge qualities are kept in the dl and dr tags, as Sanger
+    encoded strings (Z) or as byte arrays (B:C) copied from the quality
+    buffer. The subtraction and the Sanger encoding are done with byte
+    translation tables.
+    """
+    if tag_type not in EDGE_TAG_TYPES:
+        raise ValueError('Unknown edge tag type: {}'.format(tag_type))
+    left_limit, right_limit = _get_edge_limits(aligned_read, read_start_size,
+                                               read_end_size)
+    quals = aligned_read.query_qualities.tobytes()
+    left_quals = quals[:left_limit]
+    right_quals = quals[right_limit:]
+
+    subtract_table = _get_subtract_table(qual_to_substract)
+    new_quals = (left_quals.translate(subtract_table) +
+                 quals[left_limit:right_limit] +
+                 right_quals.translate(subtract_table))
+    aligned_read.query_qualities = array('B', new_quals)
+
+    if tag_type == BYTES_TAG_TYPE:
+        aligned_read.set_tag(LEFT_DOWNGRADED_TAG, array('B', left_quals))
+        aligned_read.set_tag(RIGTH_DOWNGRADED_TAG, array('B', right_quals))
+    else:
+        aligned_read.set_tag(LEFT_DOWNGRADED_TAG, _to_sanger_qual(left_quals),
+                             value_type='Z')
+        aligned_read.set_tag(RIGTH_DOWNGRADED_TAG,
+                             _to_sanger_qual(right_quals), value_type='Z')
+
+
+@lru_cache(maxsize=None)
+def _get_subtract_table(qual_to_substract):
+    'It returns a table that subtracts the quality saturating at 0'
+    return bytes(max(qual - qual_to_substract, 0) for qual in range(256))
+
+
+def _to_sanger_qual(quals):
+    return quals.translate(SANGER_ENCODING).decode('latin-1')
+
+
+def _downgrade_edge_qualities_python(aligned_read, read_start_size,
+                                     read_end_size, qual_to_substract):
+    """It is the base by base implementation of downgrade_edge_qualities.
+
+    It is kept as the reference for the tests and the benchmarks.
+    """
+    left_limit, right_limit = _get_edge_limits(aligned_read, read_start_size,
+                                               read_end_size)
     quals = list(aligned_read.query_qualities)
 
     left_quals = quals[:left_limit]
@@ -57,24 +315,9 @@ def downgrade_edge_qualities(aligned_read, read_start_size, read_end_size,
             qual = 0
         return qual
 
-    downgraded_left_quals = list(map(minus, left_quals))
-    downgraded_right_quals = list(map(minus, right_quals))
-
-    new_quals = downgraded_left_quals
+    new_quals = list(map(minus, left_quals))
     new_quals.extend(quals[left_limit:right_limit])
-    new_quals.extend(downgraded_right_quals)
-
-    try:
-        assert len(quals) == len(new_quals)
-    except AssertionError:
-        print("Is reversed:", is_reversed)
-        print(aligned_read.query_alignment_start,
-              aligned_read.query_alignment_end)
-        print(read_start_size, read_end_size)
-        print(left_limit, right_limit)
-        print(left_quals, downgraded_left_quals)
-        print(right_quals, downgraded_right_quals)
-        raise
+    new_quals.extend(map(minus, right_quals))
     aligned_read.query_qualities = array('B', new_quals)
 
     def to_sanger_qual(quals):
@@ -86,29 +329,43 @@ def downgrade_edge_qualities(aligned_read, read_start_size, read_end_size,
                          value_type='Z')
 
 
-def _restore_qual_from_tag(aligned_read):
-    def to_phred_qual(quals):
-        return [ord(qual) - 33 for qual in quals]
+def restore_edge_qualities(aligned_read):
+    'It restores the downgraded edge qualities and removes the dl/dr tags'
+    _restore_qual_from_tag(aligned_read)
+    for tag in (LEFT_DOWNGRADED_TAG, RIGTH_DOWNGRADED_TAG):
+        if aligned_read.has_tag(tag):
+            aligned_read.set_tag(tag, None)
+
 
-    left_quals, rigth_quals = [], []
+def _restore_qual_from_tag(aligned_read):
+    'It reads both the Sanger string and the byte array tags'
+    left_quals, rigth_quals = b'', b''
     if aligned_read.has_tag(LEFT_DOWNGRADED_TAG):
-        left_quals = aligned_read.get_tag(LEFT_DOWNGRADED_TAG)
-        left_quals = to_phred_qual(left_quals)
+        left_quals = _get_tag_quals(aligned_read, LEFT_DOWNGRADED_TAG)
     if aligned_read.has_tag(RIGTH_DOWNGRADED_TAG):
-        rigth_quals = aligned_read.get_tag(RIGTH_DOWNGRADED_TAG)
-        rigth_quals = to_phred_qual(rigth_quals)
+        rigth_quals = _get_tag_quals(aligned_read, RIGTH_DOWNGRADED_TAG)
 
     if left_quals or rigth_quals:
-        recover_qual = left_quals
+        quals = aligned_read.query_qualities.tobytes()
         left_limit = len(left_quals)
         rigth_limit = -len(rigth_quals) if len(rigth_quals) else None
-        recover_qual += aligned_read.query_qualities[left_limit:rigth_limit]
-        recover_qual += rigth_quals
+        recover_qual = left_quals + quals[left_limit:rigth_limit] + rigth_quals
         aligned_read.query_qualities = array('B', recover_qual)
 
 
+def _get_tag_quals(aligned_read, tag):
+    quals = aligned_read.get_tag(tag)
+    if isinstance(quals, str):
+        return quals.encode('latin-1').translate(SANGER_DECODING)
+    return quals.tobytes()
+
+
 def mark_duplicates(in_fpath, out_fpath=None, tmp_dir=None, metric_fpath=None,
-                    stderr_fhand=None):
+                    stderr_fhand=None, backend=PICARD, threads=1):
+    if backend not in DUPLICATES_BACKENDS:
+        msg = 'Unknown duplicates backend: {}'.format(backend)
+        raise ValueError(msg)
+
     if out_fpath is None:
         out_fpath = in_fpath
 
@@ -119,8 +376,15 @@ def mark_duplicates(in_fpath, out_fpath=None, tmp_dir=None, metric_fpath=None,
     else:
         temp_out_fpath = out_fpath
 
-    failed = _mark_duplicates(in_fpath, temp_out_fpath, metric_fpath,
-                              stderr_fhand=stderr_fhand)
+    if backend == PICARD:
+        failed = _mark_duplicates(in_fpath, temp_out_fpath, metric_fpath,
+                                  stderr_fhand=stderr_fhand)
+    else:
+        failed = _mark_duplicates_with_samtools(in_fpath, temp_out_fpath,
+                                                metric_fpath,
+                                                stderr_fhand=stderr_fhand,
+                                                tmp_dir=tmp_dir,
+                                                threads=threads)
 
     if failed:
         msg = 'Mark duplicate process failed, for {}'
@@ -137,15 +401,191 @@ def _mark_duplicates(in_fpath, out_fpath, metric_fpath, stderr_fhand):
     cmd = ['PicardCommandLine', 'MarkDuplicates', 'VALIDATION_STRINGENCY=LENIENT',
            'M={}'.format(metric_fpath), 'INPUT={}'.format(in_fpath),
            'OUTPUT={}'.format(out_fpath)]
-    #     cmd = ['samtools', 'markdup', in_fpath, out_fpath]
     failed = False
     try:
-        subprocess.run(cmd, stderr=stderr_fhand, stdout=stderr_fhand)
+        process = subprocess.run(cmd, stderr=stderr_fhand, stdout=stderr_fhand)
+        failed = bool(process.returncode)
     except CalledProcessError:
         failed = True
     return failed
 
 
+def _mark_duplicates_with_samtools(in_fpath, out_fpath, metric_fpath,
+                                   stderr_fhand, tmp_dir=None, threads=1):
+    'It runs samtools collate | fixmate | sort | markdup on a bam file'
+    collate = collate_process(in_fpath, stderr_fhand=stderr_fhand,
+                              tmp_dir=tmp_dir, threads=threads)
+    fixmate = fixmate_process(collate.stdout, stderr_fhand=stderr_fhand,
+                              threads=threads)
+    collate.stdout.close()
+    sort, _ = start_sort(fixmate.stdout, stderr_fhand=stderr_fhand,
+                         threads=threads, tempdir=tmp_dir)
+    fixmate.stdout.close()
+    markdup = markdup_process(sort.stdout, out_fpath,
+                              metric_fpath=metric_fpath,
+                              stderr_fhand=stderr_fhand, tmp_dir=tmp_dir,
+                              threads=threads)
+    sort.stdout.close()
+    processes = [('collate', collate), ('fixmate', fixmate), ('sort', sort),
+                 ('markdup', markdup)]
+    return wait_processes(processes) is not None
+
+
+def collate_process(in_fpath, stderr_fhand=None, tmp_dir=None, threads=1):
+    """It starts a samtools collate process that groups the reads by name.
+
+    It writes an uncompressed bam in its stdout
+    """
+    cmd = ['samtools', 'collate', '-u', '-O', '-@', str(threads)]
+    if tmp_dir is not None:
+        cmd.extend(['-T', os.path.join(str(tmp_dir), 'collate')])
+    cmd.append(str(in_fpath))
+    return Popen(cmd, stdout=PIPE, stderr=stderr_fhand)
+
+
+def fixmate_process(in_stream, stderr_fhand=None, threads=1):
+    """It starts a samtools fixmate process that adds the mate score tags
+    required by samtools markdup.
+
+    The input has to be grouped by read name, as the bwa output is.
+    It writes an uncompressed bam in its stdout
+    """
+    return Popen(fixmate_cmd(threads), stdin=in_stream, stdout=PIPE,
+                 stderr=stderr_fhand)
+
+
+def fixmate_cmd(threads=1):
+    return ['samtools', 'fixmate', '-m', '-u', '-@', str(threads), '-', '-']
+
+
+def markdup_process(in_stream, out_fpath=None, metric_fpath=None,
+                    stderr_fhand=None, tmp_dir=None, threads=1,
+                    reference_fpath=None, index_fpath=None):
+    """It starts a samtools markdup process reading a coordinate sorted bam
+    with the fixmate tags from in_stream.
+
+    If out_fpath is None it writes an uncompressed bam in its stdout, with a
+    reference_fpath the out_fpath is written as a cram and with an
+    index_fpath it is indexed while it is written.
+    """
+    cmd = markdup_cmd(out_fpath, metric_fpath=metric_fpath, tmp_dir=tmp_dir,
+                      threads=threads, reference_fpath=reference_fpath,
+                      index_fpath=index_fpath)
+    stdout = PIPE if out_fpath is None else None
+    return Popen(cmd, stdin=in_stream, stdout=stdout, stderr=stderr_fhand)
+
+
+def markdup_cmd(out_fpath=None, metric_fpath=None, tmp_dir=None, threads=1,
+                in_fpath='-', reference_fpath=None, index_fpath=None):
+    'It returns the samtools markdup command, by default it reads stdin'
+    cmd = ['samtools', 'markdup', '-@', str(threads)]
+    if metric_fpath is not None:
+        cmd.extend(['-f', str(metric_fpath)])
+    if tmp_dir is not None:
+        cmd.extend(['-T', os.path.join(str(tmp_dir), 'markdup')])
+    if out_fpath is None:
+        cmd.extend(['-u', str(in_fpath), '-'])
+    else:
+        if reference_fpath is not None:
+            cmd.extend(cram_output_params(reference_fpath))
+        if index_fpath is not None:
+            cmd.append('--write-index')
+        cmd.extend([str(in_fpath), indexed_output(out_fpath, index_fpath)])
+    return cmd
+
+
+def parse_duplicates_metrics(fpath):
+    """It reads a Picard or a samtools markdup metrics file.
+
+    The counts are returned in reads, not in pairs, so both backends can be
+    compared.
+    """
+    with open(str(fpath)) as fhand:
+        content = fhand.read()
+    if 'DuplicationMetrics' in content:
+        return _parse_picard_duplicates_metrics(content)
+    return _parse_samtools_duplicates_metrics(content)
+
+
+def _parse_picard_duplicates_metrics(content):
+    lines = content.splitlines()
+    for line_idx, line in enumerate(lines):
+        if line.startswith('## METRICS CLASS'):
+            break
+    else:
+        raise ValueError('Picard metrics section not found')
+    fields = lines[line_idx + 1].split('\t')
+    examined, duplicates, optical = 0, 0, 0
+    for line in lines[line_idx + 2:]:
+        if not line.strip():
+            break
+        values = dict(zip(fields, line.split('\t')))
+        examined += (int(values['UNPAIRED_READS_EXAMINED']) +
+                     2 * int(values['READ_PAIRS_EXAMINED']))
+        duplicates += (int(values['UNPAIRED_READ_DUPLICATES']) +
+                       2 * int(values['READ_PAIR_DUPLICATES']))
+        optical += 2 * int(values['READ_PAIR_OPTICAL_DUPLICATES'])
+    return _build_duplicates_metrics(PICARD, examined, duplicates, optical)
+
+
+def _parse_samtools_duplicates_metrics(content):
+    values = {}
+    for line in content.splitlines():
+        if ':' not in line or line.startswith('COMMAND'):
+            continue
+        key, value = line.split(':', 1)
+        values[key.strip()] = value.strip()
+    examined = int(values['EXAMINED'])
+    duplicates = (int(values['DUPLICATE PAIR']) +
+                  int(values['DUPLICATE SINGLE']))
+    optical = (int(values['DUPLICATE PAIR OPTICAL']) +
+               int(values['DUPLICATE SINGLE OPTICAL']))
+    return _build_duplicates_metrics(SAMTOOLS, examined, duplicates, optical)
+
+
+def _build_duplicates_metrics(backend, examined, duplicates, optical):
+    rate = duplicates / examined if examined else 0
+    return {'backend': backend, 'examined_reads': examined,
+            'duplicate_reads': duplicates,
+            'optical_duplicate_reads': optical,
+            'duplication_rate': rate}
+
+
+def mark_duplicates_process(in_fpath, out_fpath=None, metric_fpath=None,
+                            stderr_fhand=None, reference_fpath=None):
+    """It starts a Picard MarkDuplicates process.
+
+    Picard reads its input twice, so it needs a file, but the output can be
+    streamed. If out_fpath is None it writes an uncompressed bam in its stdout
+    """
+    cmd = mark_duplicates_cmd(in_fpath, out_fpath, metric_fpath=metric_fpath,
+                              reference_fpath=reference_fpath)
+    stdout = PIPE if out_fpath is None else stderr_fhand
+    return Popen(cmd, stdout=stdout, stderr=stderr_fhand)
+
+
+def mark_duplicates_cmd(in_fpath, out_fpath=None, metric_fpath=None,
+                        reference_fpath=None):
+    """It returns the Picard MarkDuplicates command.
+
+    Picard writes a cram if out_fpath ends with .cram, it needs the
+    reference_fpath to do it.
+    """
+    if metric_fpath is None:
+        metric_fpath = '/dev/null'
+    cmd = ['PicardCommandLine', 'MarkDuplicates',
+           'VALIDATION_STRINGENCY=LENIENT', 'M={}'.format(metric_fpath),
+           'INPUT={}'.format(in_fpath)]
+    if out_fpath is None:
+        cmd.extend(['OUTPUT=/dev/stdout', 'COMPRESSION_LEVEL=0',
+                    'QUIET=true'])
+    else:
+        cmd.append('OUTPUT={}'.format(out_fpath))
+        if reference_fpath is not None:
+            cmd.append('REFERENCE_SEQUENCE={}'.format(reference_fpath))
+    return cmd
+
+
 def filter_bam_by_flagstat(in_fpath, flag, out_fpath=None, tmp_dir=None,
                            stderr_fhand=None):
 
@@ -174,7 +614,95 @@ def _filter_bam_by_flagstat(in_fpath, out_fpath, flag, stderr_fhand):
     cmd = ['samtools', 'view', '-b', '-F', str(flag), in_fpath, '-o', out_fpath]
     failed = False
     try:
-        subprocess.run(cmd, stderr=stderr_fhand, stdout=stderr_fhand)
+        process = subprocess.run(cmd, stderr=stderr_fhand, stdout=stderr_fhand)
+        failed = bool(process.returncode)
     except CalledProcessError:
         failed = True
     return failed
+
+
+def filter_bam_by_flagstat_process(in_stream, flag, stderr_fhand=None):
+    """It starts a samtools view process that filters the reads with the flag.
+
+    It reads sam or bam from in_stream and writes an uncompressed bam in its
+    stdout
+    """
+    return Popen(filter_bam_by_flagstat_cmd(flag), stdin=in_stream,
+                 stdout=PIPE, stderr=stderr_fhand)
+
+
+def filter_bam_by_flagstat_cmd(flag):
+    return ['samtools', 'view', '-u', '-F', str(flag), '-']
+
+
+def downgrade_edges_process(in_stream, read_start_size, read_end_size,
+                            qual_to_substract=QUAL_TO_SUBSTRACT,
+                            tag_type=STRING_TAG_TYPE, stderr_fhand=None):
+    """It starts a process that downgrades the read edges of a stream.
+
+    It reads sam or bam from in_stream and writes an uncompressed bam in its
+    stdout. The reads do not need to be sorted.
+    """
+    cmd = downgrade_edges_cmd(read_start_size, read_end_size,
+                              qual_to_substract=qual_to_substract,
+                              tag_type=tag_type)
+    return Popen(cmd, stdin=in_stream, stdout=PIPE, stderr=stderr_fhand)
+
+
+def downgrade_edges_cmd(read_start_size, read_end_size,
+                        qual_to_substract=QUAL_TO_SUBSTRACT,
+                        tag_type=STRING_TAG_TYPE):
+    cmd = [sys.executable, '-m', 'dora.mapping.downgrade_filter',
+           '--read_start_size', str(read_start_size),
+           '--read_end_size', str(read_end_size),
+           '--qual_to_substract', str(qual_to_substract),
+           '--tag_type', tag_type]
+    return cmd
+
+
+def write_bam_process(out_fpath, threads=1, reference_fpath=None,
+                      index_fpath=None, stderr_fhand=None):
+    """It starts a samtools view process that compresses the bam read from
+    its stdin into out_fpath.
+
+    With a reference_fpath it writes a cram and with an index_fpath it
+    indexes the file while it is written.
+    """
+    cmd = write_bam_cmd(out_fpath, threads=threads,
+                        reference_fpath=reference_fpath,
+                        index_fpath=index_fpath)
+    return Popen(cmd, stdin=PIPE, stdout=stderr_fhand, stderr=stderr_fhand)
+
+
+def write_bam_cmd(out_fpath, threads=1, reference_fpath=None,
+                  index_fpath=None):
+    cmd = ['samtools', 'view', '-@', str(threads)]
+    if reference_fpath is None:
+        cmd.append('-b')
+    else:
+        cmd.extend(cram_output_params(reference_fpath))
+    if index_fpath is not None:
+        cmd.append('--write-index')
+    cmd.extend(['-o', indexed_output(out_fpath, index_fpath), '-'])
+    return cmd
+
+
+def merge_sorted_bams(in_fpaths, out_fpath, threads=1, stderr_fhand=None):
+    """It merges coordinate sorted bams into a sorted bam.
+
+    The read groups and program records with the same ID are combined, so
+    the shards of one sample keep a single read group in the header.
+    """
+    cmd = ['samtools', 'merge', '-f', '-c', '-p', '-@', str(threads),
+           str(out_fpath)]
+    cmd.extend(str(fpath) for fpath in in_fpaths)
+    process = subprocess.run(cmd, stdout=stderr_fhand, stderr=stderr_fhand)
+    if process.returncode:
+        msg = 'Merge process failed, for {}'
+        raise RuntimeError(msg.format(out_fpath))
+
+
+def bam_to_cram(in_fpath, out_fpath, reference_fpath, threads=1):
+    'It converts a bam to a cram with the reference used to map it'
+    view('-C', '-T', str(reference_fpath), '-@', str(threads), '-o',
+         str(out_fpath), str(in_fpath), catch_stdout=False)
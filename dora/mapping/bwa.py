@@ -1,152 +1,710 @@
+import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
 from subprocess import PIPE, Popen
-from tempfile import gettempdir, NamedTemporaryFile
+from tempfile import gettempdir, mkdtemp, NamedTemporaryFile
 
 from dora.mapping.bam import (mark_duplicates, downgrade_read_edges, index_bam,
-                              filter_bam_by_flagstat)
+                              filter_bam_by_flagstat, mark_duplicates_process,
+                              filter_bam_by_flagstat_process, fixmate_process,
+                              markdup_process, merge_sorted_bams,
+                              count_indexed_reads, downgrade_edges_process,
+                              bam_to_cram, write_bam_process, PICARD)
 from dora.mapping.utils import (get_num_threads, map_process_to_sortedbam,
-                                remove_fhand)
+                                start_sort, wait_processes,
+                                kill_processes, write_sort_stats,
+                                get_index_fpath, is_cram)
+from dora.mapping.fastq import split_fastqs, start_decompressors
+from dora.mapping.metrics import (StageMeter, build_stage_metrics,
+                                  get_fpaths_size)
+from dora.mapping.manifest import (StageManifest, fingerprint,
+                                   get_manifest_fpath, read_manifest,
+                                   INDEX_STAGE)
+from dora.mapping.cache import MappingCache, get_metrics_key, get_stage_key
+from dora.mapping.lease import (claim_lease, holds_lease, release_lease,
+                                get_lease_fpath, get_worker_id, Heartbeat,
+                                HEARTBEAT_INTERVAL, LEASE_TIMEOUT)
+from dora.mapping.progress import (BwaProgressMonitor, estimate_bwa_reads,
+                                   get_status_fpath)
+from dora.mapping.mapping_rate import (MappingRateMonitor,
+                                       LowMappingRateError,
+                                       MAPPING_RATE_READS)
+
+SUPPLEMENTARY_FLAG = '2048'
+MAPPING = 'mapping'
+FILTER_SUPPLEMENTARY = 'filter_supplementary'
+DUPLICATES = 'duplicates'
+DOWNGRADE_EDGES = 'downgrade_edges'
+CRAM = 'cram'
+READS_PER_SHARD = 10000000
+SHARD_LEASES_DIR = 'leases'
+SHARD_BWA_KEYS = ('index_fpath', 'threads', 'readgroup', 'extra_params',
+                  'paired_paths', 'unpaired_path', 'interleave_path')
 
 
 def map_mp_bwamem(conf):
+    start = time.time()
     sample = conf.get('sample')
     bwa_extra_paramas = conf.get('bwa_params', [])
     library = conf.get('library', sample)
     read_group = conf.get('read_group', library)
     read1_path = Path(conf.get('read1_fpath'))
-    read2_path = conf.get('read2_fpath', None)
-    if read2_path:
-        read2_path = Path(read2_path)
     out_path = Path(conf.get('out_fpath'))
-    bwa_index = conf.get('index')
     tempdir = conf.get('tmpdir', gettempdir())
     threads = get_num_threads(conf.get('threads', None))
-    interleave = conf.get('interleave', False)
     do_duplicates = conf.get('do_duplicates', False)
     do_downgrade_edges = conf.get('do_downgrade_edges', True)
     downgrade_edges_conf = conf.get('downgrade_edges_conf', None)
+    downgrade_workers = conf.get('downgrade_workers', threads)
+    downgrade_before_sort = conf.get('downgrade_before_sort', False)
+    # the gzipped reads are decompressed in parallel out of bwa, 0 disables it
+    decompress_threads = conf.get('decompress_threads', max(threads // 4, 1))
     do_csi_index = conf.get('do_csi_index', False)
+    # the cram is compressed against the reference of the bwa index
+    do_cram = conf.get('do_cram', False)
     log_fhand = conf.get('log_fhand', None)
     filter_supplementary = conf.get('filter_supplementary', False)
+    checkpoint = conf.get('checkpoint', False)
+    cache_dir = conf.get('cache_dir', None)
+    # dir to write the mapping progress of the samples
+    progress_dir = conf.get('progress_dir', None)
+    # the mapping is stopped if the rate of the first reads is lower
+    min_mapping_rate = conf.get('min_mapping_rate', None)
+    mapping_rate_reads = conf.get('mapping_rate_reads', MAPPING_RATE_READS)
+    shard_conf = {'workers': conf.get('shard_workers', None),
+                  'reads_per_shard': conf.get('reads_per_shard',
+                                              READS_PER_SHARD)}
+    # the checkpoints, the shards and the cache need the bams written by the
+    # stages
+    streaming = (conf.get('streaming', True) and not checkpoint and
+                 not shard_conf['workers'] and cache_dir is None)
+    duplicates_backend = conf.get('duplicates_backend', PICARD)
+    duplicates_metric_fpath = conf.get('duplicates_metric_fpath', None)
+    sort_conf = {'threads': conf.get('sort_threads', threads),
+                 'memory': conf.get('sort_memory', None),
+                 'tmpdir': conf.get('sort_tmpdir', tempdir)}
 
     if log_fhand is None:
         log_fhand = open(str(out_path.with_suffix('.stderr')), 'w')
     Path(tempdir).mkdir(exist_ok=True)
+    Path(sort_conf['tmpdir']).mkdir(exist_ok=True)
 
     if not read1_path.exists():
         msg = '{}: reads not available'.format(read_group)
         # sys.stdout.write(msg)
         return {'fail': True, 'sample': read_group, 'error_msg': msg}
 
-    if out_path.exists():
+    if checkpoint:
+        manifest = read_manifest(out_path)
+        already_mapped = (manifest is not None and
+                          manifest['stages'] and
+                          manifest['stages'][-1]['name'] == INDEX_STAGE and
+                          out_path.exists())
+    else:
+        already_mapped = out_path.exists()
+    if already_mapped:
         msg = '{} already mapped'.format(out_path)
         # sys.stdout.write(msg)
         return {'fail': True, 'sample': read_group, 'error_msg': msg}
 
-    readgroup = {'ID': read_group, 'LB': library, 'SM': sample,
-                 'PL': 'illumina'}
+    if do_cram and not is_cram(out_path):
+        msg = '{}: a cram output needs a .cram out_fpath'.format(read_group)
+        return {'fail': True, 'sample': read_group, 'error_msg': msg}
 
+    if do_duplicates and duplicates_metric_fpath is None:
+        duplicates_metric_fpath = str(out_path.with_suffix('.dup_metrics'))
 
-    bwa_conf = {'index_fpath': bwa_index, 'threads': threads,
-                'readgroup': readgroup, 'log_fhand': log_fhand}
-    if read2_path and read2_path.exists():
-        bwa_conf['paired_paths'] = [read1_path, read2_path]
-    elif interleave:
+    bwa_conf = build_bwa_conf(conf)
+    bwa_conf['log_fhand'] = log_fhand
+    progress = None
+    if progress_dir is not None:
+        Path(progress_dir).mkdir(parents=True, exist_ok=True)
+        expected_reads = estimate_bwa_reads(_get_bwa_input_fpaths(bwa_conf))
+        progress = BwaProgressMonitor(get_status_fpath(progress_dir,
+                                                       read_group),
+                                      read_group,
+                                      expected_reads=expected_reads,
+                                      log_fhand=log_fhand)
+    rate_monitor = None
+    if min_mapping_rate is not None:
+        rate_monitor = MappingRateMonitor(min_mapping_rate,
+                                          min_reads=mapping_rate_reads)
+
+    stages_conf = {'tempdir': tempdir, 'log_fhand': log_fhand,
+                   'filter_supplementary': filter_supplementary,
+                   'do_duplicates': do_duplicates,
+                   'do_downgrade_edges': do_downgrade_edges,
+                   'downgrade_edges_conf': downgrade_edges_conf,
+                   'do_csi_index': do_csi_index,
+                   'duplicates_backend': duplicates_backend,
+                   'duplicates_metric_fpath': duplicates_metric_fpath,
+                   'sort_conf': sort_conf,
+                   'decompress_threads': decompress_threads,
+                   'progress': progress,
+                   'rate_monitor': rate_monitor,
+                   'reference_fpath': conf.get('index') if do_cram else None}
+    if streaming:
+        result = _map_streaming(bwa_conf, out_path, read_group,
+                                downgrade_before_sort=downgrade_before_sort,
+                                **stages_conf)
+    else:
+        cache = None
+        if cache_dir is not None:
+            cache = MappingCache(cache_dir,
+                                 max_size=conf.get('cache_size', None))
+        result = _map_in_stages(bwa_conf, out_path, read_group,
+                                checkpoint=checkpoint, shard_conf=shard_conf,
+                                downgrade_workers=downgrade_workers,
+                                cache=cache, **stages_conf)
+    result['wall_time'] = time.time() - start
+    return result
+
+
+def build_bwa_conf(conf):
+    'It returns the map_with_bwamem arguments for a sample mapping conf'
+    sample = conf.get('sample')
+    library = conf.get('library', sample)
+    read_group = conf.get('read_group', library)
+    read1_path = Path(conf.get('read1_fpath'))
+    read2_path = conf.get('read2_fpath', None)
+    readgroup = {'ID': read_group, 'LB': library, 'SM': sample,
+                 'PL': 'illumina'}
+    bwa_conf = {'index_fpath': conf.get('index'),
+                'threads': get_num_threads(conf.get('threads', None)),
+                'readgroup': readgroup}
+    if read2_path and Path(read2_path).exists():
+        bwa_conf['paired_paths'] = [read1_path, Path(read2_path)]
+    elif conf.get('interleave', False):
         bwa_conf['interleave_path'] = read1_path
     else:
         bwa_conf['unpaired_path'] = read1_path
+    return bwa_conf
+
 
+def _map_in_stages(bwa_conf, out_path, read_group, tempdir, log_fhand,
+                   filter_supplementary=False, do_duplicates=False,
+                   do_downgrade_edges=True, downgrade_edges_conf=None,
+                   do_csi_index=False, duplicates_backend=PICARD,
+                   duplicates_metric_fpath=None, sort_conf=None,
+                   checkpoint=False, shard_conf=None, downgrade_workers=1,
+                   reference_fpath=None, cache=None, decompress_threads=0,
+                   progress=None, rate_monitor=None):
+    """It maps running every stage on the bam written by the previous one.
 
-    used_fhands = []
-    final_analysis = None
+    With checkpoint the intermediate bams are kept in a directory inside
+    tempdir and every completed stage is recorded in the sample manifest, so
+    a rerun starts from the last valid intermediate bam instead of from the
+    reads.
+    If shard_conf has workers the mapping stage is done in shards.
+    The edges of the sorted bam are downgraded by contigs in
+    downgrade_workers processes.
+    With a reference_fpath the stages write bams and a last stage converts
+    the result to cram.
+    With a cache the output of every stage is stored with a key that hashes
+    the reads, the index, the read group and the parameters of the stage and
+    of the ones before it, so a stage already run with the same parameters
+    is taken from the cache, the duplicates stage with its metrics file.
+    With a progress monitor the mapping stage reports its progress, and
+    with a rate monitor it is stopped if the first reads do not map, unless
+    it is done in shards.
+    """
+    if sort_conf is None:
+        sort_conf = {}
+    if downgrade_edges_conf is None:
+        downgrade_edges_conf = {}
 
+    stages = [(MAPPING, _get_mapping_params(bwa_conf))]
+    if filter_supplementary:
+        stages.append((FILTER_SUPPLEMENTARY, {'flag': SUPPLEMENTARY_FLAG}))
+    if do_duplicates:
+        stages.append((DUPLICATES, {'backend': duplicates_backend}))
     if do_downgrade_edges:
-        final_analysis = 'downgrade_edges'
-    elif not do_downgrade_edges and do_duplicates:
-        final_analysis = 'duplicates'
-    elif not do_downgrade_edges and not do_duplicates and filter_supplementary:
-        final_analysis = 'filter_supplementary'
-    else:
-        final_analysis = 'mapping'
+        stages.append((DOWNGRADE_EDGES, downgrade_edges_conf))
+    if reference_fpath is not None:
+        stages.append((CRAM, {'reference': str(reference_fpath)}))
 
-    if final_analysis != 'mapping':
-        bam_fhand = NamedTemporaryFile(suffix='.bwa.bam', dir=tempdir)
+    if checkpoint:
+        manifest = StageManifest(get_manifest_fpath(out_path),
+                                 sample=read_group)
+        stage_dir = Path(tempdir, '{}.stages'.format(read_group))
+        stage_dir.mkdir(exist_ok=True)
     else:
-        bam_fhand = out_path.open('w')
-    bwa_process = map_with_bwamem(**bwa_conf)
-    try:
-        map_process_to_sortedbam(bwa_process, bam_fhand.name,
-                                 stderr_fhand=log_fhand,
-                                 tempdir=tempdir)
-    except RuntimeError:
-        msg = '{}: error mapping'.format(library)
-        # sys.stderr.write(msg)
-        remove_fhand(bam_fhand)
-        return {'fail': True, 'sample': read_group, 'error_msg': msg}
-    finally:
-        bwa_process.wait()
-    out_fhand = bam_fhand
+        manifest = None
+        stage_dir = Path(mkdtemp(prefix='dora_stages.', dir=tempdir))
 
-    used_fhands.append(bam_fhand)
-
-    if filter_supplementary:
-        if final_analysis != 'filter_supplementary':
-            supplememtary_fhand = NamedTemporaryFile(suffix='.supplementary.bam', dir=tempdir)
+    in_fpaths = _get_bwa_input_fpaths(bwa_conf)
+    cache_inputs = [fingerprint(fpath) for fpath in in_fpaths]
+    stage_outs = []
+    stage_metrics = {}
+    failed_stage = None
+    stage_error = None
+    for stage_index, (stage, params) in enumerate(stages):
+        if stage_index == len(stages) - 1:
+            stage_out = out_path
+        else:
+            stage_out = stage_dir.joinpath('{}.bam'.format(stage))
+        inputs = [fingerprint(fpath) for fpath in in_fpaths]
+        cache_key = get_stage_key(stage, cache_inputs, params)
+        cache_inputs = [cache_key]
+        if manifest is not None and manifest.is_done(stage, inputs, params,
+                                                     stage_out):
+            log_fhand.write('{} stage already done, skipping\n'.format(stage))
+            log_fhand.flush()
+            in_fpaths = [stage_out]
+            stage_outs.append(stage_out)
+            continue
+        if stage == DUPLICATES and duplicates_metric_fpath is not None:
+            stage_metric_fpath = duplicates_metric_fpath
         else:
-            supplememtary_fhand = out_path.open('w')
-        flag = '2048'
+            stage_metric_fpath = None
+        if cache is not None and _fetch_stage(cache, cache_key, stage_out,
+                                              stage_metric_fpath):
+            log_fhand.write('{} stage found in the cache\n'.format(stage))
+            log_fhand.flush()
+            if manifest is not None:
+                manifest.record(stage, inputs, params, stage_out)
+            in_fpaths = [stage_out]
+            stage_outs.append(stage_out)
+            continue
+
+        partial_out = stage_out.with_suffix('.partial' + stage_out.suffix)
         try:
-            filter_bam_by_flagstat(out_fhand.name, flag,
-                                   out_fpath=supplememtary_fhand.name, tmp_dir=None,
-                                   stderr_fhand=log_fhand)
-        except Exception as error:
-            print(error)
-            raise
-        out_fhand = supplememtary_fhand
-        used_fhands.append(supplememtary_fhand)
+            with StageMeter(stage, in_fpaths=in_fpaths,
+                            out_fpaths=[partial_out]) as meter:
+                meter.reads = _run_stage(
+                    stage, in_fpaths[0], partial_out, bwa_conf=bwa_conf,
+                    log_fhand=log_fhand, tempdir=tempdir, sort_conf=sort_conf,
+                    duplicates_backend=duplicates_backend,
+                    duplicates_metric_fpath=duplicates_metric_fpath,
+                    downgrade_edges_conf=downgrade_edges_conf,
+                    downgrade_workers=downgrade_workers,
+                    shard_conf=shard_conf,
+                    shard_dir=stage_dir.joinpath('shards'),
+                    reference_fpath=reference_fpath,
+                    decompress_threads=decompress_threads,
+                    progress=progress, rate_monitor=rate_monitor)
+        except RuntimeError as error:
+            stage_metrics[stage] = meter.metrics
+            if partial_out.exists():
+                partial_out.unlink()
+            failed_stage = stage
+            stage_error = error
+            break
+        stage_metrics[stage] = meter.metrics
+        os.replace(str(partial_out), str(stage_out))
+        if cache is not None:
+            if stage_metric_fpath is not None:
+                cache.put(get_metrics_key(cache_key), stage_metric_fpath,
+                          link=False)
+            cache.put(cache_key, stage_out)
+        if manifest is not None:
+            manifest.record(stage, inputs, params, stage_out)
+        in_fpaths = [stage_out]
+        stage_outs.append(stage_out)
 
+    num_reads = None
+    if failed_stage is None:
+        with StageMeter(INDEX_STAGE, in_fpaths=[out_path]) as meter:
+            index_bam(out_path, do_csi_index=do_csi_index)
+            num_reads = count_indexed_reads(out_path)
+            meter.reads = num_reads
+        stage_metrics[INDEX_STAGE] = meter.metrics
+        if manifest is not None:
+            manifest.record(INDEX_STAGE, [fingerprint(out_path)],
+                            {'csi': do_csi_index},
+                            get_index_fpath(out_path, do_csi_index))
 
-    if do_duplicates:
-        if final_analysis != 'duplicates':
-            dup_fhand = NamedTemporaryFile(suffix='.dup.bam', dir=tempdir)
+    if failed_stage is None or not checkpoint:
+        for stage_out in stage_outs:
+            if stage_out != out_path and stage_out.exists():
+                stage_out.unlink()
+        shutil.rmtree(str(stage_dir), ignore_errors=True)
+
+    if failed_stage is not None:
+        if isinstance(stage_error, LowMappingRateError):
+            msg = '{}: {}'.format(read_group, stage_error)
         else:
-            dup_fhand = out_path.open('w')
+            msg = '{}: error in {} stage'.format(read_group, failed_stage)
+        return {'fail': True, 'sample': read_group, 'error_msg': msg,
+                'stages': stage_metrics,
+                'mapping_rate': _get_mapping_rate(rate_monitor)}
+
+    log_fhand.close()
+    return {'fail': False, 'sample': read_group, 'error_msg': 'OK',
+            'stages': stage_metrics, 'reads': num_reads}
+
+
+def _fetch_stage(cache, cache_key, stage_out, metric_fpath=None):
+    'The stages that write metrics are only taken with their metrics'
+    if metric_fpath is not None and not cache.fetch(
+            get_metrics_key(cache_key), metric_fpath, link=False):
+        return False
+    return cache.fetch(cache_key, stage_out)
+
+
+def _get_bwa_input_fpaths(bwa_conf):
+    if bwa_conf.get('paired_paths'):
+        return list(bwa_conf['paired_paths'])
+    if bwa_conf.get('interleave_path'):
+        return [bwa_conf['interleave_path']]
+    return [bwa_conf['unpaired_path']]
+
+
+def _set_bwa_input_fpaths(bwa_conf, in_fpaths):
+    bwa_conf = dict(bwa_conf)
+    if bwa_conf.get('paired_paths'):
+        bwa_conf['paired_paths'] = list(in_fpaths)
+    elif bwa_conf.get('interleave_path'):
+        bwa_conf['interleave_path'] = in_fpaths[0]
+    else:
+        bwa_conf['unpaired_path'] = in_fpaths[0]
+    return bwa_conf
+
+
+def _get_mapping_params(bwa_conf):
+    index_fpath = str(bwa_conf['index_fpath']) + '.bwt'
+    if os.path.exists(index_fpath):
+        index = fingerprint(index_fpath)
+    else:
+        index = index_fpath
+    return {'index': index, 'readgroup': bwa_conf.get('readgroup'),
+            'extra_params': bwa_conf.get('extra_params')}
+
+
+def _run_stage(stage, in_fpath, out_fpath, bwa_conf, log_fhand, tempdir,
+               sort_conf, duplicates_backend, duplicates_metric_fpath,
+               downgrade_edges_conf, downgrade_workers=1, shard_conf=None,
+               shard_dir=None, reference_fpath=None, decompress_threads=0,
+               progress=None, rate_monitor=None):
+    """It runs one stage, it raises a RuntimeError if it fails.
+
+    It returns the number of reads processed if the stage knows it
+    """
+    if stage == MAPPING and shard_conf and shard_conf.get('workers'):
+        map_with_bwamem_sharded(bwa_conf, str(out_fpath), shard_dir,
+                                num_workers=shard_conf['workers'],
+                                reads_per_shard=shard_conf['reads_per_shard'],
+                                sort_conf=sort_conf, log_fhand=log_fhand)
+    elif stage == MAPPING:
+        bwa_processes = start_bwamem(bwa_conf, decompress_threads,
+                                     progress=progress)
+        bwa_process = bwa_processes[0][1]
+        sam_stream = None
+        if rate_monitor is not None:
+            sam_stream = rate_monitor.follow(bwa_process)
         try:
-            mark_duplicates(out_fhand.name, dup_fhand.name, stderr_fhand=log_fhand)
-        except RuntimeError:
-            msg = '{}: error marking duplicates\n'.format(sample)
-            # sys.stderr.write(msg)
-            remove_fhand(bam_fhand)
-            remove_fhand(dup_fhand)
-            return {'fail': True, 'sample': read_group, 'error_msg': msg}
-        out_fhand = dup_fhand
-        used_fhands.append(dup_fhand)
+            sort_stats = map_process_to_sortedbam(
+                bwa_process, str(out_fpath), stderr_fhand=log_fhand,
+                tempdir=sort_conf.get('tmpdir', tempdir),
+                threads=sort_conf.get('threads', bwa_conf.get('threads')),
+                memory=sort_conf.get('memory'), in_stream=sam_stream)
+        finally:
+            bwa_process.wait()
+            failed_process = wait_processes(bwa_processes[1:])
+            if progress is not None:
+                progress.wait()
+            if rate_monitor is not None:
+                rate_monitor.wait()
+        if rate_monitor is not None:
+            rate_monitor.check()
+        if failed_process:
+            raise RuntimeError('Error in {} process'.format(failed_process))
+        write_sort_stats(sort_stats, log_fhand)
+    elif stage == FILTER_SUPPLEMENTARY:
+        filter_bam_by_flagstat(str(in_fpath), SUPPLEMENTARY_FLAG,
+                               out_fpath=str(out_fpath),
+                               stderr_fhand=log_fhand)
+    elif stage == DUPLICATES:
+        mark_duplicates(str(in_fpath), str(out_fpath), tmp_dir=tempdir,
+                        metric_fpath=duplicates_metric_fpath,
+                        stderr_fhand=log_fhand, backend=duplicates_backend,
+                        threads=bwa_conf.get('threads', 1))
+    elif stage == DOWNGRADE_EDGES:
+        return downgrade_read_edges(str(in_fpath), str(out_fpath),
+                                    threads=bwa_conf.get('threads', 1),
+                                    workers=downgrade_workers,
+                                    tmp_dir=tempdir, **downgrade_edges_conf)
+    elif stage == CRAM:
+        bam_to_cram(str(in_fpath), str(out_fpath), reference_fpath,
+                    threads=bwa_conf.get('threads', 1))
+    return None
 
-    if do_downgrade_edges:
-        downgrade_fhand = out_path.open('w')
-        if downgrade_edges_conf is None:
-            downgrade_edges_conf = {}
-        downgrade_read_edges(out_fhand.name, downgrade_fhand.name,
-                             **downgrade_edges_conf)
 
-        out_fhand = downgrade_fhand
-        used_fhands.append(downgrade_fhand)
+def _map_streaming(bwa_conf, out_path, read_group, tempdir, log_fhand,
+                   filter_supplementary=False, do_duplicates=False,
+                   do_downgrade_edges=True, downgrade_edges_conf=None,
+                   do_csi_index=False, duplicates_backend=PICARD,
+                   duplicates_metric_fpath=None, sort_conf=None,
+                   downgrade_before_sort=False, reference_fpath=None,
+                   decompress_threads=0, progress=None, rate_monitor=None):
+    """It maps connecting all the stages with pipes.
 
-    index_bam(out_fhand.name, do_csi_index=do_csi_index)
-    log_fhand.close()
-    for fhand in used_fhands:
-        if fhand.name != out_fhand.name:
-            remove_fhand(fhand)
+    bwa -> filter supplementary -> sort -> mark duplicates -> downgrade edges
+    Only the final bam is written to disk. The only exception is the
+    Picard input, Picard reads its input twice so the sorted bam has to be
+    stored in a temporary file. With the samtools backend the bwa output,
+    already grouped by read name, goes through fixmate before the sort and
+    markdup reads the sorted stream.
+    With downgrade_before_sort the edges are downgraded by a filter process
+    between bwa, or the supplementary filter, and the sort, saving the
+    decoding and encoding of the sorted bam. The duplicates are then chosen
+    with the downgraded qualities.
+    With a reference_fpath the last stage writes a cram.
+    With a progress monitor bwa reports the reads mapped per second and the
+    time left. With a rate monitor between bwa and the next process the
+    pipeline is stopped if the first reads do not map.
+    The index is built by the samtools process that writes the final file,
+    so the final file is not read again to index it. Only the output of
+    Picard is indexed afterwards.
+    """
+    out_fpath = str(out_path)
+    threads = bwa_conf.get('threads', 1)
+    if downgrade_edges_conf is None:
+        downgrade_edges_conf = {}
+    downgrade_after_sort = do_downgrade_edges and not downgrade_before_sort
+    more_stages_after_sort = do_duplicates or downgrade_after_sort
+    use_picard = do_duplicates and duplicates_backend == PICARD
+    if sort_conf is None:
+        sort_conf = {}
+
+    processes = []
+    starts = {}
+    usages = {}
+    stage_metrics = {}
+
+    def add_process(name, process):
+        processes.append((name, process))
+        starts[name] = time.time()
+
+    sorted_fhand = None
+    sort_out_fpath = None
+    # the last stage indexes the file while it writes it
+    index_fpath = get_index_fpath(out_fpath, do_csi_index)
+    index_on_write = True
+    try:
+        bwa_processes = start_bwamem(bwa_conf, decompress_threads,
+                                     progress=progress)
+        for name, process in bwa_processes:
+            add_process(name, process)
+        stream = bwa_processes[0][1].stdout
+        if rate_monitor is not None:
+            stream = rate_monitor.follow(bwa_processes[0][1])
+
+        if filter_supplementary:
+            add_process(FILTER_SUPPLEMENTARY, filter_bam_by_flagstat_process(
+                stream, SUPPLEMENTARY_FLAG, stderr_fhand=log_fhand))
+            stream.close()
+            stream = processes[-1][1].stdout
+
+        if do_downgrade_edges and downgrade_before_sort:
+            add_process(DOWNGRADE_EDGES, downgrade_edges_process(
+                stream, stderr_fhand=log_fhand, **downgrade_edges_conf))
+            stream.close()
+            stream = processes[-1][1].stdout
+
+        if do_duplicates and not use_picard:
+            add_process('fixmate', fixmate_process(stream,
+                                                   stderr_fhand=log_fhand,
+                                                   threads=threads))
+            stream.close()
+            stream = processes[-1][1].stdout
+
+        if use_picard:
+            sorted_fhand = NamedTemporaryFile(suffix='.sorted.bam',
+                                              dir=tempdir)
+            sort_out_fpath = sorted_fhand.name
+        elif more_stages_after_sort:
+            sort_out_fpath = None
+        else:
+            sort_out_fpath = out_fpath
+        sort_reference = None
+        sort_index = None
+        if sort_out_fpath == out_fpath:
+            sort_reference = reference_fpath
+            sort_index = index_fpath
+        sort, sort_monitor = start_sort(stream, sort_out_fpath,
+                                        stderr_fhand=log_fhand,
+                                        threads=sort_conf.get('threads',
+                                                              threads),
+                                        memory=sort_conf.get('memory'),
+                                        tempdir=sort_conf.get('tmpdir',
+                                                              tempdir),
+                                        reference_fpath=sort_reference,
+                                        index_fpath=sort_index)
+        stream.close()
+        add_process('sort', sort)
+        stream = sort.stdout
+
+        dup_out_fpath = out_fpath if not downgrade_after_sort else None
+        dup_reference = reference_fpath if dup_out_fpath else None
+        dup_index = index_fpath if dup_out_fpath else None
+        if use_picard:
+            # Picard names the index that it creates as it wants
+            index_on_write = dup_out_fpath is None
+            failed_stage = wait_processes(processes, usages)
+            if failed_stage:
+                raise RuntimeError(failed_stage)
+            if rate_monitor is not None:
+                rate_monitor.check()
+            add_process(DUPLICATES, mark_duplicates_process(
+                sorted_fhand.name, dup_out_fpath,
+                metric_fpath=duplicates_metric_fpath, stderr_fhand=log_fhand,
+                reference_fpath=dup_reference))
+            stream = processes[-1][1].stdout
+        elif do_duplicates:
+            add_process(DUPLICATES, markdup_process(
+                stream, dup_out_fpath, metric_fpath=duplicates_metric_fpath,
+                stderr_fhand=log_fhand, tmp_dir=tempdir, threads=threads,
+                reference_fpath=dup_reference, index_fpath=dup_index))
+            stream.close()
+            stream = processes[-1][1].stdout
+
+        if downgrade_after_sort:
+            # samtools compresses and indexes the downgraded reads
+            add_process('write', write_bam_process(
+                out_fpath, threads=threads, reference_fpath=reference_fpath,
+                index_fpath=index_fpath, stderr_fhand=log_fhand))
+            writer = processes[-1][1]
+            try:
+                with StageMeter(DOWNGRADE_EDGES, out_fpaths=[out_fpath],
+                                children=False) as meter:
+                    meter.reads = downgrade_read_edges(
+                        stream, writer.stdin, uncompressed=True,
+                        **downgrade_edges_conf)
+            except (RuntimeError, OSError, ValueError):
+                kill_processes(processes)
+                raise RuntimeError(DOWNGRADE_EDGES)
+            finally:
+                writer.stdin.close()
+                stage_metrics[DOWNGRADE_EDGES] = meter.metrics
+
+        failed_stage = wait_processes(processes, usages)
+        if failed_stage:
+            raise RuntimeError(failed_stage)
+        if rate_monitor is not None:
+            # bwa could end before being killed
+            rate_monitor.check()
+        write_sort_stats(sort_monitor.stats, log_fhand)
+    except RuntimeError as error:
+        kill_processes(processes)
+        for fpath in (out_path, Path(index_fpath)):
+            if fpath.exists():
+                fpath.unlink()
+        if rate_monitor is not None and rate_monitor.aborted:
+            # bwa fails when it is killed
+            msg = '{}: {}'.format(read_group, rate_monitor.get_error_msg())
         else:
-            fhand.close()
+            msg = '{}: error in {} stage'.format(read_group, error)
+        return {'fail': True, 'sample': read_group, 'error_msg': msg,
+                'stages': _get_process_metrics(processes, starts, usages,
+                                               stage_metrics),
+                'mapping_rate': _get_mapping_rate(rate_monitor)}
+    finally:
+        sort_out_size = get_fpaths_size([sort_out_fpath])
+        if sorted_fhand is not None:
+            sorted_fhand.close()
+        if progress is not None:
+            progress.wait()
+        if rate_monitor is not None:
+            rate_monitor.wait()
+
+    with StageMeter(INDEX_STAGE, in_fpaths=[out_fpath]) as meter:
+        if not index_on_write:
+            index_bam(out_fpath, do_csi_index=do_csi_index)
+        num_reads = count_indexed_reads(out_fpath)
+        meter.reads = num_reads
+    stage_metrics = _get_process_metrics(processes, starts, usages,
+                                         stage_metrics)
+    stage_metrics['bwa']['bytes_in'] = get_fpaths_size(
+        _get_bwa_input_fpaths(bwa_conf))
+    stage_metrics['sort']['bytes_out'] = sort_out_size
+    last_stage = list(stage_metrics)[-1]
+    stage_metrics[last_stage]['bytes_out'] = get_fpaths_size([out_fpath])
+    stage_metrics[INDEX_STAGE] = meter.metrics
+    log_fhand.close()
+    return {'fail': False, 'sample': read_group, 'error_msg': 'OK',
+            'stages': stage_metrics, 'reads': num_reads}
+
+
+def _get_mapping_rate(rate_monitor):
+    if rate_monitor is None:
+        return None
+    return rate_monitor.mapping_rate
+
 
-    return {'fail': False, 'sample': read_group, 'error_msg': 'OK'}
+def _get_process_metrics(processes, starts, usages, stage_metrics):
+    'It builds the stage metrics of the piped processes'
+    metrics = {}
+    for name, _ in processes:
+        usage = usages.get(name)
+        if usage is None:
+            metrics[name] = build_stage_metrics(wall_time=None)
+            continue
+        metrics[name] = build_stage_metrics(
+            wall_time=usage['end_time'] - starts[name],
+            cpu_time=usage['cpu_time'], max_rss=usage['max_rss'])
+    metrics.update(stage_metrics)
+    return metrics
 
 
 def map_with_bwamem(index_fpath, unpaired_path=None, paired_paths=None,
                     interleave_path=None, threads=None, log_fhand=None,
-                    extra_params=None, readgroup=None):
+                    extra_params=None, readgroup=None, pass_fds=()):
     'It maps with bwa mem algorithm'
+    cmd = bwa_mem_cmd(index_fpath, unpaired_path=unpaired_path,
+                      paired_paths=paired_paths,
+                      interleave_path=interleave_path, threads=threads,
+                      extra_params=extra_params, readgroup=readgroup)
+    bwa = Popen(cmd, stderr=log_fhand, stdout=PIPE, pass_fds=pass_fds)
+    return bwa
+
+
+def start_bwamem(bwa_conf, decompress_threads=0, progress=None):
+    """It starts bwa mem, with decompress_threads the gzipped reads are
+    decompressed by parallel decompressors that feed bwa through pipes.
+
+    bwa decompresses the reads in its input thread, so the decompression
+    limits the mapping speed when bwa has many threads.
+    With a progress monitor the bwa stderr goes through it to the log.
+    It returns the processes as (name, process) tuples, bwa the first one.
+    """
+    log_fhand = bwa_conf.get('log_fhand')
+    if progress is not None:
+        bwa_conf = dict(bwa_conf, log_fhand=PIPE)
+    if not decompress_threads:
+        bwa = map_with_bwamem(**bwa_conf)
+        if progress is not None:
+            progress.follow(bwa.stderr)
+        return [('bwa', bwa)]
+    in_paths, pipe_fds, decompressors = start_decompressors(
+        _get_bwa_input_fpaths(bwa_conf), threads=decompress_threads,
+        stderr_fhand=log_fhand)
+    try:
+        bwa = map_with_bwamem(pass_fds=pipe_fds,
+                              **_set_bwa_input_fpaths(bwa_conf, in_paths))
+    except OSError:
+        kill_processes([(None, process) for process in decompressors])
+        raise
+    finally:
+        for fd in pipe_fds:
+            os.close(fd)
+    if progress is not None:
+        progress.follow(bwa.stderr)
+    processes = [('bwa', bwa)]
+    for index, process in enumerate(decompressors):
+        processes.append(('decompress{}'.format(index + 1), process))
+    return processes
+
+
+def bwa_mem_cmd(index_fpath, unpaired_path=None, paired_paths=None,
+                interleave_path=None, threads=None, extra_params=None,
+                readgroup=None):
+    'It returns the bwa mem command'
     interleave = False
     num_called_fpaths = 0
     in_paths = []
@@ -184,6 +742,179 @@ def map_with_bwamem(index_fpath, unpaired_path=None, paired_paths=None,
     cmd = [binary, 'mem', '-t', str(get_num_threads(threads)), index_fpath]
     cmd.extend(extra_params)
     cmd.extend(map(str, in_paths))
-    #     print(' '.join(cmd))
-    bwa = Popen(cmd, stderr=log_fhand, stdout=PIPE)
-    return bwa
+    return cmd
+
+
+def prepare_shards(bwa_conf, shard_dir, reads_per_shard=READS_PER_SHARD,
+                   sort_conf=None, compresslevel=1):
+    """It splits the reads of a sample in shards and writes a json conf for
+    every shard in shard_dir.
+
+    The shard confs only have paths, so they can be mapped by workers in any
+    node that shares the filesystem. It returns the shard conf paths.
+    """
+    shard_dir = Path(shard_dir)
+    if sort_conf is None:
+        sort_conf = {}
+    in_fpaths = _get_bwa_input_fpaths(bwa_conf)
+    interleaved = bool(bwa_conf.get('interleave_path'))
+    chunks = split_fastqs(in_fpaths, shard_dir.joinpath('reads'),
+                          reads_per_shard, interleaved=interleaved,
+                          compresslevel=compresslevel)
+    shard_conf_fpaths = []
+    for shard_index, chunk_fpaths in enumerate(chunks):
+        name = 'shard{:05d}'.format(shard_index)
+        shard_conf = {'name': name,
+                      'index_fpath': str(bwa_conf['index_fpath']),
+                      'threads': bwa_conf.get('threads', 1),
+                      'readgroup': bwa_conf.get('readgroup'),
+                      'extra_params': bwa_conf.get('extra_params'),
+                      'out_fpath': str(shard_dir.joinpath(name + '.bam')),
+                      'log_fpath': str(shard_dir.joinpath(name + '.stderr')),
+                      'sort': {'threads': sort_conf.get('threads', 1),
+                               'memory': sort_conf.get('memory'),
+                               'tmpdir': str(sort_conf.get('tmpdir',
+                                                           shard_dir))}}
+        chunk_fpaths = [str(fpath) for fpath in chunk_fpaths]
+        if len(chunk_fpaths) == 2:
+            shard_conf['paired_paths'] = chunk_fpaths
+        elif interleaved:
+            shard_conf['interleave_path'] = chunk_fpaths[0]
+        else:
+            shard_conf['unpaired_path'] = chunk_fpaths[0]
+        shard_conf_fpath = shard_dir.joinpath(name + '.json')
+        with shard_conf_fpath.open('w') as fhand:
+            json.dump(shard_conf, fhand, indent=2)
+        shard_conf_fpaths.append(str(shard_conf_fpath))
+    return shard_conf_fpaths
+
+
+def map_shard(shard_conf_fpath, lease_timeout=LEASE_TIMEOUT,
+              heartbeat_interval=HEARTBEAT_INTERVAL):
+    """It maps one shard with bwa and sorts it.
+
+    The shard is claimed with a lease, so several workers, in any node, can
+    go through the same shard list. The lease is renewed by a heartbeat
+    while the shard is mapped and, if its worker dies, the shard is claimed
+    again once the lease is older than lease_timeout seconds. A .done file
+    is written once it is mapped.
+    The result of a shard mapped by another worker has claimed True.
+    """
+    with open(str(shard_conf_fpath)) as fhand:
+        shard_conf = json.load(fhand)
+    name = shard_conf['name']
+    out_fpath = shard_conf['out_fpath']
+    done_path = Path(out_fpath + '.done')
+    lease_dir = Path(out_fpath).parent.joinpath(SHARD_LEASES_DIR)
+    if done_path.exists():
+        return {'fail': False, 'sample': name, 'error_msg': 'OK'}
+    lease_dir.mkdir(exist_ok=True)
+    worker_id = '{}.{}'.format(get_worker_id(), threading.get_ident())
+    generation = claim_lease(lease_dir, name, worker_id,
+                             lease_dir.joinpath('.clock.' + worker_id),
+                             lease_timeout=lease_timeout)
+    if generation is None:
+        msg = 'claimed by another worker'
+        return {'fail': False, 'claimed': True, 'sample': name,
+                'error_msg': msg}
+    heartbeat = Heartbeat(get_lease_fpath(lease_dir, name, generation),
+                          interval=heartbeat_interval)
+    heartbeat.start()
+
+    # a worker whose lease has expired could still be writing its bam
+    partial_fpath = '{}.{}.partial.bam'.format(out_fpath[:-len('.bam')],
+                                               generation)
+    sort_conf = shard_conf['sort']
+    bwa_conf = {key: shard_conf[key] for key in SHARD_BWA_KEYS
+                if shard_conf.get(key) is not None}
+    if 'extra_params' in bwa_conf:
+        bwa_conf['extra_params'] = list(bwa_conf['extra_params'])
+    try:
+        with open(shard_conf['log_fpath'], 'w') as log_fhand:
+            bwa_process = map_with_bwamem(log_fhand=log_fhand, **bwa_conf)
+            try:
+                map_process_to_sortedbam(bwa_process, partial_fpath,
+                                         stderr_fhand=log_fhand,
+                                         tempdir=sort_conf['tmpdir'],
+                                         threads=sort_conf['threads'],
+                                         memory=sort_conf['memory'])
+            finally:
+                bwa_process.wait()
+    except (RuntimeError, OSError):
+        heartbeat.stop()
+        if os.path.exists(partial_fpath):
+            os.remove(partial_fpath)
+        release_lease(lease_dir, name, generation)
+        msg = '{}: error mapping'.format(name)
+        return {'fail': True, 'sample': name, 'error_msg': msg}
+    heartbeat.stop()
+    if not holds_lease(lease_dir, name, generation):
+        os.remove(partial_fpath)
+        msg = 'claimed again by another worker'
+        return {'fail': False, 'claimed': True, 'sample': name,
+                'error_msg': msg}
+    os.replace(partial_fpath, out_fpath)
+    done_path.touch()
+    return {'fail': False, 'sample': name, 'error_msg': 'OK'}
+
+
+def map_shards(shard_conf_fpaths, num_workers, lease_timeout=LEASE_TIMEOUT,
+               heartbeat_interval=HEARTBEAT_INTERVAL):
+    """It maps the shards in parallel.
+
+    The workers are threads, every shard runs in its own bwa and samtools
+    processes, so this can also run inside a multiprocessing pool worker.
+    """
+    map_ = partial(map_shard, lease_timeout=lease_timeout,
+                   heartbeat_interval=heartbeat_interval)
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        return list(executor.map(map_, shard_conf_fpaths))
+
+
+def merge_shards(shard_conf_fpaths, out_fpath, threads=1, stderr_fhand=None):
+    'It merges the sorted bams of all the shards once they are mapped'
+    shard_bams = []
+    for shard_conf_fpath in shard_conf_fpaths:
+        with open(str(shard_conf_fpath)) as fhand:
+            shard_bam = json.load(fhand)['out_fpath']
+        if not os.path.exists(shard_bam + '.done'):
+            raise RuntimeError('Shard not mapped: {}'.format(shard_bam))
+        shard_bams.append(shard_bam)
+    merge_sorted_bams(shard_bams, out_fpath, threads=threads,
+                      stderr_fhand=stderr_fhand)
+
+
+def map_with_bwamem_sharded(bwa_conf, out_fpath, shard_dir, num_workers,
+                            reads_per_shard=READS_PER_SHARD, sort_conf=None,
+                            log_fhand=None):
+    """It maps a sample splitting its reads in shards that are mapped and
+    sorted in parallel and merged afterwards.
+
+    The threads and the sort memory are shared among the workers.
+    """
+    if sort_conf is None:
+        sort_conf = {}
+    threads = get_num_threads(bwa_conf.get('threads'))
+    shard_bwa_conf = dict(bwa_conf)
+    shard_bwa_conf['threads'] = max(1, threads // num_workers)
+    shard_sort_conf = dict(sort_conf)
+    shard_sort_conf['threads'] = max(1, get_num_threads(
+        sort_conf.get('threads', threads)) // num_workers)
+    if sort_conf.get('memory'):
+        shard_sort_conf['memory'] = sort_conf['memory'] // num_workers
+
+    shard_dir = Path(shard_dir)
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    try:
+        shard_conf_fpaths = prepare_shards(shard_bwa_conf, shard_dir,
+                                           reads_per_shard=reads_per_shard,
+                                           sort_conf=shard_sort_conf)
+        results = map_shards(shard_conf_fpaths, num_workers)
+        failed = [result['sample'] for result in results
+                  if result['fail'] or result.get('claimed')]
+        if failed:
+            raise RuntimeError('Shards failed: {}'.format(', '.join(failed)))
+        merge_shards(shard_conf_fpaths, out_fpath, threads=threads,
+                     stderr_fhand=log_fhand)
+    finally:
+        shutil.rmtree(str(shard_dir), ignore_errors=True)
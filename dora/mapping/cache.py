@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+
+from dora.mapping.utils import MB
+
+TMP_SUFFIX = '.tmp'
+METRICS_SUFFIX = '.metrics'
+
+
+def get_stage_key(stage, inputs, params):
+    """It hashes a stage with its inputs and its parameters.
+
+    The inputs are the fingerprints of the reads for the first stage and
+    the key of the previous stage for the rest, so a stage key identifies
+    all the stages that produced its output.
+    """
+    content = json.dumps([stage, inputs, params], default=str,
+                         sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def get_metrics_key(key):
+    'The key of the metrics file written by a stage'
+    return key + METRICS_SUFFIX
+
+
+def _link_or_copy(in_fpath, out_fpath, link=True):
+    if link:
+        try:
+            os.link(str(in_fpath), str(out_fpath))
+            return
+        except OSError:
+            pass
+    shutil.copyfile(str(in_fpath), str(out_fpath))
+
+
+def _touch(fpath):
+    'It sets the access time to now keeping the modification time'
+    try:
+        stat = os.stat(str(fpath))
+        os.utime(str(fpath), ns=(int(time.time() * 1e9), stat.st_mtime_ns))
+    except FileNotFoundError:
+        pass
+
+
+class MappingCache:
+    """It stores the stage outputs by their stage key.
+
+    The files are hard linked in and out of the cache when they are in the
+    same filesystem, unless they are written in place, like the metrics
+    files, that are copied. When the files only in the cache take more than
+    max_size megabytes the least recently used ones are removed, the ones
+    also linked outside the cache are not counted because removing them
+    would not free any space. The last use is kept in the access time, so
+    the modification time, used by the fingerprints, does not change.
+    """
+
+    def __init__(self, cache_dir, max_size=None):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+
+    def _get_fpath(self, key):
+        return self.cache_dir.joinpath(key)
+
+    def fetch(self, key, out_fpath, link=True):
+        'It writes the file cached with the key, it returns False if missing'
+        fpath = self._get_fpath(key)
+        tmp_fpath = Path(str(out_fpath) + TMP_SUFFIX)
+        try:
+            _link_or_copy(fpath, tmp_fpath, link=link)
+        except FileNotFoundError:
+            return False
+        os.replace(str(tmp_fpath), str(out_fpath))
+        _touch(fpath)
+        return True
+
+    def put(self, key, fpath, link=True):
+        'It stores the file with the key and evicts the old files'
+        tmp_fpath = self._get_fpath('{}.{}{}'.format(key, os.getpid(),
+                                                     TMP_SUFFIX))
+        _link_or_copy(fpath, tmp_fpath, link=link)
+        os.replace(str(tmp_fpath), str(self._get_fpath(key)))
+        _touch(self._get_fpath(key))
+        self.evict()
+
+    def get_entries(self):
+        """It returns the cached files, the least recently used first.
+
+        The size of every file is the space that removing it would free,
+        zero for the files also linked outside the cache.
+        """
+        entries = []
+        for fpath in self.cache_dir.iterdir():
+            if fpath.name.endswith(TMP_SUFFIX):
+                continue
+            try:
+                stat = fpath.stat()
+            except FileNotFoundError:
+                continue
+            size = stat.st_size if stat.st_nlink == 1 else 0
+            entries.append((stat.st_atime_ns, size, fpath))
+        entries.sort()
+        return [(fpath, size) for _, size, fpath in entries]
+
+    def evict(self):
+        'It removes the least recently used files until the cache fits'
+        if self.max_size is None:
+            return
+        entries = self.get_entries()
+        size = sum(size for _, size in entries)
+        for fpath, fsize in entries:
+            if size <= self.max_size * MB:
+                break
+            if not fsize:
+                continue
+            try:
+                fpath.unlink()
+            except FileNotFoundError:
+                pass
+            size -= fsize
@@ -0,0 +1,43 @@
+"""It downgrades the read edges of the sam or bam read from stdin.
+
+The reads are written to stdout as an uncompressed bam, so it can be used
+as a filter between the mapper and the sort.
+"""
+import argparse
+import sys
+
+from dora.mapping.bam import (downgrade_read_edges, QUAL_TO_SUBSTRACT,
+                              EDGE_TAG_TYPES, STRING_TAG_TYPE)
+
+
+def _setup_argparse():
+    'It returns the argument parser'
+    description = 'Downgrade the read edges of a sam/bam stream'
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--read_start_size', type=int, required=True,
+                        help='Bases to downgrade at the read start')
+    parser.add_argument('--read_end_size', type=int, required=True,
+                        help='Bases to downgrade at the read end')
+    parser.add_argument('--qual_to_substract', type=int,
+                        default=QUAL_TO_SUBSTRACT,
+                        help='Quality to substract to the edges')
+    parser.add_argument('--tag_type', default=STRING_TAG_TYPE,
+                        choices=EDGE_TAG_TYPES,
+                        help='Type of the tags with the original qualities')
+    return parser
+
+
+def main():
+    args = _setup_argparse().parse_args()
+    try:
+        downgrade_read_edges('-', '-', args.read_start_size,
+                             args.read_end_size,
+                             qual_to_substract=args.qual_to_substract,
+                             tag_type=args.tag_type, uncompressed=True)
+    except RuntimeError as error:
+        sys.stderr.write(str(error))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+import gzip
+import os
+import shutil
+import zlib
+from itertools import islice
+from pathlib import Path
+from subprocess import Popen
+
+GZIP_MAGIC = b'\x1f\x8b'
+GZIP_FEXTRA = 4
+BGZF_SUBFIELD = b'BC'
+LINES_PER_READ = 4
+SPLIT_BLOCK_READS = 100000
+ESTIMATE_SAMPLE_READS = 100000
+ESTIMATE_CHUNK_SIZE = 64 * 1024
+GZIP_WBITS = zlib.MAX_WBITS | 16
+
+
+def is_gzipped(fpath):
+    with open(str(fpath), 'rb') as fhand:
+        return fhand.read(2) == GZIP_MAGIC
+
+
+def is_bgzf(fpath):
+    'A bgzf file is a gzip file with the BC extra field in its blocks'
+    with open(str(fpath), 'rb') as fhand:
+        header = fhand.read(14)
+    return (len(header) == 14 and header[:2] == GZIP_MAGIC and
+            bool(header[3] & GZIP_FEXTRA) and header[12:14] == BGZF_SUBFIELD)
+
+
+def decompress_cmd(fpath, threads=1):
+    """It returns the command that decompresses a gzipped file in parallel
+    to its stdout.
+
+    The bgzf blocks are decompressed in parallel by bgzip, pigz decompresses
+    any gzip file in a thread helped by other threads that read, write and
+    check the data. It returns None if the file is not gzipped or there is
+    no parallel decompressor installed.
+    """
+    if not is_gzipped(fpath):
+        return None
+    if is_bgzf(fpath) and shutil.which('bgzip'):
+        return ['bgzip', '-d', '-c', '-@', str(threads), str(fpath)]
+    if shutil.which('pigz'):
+        return ['pigz', '-d', '-c', '-p', str(threads), str(fpath)]
+    return None
+
+
+def start_decompressors(fpaths, threads=1, stderr_fhand=None):
+    """It starts a parallel decompressor for every gzipped fastq.
+
+    Every decompressor writes to a pipe that the reader gets as a
+    /dev/fd path, as the bash process substitution does. The reader has to
+    be started with the pipe_fds in its pass_fds and they have to be closed
+    afterwards.
+    It returns the paths to read, the pipe_fds and the decompressors. The
+    files that are not decompressed here are given with their own paths.
+    """
+    in_paths = []
+    pipe_fds = []
+    processes = []
+    try:
+        for fpath in fpaths:
+            cmd = decompress_cmd(fpath, threads=threads)
+            if cmd is None:
+                in_paths.append(fpath)
+                continue
+            read_fd, write_fd = os.pipe()
+            pipe_fds.append(read_fd)
+            try:
+                processes.append(Popen(cmd, stdout=write_fd,
+                                       stderr=stderr_fhand))
+            finally:
+                os.close(write_fd)
+            in_paths.append('/dev/fd/{}'.format(read_fd))
+    except OSError:
+        for process in processes:
+            process.kill()
+            process.wait()
+        for fd in pipe_fds:
+            os.close(fd)
+        raise
+    return in_paths, pipe_fds, processes
+
+
+def open_fastq(fpath, mode='rt', compresslevel=1):
+    'It opens plain or gzipped fastq files'
+    if 'r' in mode:
+        gzipped = is_gzipped(fpath)
+    else:
+        gzipped = str(fpath).endswith('.gz')
+    if gzipped:
+        if 'r' in mode:
+            return gzip.open(str(fpath), mode)
+        return gzip.open(str(fpath), mode, compresslevel=compresslevel)
+    return open(str(fpath), mode)
+
+
+def estimate_num_reads(fpath, sample_reads=ESTIMATE_SAMPLE_READS):
+    """It estimates the reads of a fastq from the bytes used by its first
+    sample_reads reads.
+
+    For gzipped files the bytes are the compressed ones, so the estimate
+    includes the compression ratio. If the file has less reads than the
+    sample it returns their exact number.
+    """
+    size = os.path.getsize(str(fpath))
+    gzipped = is_gzipped(fpath)
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    num_lines = 0
+    used_bytes = 0
+    with open(str(fpath), 'rb') as fhand:
+        while num_lines < sample_reads * LINES_PER_READ:
+            chunk = fhand.read(ESTIMATE_CHUNK_SIZE)
+            if not chunk:
+                return num_lines // LINES_PER_READ
+            used_bytes += len(chunk)
+            if not gzipped:
+                num_lines += chunk.count(b'\n')
+                continue
+            # the bgzf files and the concatenated gzips have several members
+            while chunk:
+                num_lines += decompressor.decompress(chunk).count(b'\n')
+                if not decompressor.eof:
+                    break
+                chunk = decompressor.unused_data
+                decompressor = zlib.decompressobj(GZIP_WBITS)
+    if used_bytes >= size:
+        return num_lines // LINES_PER_READ
+    return int(num_lines / LINES_PER_READ * size / used_bytes)
+
+
+def get_read_name(title_line):
+    'It returns the read name without the pair number and comments'
+    name = title_line.split(maxsplit=1)[0][1:]
+    if name[-2:] in ('/1', '/2'):
+        name = name[:-2]
+    return name
+
+
+def split_fastqs(fpaths, out_dir, reads_per_chunk, interleaved=False,
+                 compresslevel=1):
+    """It splits the fastq files in chunks with the same reads.
+
+    All the files are split in sync, so every chunk of the first file has
+    the pairs of the same chunk in the second one. In interleaved files the
+    two reads of a pair go to the same chunk.
+    It returns a list with the chunk paths, one list per chunk with one path
+    per input file.
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    lines_per_unit = LINES_PER_READ * (2 if interleaved else 1)
+    lines_per_block = lines_per_unit * min(SPLIT_BLOCK_READS, reads_per_chunk)
+    lines_per_chunk = lines_per_unit * reads_per_chunk
+
+    in_fhands = [open_fastq(fpath) for fpath in fpaths]
+    chunks = []
+    out_fhands = None
+    lines_in_chunk = 0
+    try:
+        while True:
+            num_lines = min(lines_per_block, lines_per_chunk - lines_in_chunk)
+            blocks = [list(islice(fhand, num_lines)) for fhand in in_fhands]
+            _check_blocks_in_sync(blocks, lines_per_unit)
+            if not blocks[0]:
+                break
+            if out_fhands is None:
+                chunk_fpaths = []
+                for file_index in range(len(fpaths)):
+                    fname = 'chunk{:05d}_{}.fastq.gz'.format(len(chunks),
+                                                             file_index + 1)
+                    chunk_fpaths.append(out_dir.joinpath(fname))
+                chunks.append(chunk_fpaths)
+                out_fhands = [open_fastq(fpath, 'wt',
+                                         compresslevel=compresslevel)
+                              for fpath in chunk_fpaths]
+            for block, out_fhand in zip(blocks, out_fhands):
+                out_fhand.writelines(block)
+            lines_in_chunk += len(blocks[0])
+            if lines_in_chunk >= lines_per_chunk:
+                for out_fhand in out_fhands:
+                    out_fhand.close()
+                out_fhands = None
+                lines_in_chunk = 0
+    finally:
+        if out_fhands is not None:
+            for out_fhand in out_fhands:
+                out_fhand.close()
+        for in_fhand in in_fhands:
+            in_fhand.close()
+    return chunks
+
+
+def _check_blocks_in_sync(blocks, lines_per_unit):
+    num_lines = len(blocks[0])
+    if any(len(block) != num_lines for block in blocks):
+        raise RuntimeError('The fastq files do not have the same reads')
+    if num_lines % lines_per_unit:
+        raise RuntimeError('Truncated fastq file')
+    if not num_lines:
+        return
+    for line_index in (0, num_lines - lines_per_unit):
+        names = {get_read_name(block[line_index]) for block in blocks}
+        if len(names) > 1:
+            msg = 'The fastq files are not in sync: {}'
+            raise RuntimeError(msg.format(', '.join(sorted(names))))
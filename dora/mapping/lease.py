@@ -0,0 +1,110 @@
+import json
+import os
+import socket
+from pathlib import Path
+from threading import Event, Thread
+
+HEARTBEAT_INTERVAL = 30
+LEASE_TIMEOUT = 300
+
+
+def get_worker_id():
+    return '{}.{}'.format(socket.gethostname(), os.getpid())
+
+
+def get_leases(lease_dir, name):
+    'It returns the lease paths of a task, the current one the last'
+    leases = []
+    for fpath in Path(lease_dir).glob(name + '.*'):
+        generation = fpath.name[len(name) + 1:]
+        if generation.isdigit():
+            leases.append((int(generation), fpath))
+    return [fpath for _, fpath in sorted(leases)]
+
+
+def get_lease_fpath(lease_dir, name, generation):
+    return Path(lease_dir, '{}.{}'.format(name, generation))
+
+
+def _get_generation(lease_fpath):
+    return int(lease_fpath.name.rsplit('.', 1)[1])
+
+
+def get_fs_time(clock_fpath):
+    """It returns the current time of the shared filesystem.
+
+    The lease heartbeats are file modification times set by the filesystem,
+    so they are compared with this time instead of with the host clock,
+    that can be skewed from the one of other nodes.
+    """
+    clock_fpath = Path(clock_fpath)
+    with clock_fpath.open('w'):
+        pass
+    return clock_fpath.stat().st_mtime
+
+
+def claim_lease(lease_dir, name, worker_id, clock_fpath,
+                lease_timeout=LEASE_TIMEOUT):
+    """It claims a task if it is not leased or its lease has expired.
+
+    A lease is a file created with O_EXCL, so only one worker can create it.
+    Every claim of a task creates a lease with the next generation number,
+    so when the heartbeat of a lease is older than lease_timeout seconds its
+    task is claimed again creating the following lease.
+    It returns the generation of the lease or None.
+    """
+    leases = get_leases(lease_dir, name)
+    if leases:
+        try:
+            heartbeat = leases[-1].stat().st_mtime
+        except FileNotFoundError:
+            return None
+        if get_fs_time(clock_fpath) - heartbeat < lease_timeout:
+            return None
+        generation = _get_generation(leases[-1]) + 1
+    else:
+        generation = 0
+    lease_fpath = get_lease_fpath(lease_dir, name, generation)
+    try:
+        fd = os.open(str(lease_fpath), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return None
+    with os.fdopen(fd, 'w') as fhand:
+        json.dump({'worker': worker_id, 'host': socket.gethostname(),
+                   'pid': os.getpid()}, fhand)
+    return generation
+
+
+def holds_lease(lease_dir, name, generation):
+    'A lease is lost when the task has been claimed again'
+    leases = get_leases(lease_dir, name)
+    return bool(leases) and leases[-1] == get_lease_fpath(lease_dir, name,
+                                                          generation)
+
+
+def release_lease(lease_dir, name, generation):
+    'It removes the lease, so the task can be claimed again at once'
+    lease_fpath = get_lease_fpath(lease_dir, name, generation)
+    if lease_fpath.exists():
+        lease_fpath.unlink()
+
+
+class Heartbeat(Thread):
+    'It touches the lease file while the task is running'
+
+    def __init__(self, lease_fpath, interval=HEARTBEAT_INTERVAL):
+        super().__init__(daemon=True)
+        self.lease_fpath = lease_fpath
+        self.interval = interval
+        self._stop_event = Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                os.utime(str(self.lease_fpath))
+            except FileNotFoundError:
+                break
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
@@ -0,0 +1,95 @@
+import json
+import os
+import time
+from pathlib import Path
+
+MANIFEST_SUFFIX = '.manifest.json'
+INDEX_STAGE = 'index'
+
+
+def fingerprint(fpath):
+    'It identifies a file by its path, size and modification time'
+    stat = os.stat(str(fpath))
+    return {'path': str(Path(fpath).absolute()), 'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns}
+
+
+def get_manifest_fpath(out_fpath):
+    return Path(str(out_fpath) + MANIFEST_SUFFIX)
+
+
+def read_manifest(out_fpath):
+    'It returns the manifest of the sample mapped to out_fpath or None'
+    manifest_fpath = get_manifest_fpath(out_fpath)
+    if not manifest_fpath.exists():
+        return None
+    with manifest_fpath.open() as fhand:
+        return json.load(fhand)
+
+
+def _normalize(value):
+    return json.loads(json.dumps(value, default=str, sort_keys=True))
+
+
+class StageManifest:
+    """It records the completed stages of a sample.
+
+    Every stage is stored with the fingerprints of its inputs, its parameters
+    and the fingerprint of its output. A stage is valid if it was run with
+    the same inputs and parameters and its output has not changed since.
+    The stages are kept in the order they were run, recording a stage again
+    removes the ones that were after it.
+    """
+
+    def __init__(self, fpath, sample=None):
+        self.fpath = Path(fpath)
+        if self.fpath.exists():
+            with self.fpath.open() as fhand:
+                self._manifest = json.load(fhand)
+        else:
+            self._manifest = {'sample': sample, 'stages': []}
+
+    @property
+    def stages(self):
+        return self._manifest['stages']
+
+    @property
+    def completed_stages(self):
+        return [stage['name'] for stage in self.stages]
+
+    def is_complete(self):
+        return bool(self.stages) and self.stages[-1]['name'] == INDEX_STAGE
+
+    def _get_stage(self, name):
+        for stage in self.stages:
+            if stage['name'] == name:
+                return stage
+        return None
+
+    def is_done(self, name, inputs, params, out_fpath):
+        stage = self._get_stage(name)
+        if stage is None:
+            return False
+        if stage['inputs'] != _normalize(inputs):
+            return False
+        if stage['params'] != _normalize(params):
+            return False
+        if not os.path.exists(str(out_fpath)):
+            return False
+        return stage['output'] == _normalize(fingerprint(out_fpath))
+
+    def record(self, name, inputs, params, out_fpath):
+        stage = self._get_stage(name)
+        if stage is not None:
+            del self.stages[self.stages.index(stage):]
+        self.stages.append({'name': name, 'inputs': _normalize(inputs),
+                            'params': _normalize(params),
+                            'output': fingerprint(out_fpath),
+                            'end_time': time.time()})
+        self.save()
+
+    def save(self):
+        tmp_fpath = self.fpath.with_name(self.fpath.name + '.tmp')
+        with tmp_fpath.open('w') as fhand:
+            json.dump(self._manifest, fhand, indent=2)
+        os.replace(str(tmp_fpath), str(self.fpath))
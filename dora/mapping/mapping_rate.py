@@ -0,0 +1,96 @@
+import os
+import shutil
+from threading import Thread
+
+MAPPING_RATE_READS = 100000
+UNMAPPED_FLAG = 0x4
+NOT_PRIMARY_FLAGS = 0x100 | 0x800
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class LowMappingRateError(RuntimeError):
+    pass
+
+
+class MappingRateMonitor(Thread):
+    """It copies the sam written by bwa to a pipe counting the mapped reads.
+
+    Once min_reads primary reads have gone through, if the fraction mapped
+    is below min_rate bwa is killed and the pipe is closed, so the rest of
+    the pipeline ends without mapping the rest of the reads. Otherwise the
+    rest of the sam is copied without looking at it.
+    It starts following the process given to follow.
+    """
+
+    def __init__(self, min_rate, min_reads=MAPPING_RATE_READS):
+        super().__init__(daemon=True)
+        self.min_rate = min_rate
+        self.min_reads = min_reads
+        self.reads = 0
+        self.mapped_reads = 0
+        self.aborted = False
+        self._process = None
+        self._out_fhand = None
+
+    def follow(self, process):
+        'It returns the stream to read the sam of the process from'
+        read_fd, write_fd = os.pipe()
+        self._process = process
+        self._out_fhand = os.fdopen(write_fd, 'wb')
+        self.start()
+        return os.fdopen(read_fd, 'rb')
+
+    @property
+    def mapping_rate(self):
+        if not self.reads:
+            return None
+        return self.mapped_reads / self.reads
+
+    def _count(self, line):
+        flag = int(line.split(b'\t', 2)[1])
+        if flag & NOT_PRIMARY_FLAGS:
+            return
+        self.reads += 1
+        if not flag & UNMAPPED_FLAG:
+            self.mapped_reads += 1
+
+    def run(self):
+        in_fhand = self._process.stdout
+        try:
+            for line in in_fhand:
+                if not line.startswith(b'@'):
+                    self._count(line)
+                self._out_fhand.write(line)
+                if self.reads >= self.min_reads:
+                    break
+            if self.reads >= self.min_reads and \
+               self.mapping_rate < self.min_rate:
+                self.aborted = True
+                self._process.kill()
+            else:
+                shutil.copyfileobj(in_fhand, self._out_fhand,
+                                   COPY_CHUNK_SIZE)
+        except (BrokenPipeError, ValueError):
+            # the process reading the sam has failed
+            pass
+        finally:
+            in_fhand.close()
+            try:
+                self._out_fhand.close()
+            except BrokenPipeError:
+                pass
+
+    def wait(self):
+        'It waits until bwa ends, if it was started'
+        if self.ident is not None:
+            self.join()
+
+    def check(self):
+        'It raises a LowMappingRateError if bwa was stopped'
+        self.wait()
+        if self.aborted:
+            raise LowMappingRateError(self.get_error_msg())
+
+    def get_error_msg(self):
+        msg = 'mapping rate {:.1%} below {:.1%} in the first {} reads'
+        return msg.format(self.mapping_rate, self.min_rate, self.reads)
@@ -0,0 +1,84 @@
+import json
+import os
+import resource
+import time
+
+
+def get_fpaths_size(fpaths):
+    'It returns the size of the files or None if any of them is not a file'
+    size = 0
+    for fpath in fpaths:
+        if fpath is None or not os.path.isfile(str(fpath)):
+            return None
+        size += os.path.getsize(str(fpath))
+    return size
+
+
+def build_stage_metrics(wall_time, cpu_time=None, max_rss=None,
+                        bytes_in=None, bytes_out=None, reads=None):
+    return {'wall_time': wall_time, 'cpu_time': cpu_time, 'max_rss': max_rss,
+            'bytes_in': bytes_in, 'bytes_out': bytes_out, 'reads': reads}
+
+
+def rusage_to_usage(rusage):
+    'max_rss is given in bytes, Linux reports ru_maxrss in kilobytes'
+    return {'cpu_time': rusage.ru_utime + rusage.ru_stime,
+            'max_rss': rusage.ru_maxrss * 1024}
+
+
+class StageMeter:
+    """It measures a stage run sequentially in this process.
+
+    The cpu time is the one used by this process and, unless children is
+    False, by the children that finished during the stage. The resource
+    module only keeps the peak RSS of the largest child reaped so far, so the
+    max_rss of a stage is the largest of this process and its children up to
+    the end of the stage.
+    """
+
+    def __init__(self, name, in_fpaths=None, out_fpaths=None, children=True):
+        self.name = name
+        if children:
+            self._whos = (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)
+        else:
+            self._whos = (resource.RUSAGE_SELF,)
+        self.in_fpaths = in_fpaths if in_fpaths is not None else []
+        self.out_fpaths = out_fpaths if out_fpaths is not None else []
+        self.reads = None
+        self.metrics = None
+
+    def _get_cpu_time(self):
+        cpu_time = 0
+        for who in self._whos:
+            usage = resource.getrusage(who)
+            cpu_time += usage.ru_utime + usage.ru_stime
+        return cpu_time
+
+    def __enter__(self):
+        self._start = time.time()
+        self._start_cpu = self._get_cpu_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        max_rss = max(resource.getrusage(who).ru_maxrss
+                      for who in self._whos)
+        self.metrics = build_stage_metrics(
+            wall_time=time.time() - self._start,
+            cpu_time=self._get_cpu_time() - self._start_cpu,
+            max_rss=max_rss * 1024,
+            bytes_in=get_fpaths_size(self.in_fpaths),
+            bytes_out=get_fpaths_size(self.out_fpaths),
+            reads=self.reads)
+        return False
+
+
+def write_metrics(result, metrics_fhand, **extra):
+    'It writes the stage metrics of a sample result as a json line'
+    if 'stages' not in result:
+        return
+    line = {'sample': result['sample'], 'fail': result['fail'],
+            'wall_time': result.get('wall_time'),
+            'reads': result.get('reads'), 'stages': result['stages']}
+    line.update(extra)
+    metrics_fhand.write(json.dumps(line) + '\n')
+    metrics_fhand.flush()
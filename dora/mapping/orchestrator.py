@@ -0,0 +1,430 @@
+import asyncio
+import os
+import shutil
+import signal
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+from tempfile import gettempdir, mkdtemp
+
+from dora.mapping.bam import (downgrade_read_edges, index_bam,
+                              count_indexed_reads, downgrade_edges_cmd,
+                              filter_bam_by_flagstat_cmd, fixmate_cmd,
+                              markdup_cmd, mark_duplicates_cmd, PICARD)
+from dora.mapping.bwa import (bwa_mem_cmd, build_bwa_conf, MAPPING,
+                              DUPLICATES, DOWNGRADE_EDGES,
+                              SUPPLEMENTARY_FLAG)
+from dora.mapping.manifest import INDEX_STAGE
+from dora.mapping.metrics import (build_stage_metrics, get_fpaths_size,
+                                  write_metrics)
+from dora.mapping.utils import (sort_cmd, get_num_threads, _write_result,
+                                _get_sample_name, get_index_fpath, is_cram,
+                                MIN_THREADS_PER_SAMPLE)
+
+WAITING = 'waiting'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+STATUS_INTERVAL = 60
+
+
+def get_default_stage_limits(threads=None):
+    """It returns how many samples can be at the same time in every stage.
+
+    The external stages get enough slots to use the host threads with
+    MIN_THREADS_PER_SAMPLE threads per sample.
+    """
+    if threads is None:
+        threads = os.sysconf('SC_NPROCESSORS_ONLN')
+    samples = max(1, threads // MIN_THREADS_PER_SAMPLE)
+    return {MAPPING: samples, DUPLICATES: samples, DOWNGRADE_EDGES: samples,
+            INDEX_STAGE: samples}
+
+
+class StageTimeoutError(RuntimeError):
+    pass
+
+
+class ProjectOrchestrator:
+    """It maps the samples of a project from a single event loop.
+
+    The external programs of every sample run as asyncio subprocesses
+    connected with pipes, so no Python process is kept blocked waiting for
+    them. The Python stages, edge downgrading and indexing, run in a process
+    pool.
+    stage_limits bound the samples that can be at the same time in every
+    stage and stage_timeouts, in seconds, kill the stages that take too long.
+    A Python stage that times out can not be killed, the sample fails but
+    its worker finishes the task.
+    """
+
+    def __init__(self, stage_limits=None, stage_timeouts=None,
+                 python_workers=None, log_fhand=None, metrics_fhand=None,
+                 status_interval=STATUS_INTERVAL):
+        self.stage_limits = get_default_stage_limits()
+        if stage_limits:
+            self.stage_limits.update(stage_limits)
+        self.stage_timeouts = stage_timeouts if stage_timeouts else {}
+        self.python_workers = python_workers
+        self.log_fhand = log_fhand
+        self.metrics_fhand = metrics_fhand
+        self.status_interval = status_interval
+        self.status = {}
+        self._tasks = {}
+        self._semaphores = None
+        self._executor = None
+
+    def get_status(self):
+        'It returns the stage, the state and the start time of every sample'
+        return {sample: dict(status) for sample, status in self.status.items()}
+
+    def write_status(self, fhand):
+        now = time.time()
+        states = [status['state'] for status in self.status.values()]
+        running = ['{} ({} {:.0f}s)'.format(sample, status['stage'],
+                                            now - status['start'])
+                   for sample, status in self.status.items()
+                   if status['state'] == RUNNING]
+        msg = 'STATUS: {} waiting, {} running, {} done, {} failed'
+        msg = msg.format(states.count(WAITING), len(running),
+                         states.count(DONE),
+                         states.count(FAILED) + states.count(CANCELLED))
+        if running:
+            msg += ': ' + ', '.join(running)
+        fhand.write(msg + '\n')
+        fhand.flush()
+
+    def cancel(self, sample=None):
+        'It cancels a sample or, if no sample is given, all of them'
+        samples = [sample] if sample is not None else list(self._tasks)
+        for sample in samples:
+            task = self._tasks.get(sample)
+            if task is not None and not task.done():
+                task.cancel()
+
+    def run(self, confs):
+        'It maps the samples and returns their results'
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self.run_async(confs))
+        finally:
+            loop.close()
+
+    async def run_async(self, confs):
+        loop = asyncio.get_event_loop()
+        self._semaphores = {stage: asyncio.Semaphore(limit)
+                            for stage, limit in self.stage_limits.items()}
+        try:
+            loop.add_signal_handler(signal.SIGINT, self.cancel)
+        except (NotImplementedError, RuntimeError, ValueError):
+            pass
+        reporter = None
+        if self.log_fhand is not None and self.status_interval:
+            reporter = asyncio.ensure_future(self._report_status())
+        self._executor = ProcessPoolExecutor(max_workers=self.python_workers)
+        try:
+            for conf in confs:
+                sample = _get_sample_name(conf)
+                self.status[sample] = {'stage': None, 'state': WAITING,
+                                       'start': time.time()}
+                self._tasks[sample] = asyncio.ensure_future(
+                    self.map_sample(conf))
+            samples = {task: sample for sample, task in self._tasks.items()}
+            results = []
+            pending = set(samples)
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.cancelled():
+                        # cancelled before it started
+                        sample = samples[task]
+                        self._set_status(sample, state=CANCELLED)
+                        msg = '{}: cancelled'.format(sample)
+                        result = {'fail': True, 'sample': sample,
+                                  'error_msg': msg}
+                    else:
+                        result = task.result()
+                    self._write_result(result)
+                    results.append(result)
+        finally:
+            if reporter is not None:
+                reporter.cancel()
+            self._executor.shutdown()
+            try:
+                loop.remove_signal_handler(signal.SIGINT)
+            except (NotImplementedError, RuntimeError, ValueError):
+                pass
+        if self.log_fhand is not None:
+            self.write_status(self.log_fhand)
+        return results
+
+    def _write_result(self, result):
+        if self.log_fhand is not None:
+            _write_result(result, self.log_fhand)
+        if self.metrics_fhand is not None:
+            write_metrics(result, self.metrics_fhand)
+
+    async def _report_status(self):
+        while True:
+            await asyncio.sleep(self.status_interval)
+            self.write_status(self.log_fhand)
+
+    def _set_status(self, sample, stage=None, state=RUNNING):
+        status = self.status.setdefault(sample, {})
+        if stage is not None:
+            status['stage'] = stage
+        status['state'] = state
+        status['start'] = time.time()
+
+    async def map_sample(self, conf):
+        """It maps a sample, the result is the one given by map_mp_bwamem.
+
+        The stages are: bwa | [filter] | [downgrade] | [fixmate] | sort,
+        duplicates, downgrade edges in the sorted bam and index.
+        """
+        start = time.time()
+        sample = _get_sample_name(conf)
+        read1_path = Path(conf.get('read1_fpath'))
+        out_path = Path(conf.get('out_fpath'))
+        if not read1_path.exists():
+            self._set_status(sample, state=FAILED)
+            msg = '{}: reads not available'.format(sample)
+            return {'fail': True, 'sample': sample, 'error_msg': msg}
+        if out_path.exists():
+            self._set_status(sample, state=FAILED)
+            msg = '{} already mapped'.format(out_path)
+            return {'fail': True, 'sample': sample, 'error_msg': msg}
+        if conf.get('do_cram', False) and not is_cram(out_path):
+            self._set_status(sample, state=FAILED)
+            msg = '{}: a cram output needs a .cram out_fpath'.format(sample)
+            return {'fail': True, 'sample': sample, 'error_msg': msg}
+
+        tempdir = conf.get('tmpdir', gettempdir())
+        Path(tempdir).mkdir(exist_ok=True)
+        work_dir = Path(mkdtemp(prefix='dora_async.', dir=tempdir))
+        log_fhand = conf.get('log_fhand', None)
+        if log_fhand is None:
+            log_fhand = open(str(out_path.with_suffix('.stderr')), 'w')
+
+        stage_metrics = {}
+        stage = None
+        try:
+            for stage, run_stage in self._get_stages(conf, out_path,
+                                                     work_dir, log_fhand):
+                async with self._semaphores[stage]:
+                    self._set_status(sample, stage)
+                    stage_start = time.time()
+                    try:
+                        reads = await asyncio.wait_for(
+                            run_stage(), self.stage_timeouts.get(stage))
+                    except asyncio.TimeoutError:
+                        raise StageTimeoutError(stage)
+                    finally:
+                        stage_metrics[stage] = build_stage_metrics(
+                            wall_time=time.time() - stage_start)
+                    stage_metrics[stage]['reads'] = reads
+        except asyncio.CancelledError:
+            self._set_status(sample, state=CANCELLED)
+            msg = '{}: cancelled in {} stage'.format(sample, stage)
+            result = {'fail': True, 'sample': sample, 'error_msg': msg,
+                      'stages': stage_metrics}
+        except StageTimeoutError:
+            self._set_status(sample, state=FAILED)
+            msg = '{}: timeout in {} stage'.format(sample, stage)
+            result = {'fail': True, 'sample': sample, 'error_msg': msg,
+                      'stages': stage_metrics}
+        except (RuntimeError, OSError, ValueError):
+            self._set_status(sample, state=FAILED)
+            msg = '{}: error in {} stage'.format(sample, stage)
+            result = {'fail': True, 'sample': sample, 'error_msg': msg,
+                      'stages': stage_metrics}
+        else:
+            self._set_status(sample, state=DONE)
+            stage_metrics[INDEX_STAGE]['bytes_in'] = get_fpaths_size(
+                [out_path])
+            result = {'fail': False, 'sample': sample, 'error_msg': 'OK',
+                      'stages': stage_metrics,
+                      'reads': stage_metrics[INDEX_STAGE]['reads']}
+        finally:
+            shutil.rmtree(str(work_dir), ignore_errors=True)
+            log_fhand.close()
+        if result['fail']:
+            index_path = Path(get_index_fpath(out_path,
+                                              conf.get('do_csi_index', False)))
+            for fpath in (out_path, index_path):
+                if fpath.exists():
+                    fpath.unlink()
+        result['wall_time'] = time.time() - start
+        return result
+
+    def _get_stages(self, conf, out_path, work_dir, log_fhand):
+        'It returns the stage names with the coroutine functions to run them'
+        threads = get_num_threads(conf.get('threads', None))
+        do_duplicates = conf.get('do_duplicates', False)
+        duplicates_backend = conf.get('duplicates_backend', PICARD)
+        do_downgrade_edges = conf.get('do_downgrade_edges', True)
+        downgrade_edges_conf = conf.get('downgrade_edges_conf', None)
+        if downgrade_edges_conf is None:
+            downgrade_edges_conf = {}
+        downgrade_before_sort = conf.get('downgrade_before_sort', False)
+        downgrade_after_sort = do_downgrade_edges and not downgrade_before_sort
+        duplicates_metric_fpath = conf.get('duplicates_metric_fpath', None)
+        reference_fpath = None
+        if conf.get('do_cram', False):
+            reference_fpath = conf.get('index')
+        do_csi_index = conf.get('do_csi_index', False)
+        # samtools indexes the final file while it writes it
+        index_fpath = get_index_fpath(out_path, do_csi_index)
+        index_on_write = True
+        if do_duplicates and duplicates_metric_fpath is None:
+            duplicates_metric_fpath = str(out_path.with_suffix('.dup_metrics'))
+
+        cmds = [bwa_mem_cmd(**build_bwa_conf(conf))]
+        if conf.get('filter_supplementary', False):
+            cmds.append(filter_bam_by_flagstat_cmd(SUPPLEMENTARY_FLAG))
+        if do_downgrade_edges and downgrade_before_sort:
+            cmds.append(downgrade_edges_cmd(**downgrade_edges_conf))
+        if do_duplicates and duplicates_backend != PICARD:
+            cmds.append(fixmate_cmd(threads))
+        stages_out = work_dir.joinpath('sorted.bam')
+        if not do_duplicates and not downgrade_after_sort:
+            stages_out = out_path
+        sort_tmp_dir = mkdtemp(prefix='dora_sort.', dir=str(work_dir))
+        cmds.append(sort_cmd(stages_out, threads=conf.get('sort_threads',
+                                                          threads),
+                             memory=conf.get('sort_memory', None),
+                             tmp_prefix=os.path.join(sort_tmp_dir, 'spill'),
+                             reference_fpath=_for_final_stage(
+                                 stages_out, out_path, reference_fpath),
+                             index_fpath=_for_final_stage(
+                                 stages_out, out_path, index_fpath)))
+        stages = [(MAPPING, partial(self.run_pipeline, cmds, log_fhand))]
+
+        if do_duplicates:
+            in_fpath = stages_out
+            stages_out = work_dir.joinpath('duplicates.bam')
+            if not downgrade_after_sort:
+                stages_out = out_path
+            dup_reference = _for_final_stage(stages_out, out_path,
+                                             reference_fpath)
+            if duplicates_backend == PICARD:
+                cmd = mark_duplicates_cmd(in_fpath, stages_out,
+                                          metric_fpath=duplicates_metric_fpath,
+                                          reference_fpath=dup_reference)
+                index_on_write = False
+            else:
+                cmd = markdup_cmd(stages_out,
+                                  metric_fpath=duplicates_metric_fpath,
+                                  tmp_dir=work_dir, threads=threads,
+                                  in_fpath=in_fpath,
+                                  reference_fpath=dup_reference,
+                                  index_fpath=_for_final_stage(
+                                      stages_out, out_path, index_fpath))
+            stages.append((DUPLICATES, partial(self.run_pipeline, [cmd],
+                                               log_fhand)))
+
+        if downgrade_after_sort:
+            downgrade = partial(downgrade_read_edges, str(stages_out),
+                                str(out_path), threads=threads,
+                                tmp_dir=str(work_dir),
+                                reference_fpath=reference_fpath,
+                                **downgrade_edges_conf)
+            stages.append((DOWNGRADE_EDGES,
+                           partial(self.run_in_executor, downgrade)))
+            index_on_write = False
+
+        index = partial(_index_and_count_reads, str(out_path), do_csi_index,
+                        index_on_write)
+        stages.append((INDEX_STAGE, partial(self.run_in_executor, index)))
+        return stages
+
+    async def run_in_executor(self, func):
+        'It runs a Python stage in the process pool'
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, func)
+
+    async def run_pipeline(self, cmds, log_fhand):
+        """It runs the commands connecting the stdout of every command to the
+        stdin of the next one.
+
+        The processes are killed if the pipeline is cancelled. It raises a
+        RuntimeError if any of them fails.
+        """
+        processes = []
+        open_fds = []
+        stdin = None
+        try:
+            for index, cmd in enumerate(cmds):
+                if index == len(cmds) - 1:
+                    read_fd, write_fd = None, None
+                else:
+                    read_fd, write_fd = os.pipe()
+                    open_fds.extend([read_fd, write_fd])
+                if stdin is None:
+                    stdin = asyncio.subprocess.DEVNULL
+                process = await asyncio.create_subprocess_exec(
+                    *cmd, stdin=stdin,
+                    stdout=log_fhand if write_fd is None else write_fd,
+                    stderr=log_fhand)
+                processes.append(process)
+                # the children have their copies of the pipe ends
+                for fd in (stdin, write_fd):
+                    if fd in open_fds:
+                        os.close(fd)
+                        open_fds.remove(fd)
+                stdin = read_fd
+            returncodes = await asyncio.gather(*[process.wait()
+                                                 for process in processes])
+        except BaseException:
+            for fd in open_fds:
+                os.close(fd)
+            await _kill_processes(processes)
+            raise
+        if any(returncodes):
+            raise RuntimeError(' | '.join(cmd[0] for cmd in cmds))
+        return None
+
+
+async def _kill_processes(processes):
+    for process in processes:
+        if process.returncode is None:
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass
+    for process in processes:
+        await process.wait()
+
+
+def _for_final_stage(stage_out, out_path, value):
+    'Only the stage that writes the final file writes a cram and its index'
+    return value if stage_out == out_path else None
+
+
+def _index_and_count_reads(out_fpath, do_csi_index, index_on_write=False):
+    if not index_on_write:
+        index_bam(out_fpath, do_csi_index=do_csi_index)
+    return count_indexed_reads(out_fpath)
+
+
+def run_project_async(confs, log_fhand, stage_limits=None,
+                      stage_timeouts=None, python_workers=None,
+                      metrics_fhand=None, status_interval=STATUS_INTERVAL):
+    """It maps the samples with a ProjectOrchestrator.
+
+    It writes the result of every sample in log_fhand, like
+    run_multiprocesses, and returns the results.
+    """
+    orchestrator = ProjectOrchestrator(stage_limits=stage_limits,
+                                       stage_timeouts=stage_timeouts,
+                                       python_workers=python_workers,
+                                       log_fhand=log_fhand,
+                                       metrics_fhand=metrics_fhand,
+                                       status_interval=status_interval)
+    results = orchestrator.run(confs)
+    if any(result['fail'] for result in results):
+        log_fhand.write('ERROR: One or more mapping process hace failed\n')
+    return results
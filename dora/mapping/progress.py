@@ -0,0 +1,139 @@
+import json
+import os
+import re
+import time
+from pathlib import Path
+from threading import Thread
+
+from dora.mapping.fastq import estimate_num_reads
+
+BWA_PROCESSED_REGEX = re.compile(r'Processed (\d+) reads in')
+STATUS_SUFFIX = '.progress.json'
+MAPPING_STATE = 'mapping'
+MAPPED_STATE = 'mapped'
+# samples without progress in this time, in seconds, are shown as stuck
+STUCK_TIME = 900
+
+
+def estimate_bwa_reads(in_fpaths):
+    'bwa counts every read of the pairs, so the reads of all the files add up'
+    return sum(estimate_num_reads(fpath) for fpath in in_fpaths)
+
+
+def get_status_fpath(status_dir, sample):
+    return Path(status_dir, '{}{}'.format(sample, STATUS_SUFFIX))
+
+
+def build_progress(sample, reads, expected_reads, start, now, state):
+    'It calculates the reads per second and the remaining seconds'
+    elapsed = now - start
+    reads_per_sec = reads / elapsed if elapsed > 0 else None
+    eta = None
+    if reads_per_sec and expected_reads:
+        eta = max(expected_reads - reads, 0) / reads_per_sec
+    return {'sample': sample, 'state': state, 'reads': reads,
+            'expected_reads': expected_reads, 'reads_per_sec': reads_per_sec,
+            'eta': eta, 'start': start, 'update_time': now}
+
+
+def _write_status(status, fpath):
+    tmp_fpath = fpath.with_name('.{}.tmp'.format(fpath.name))
+    with tmp_fpath.open('w') as fhand:
+        json.dump(status, fhand)
+    os.replace(str(tmp_fpath), str(fpath))
+
+
+class BwaProgressMonitor(Thread):
+    """It follows the stderr of a bwa mem process.
+
+    The stderr is copied to the log and, every time bwa reports a processed
+    batch, the reads per second and the time left to map the expected reads
+    are written to the status file of the sample.
+    It starts following the stderr given to follow.
+    """
+
+    def __init__(self, status_fpath, sample, expected_reads=None,
+                 log_fhand=None):
+        super().__init__(daemon=True)
+        self._stderr = None
+        self._status_fpath = Path(status_fpath)
+        self._sample = sample
+        self._expected_reads = expected_reads
+        self._log_fhand = log_fhand
+        self._start = time.time()
+        self.reads = 0
+
+    def _update(self, state):
+        status = build_progress(self._sample, self.reads,
+                                self._expected_reads, self._start,
+                                time.time(), state)
+        _write_status(status, self._status_fpath)
+
+    def follow(self, stderr):
+        self._stderr = stderr
+        self._start = time.time()
+        self.start()
+
+    def wait(self):
+        'It waits until bwa ends, if it was started'
+        if self.ident is not None:
+            self.join()
+
+    def run(self):
+        self._update(MAPPING_STATE)
+        for line in self._stderr:
+            line = line.decode(errors='replace')
+            match = BWA_PROCESSED_REGEX.search(line)
+            if match:
+                self.reads += int(match.group(1))
+                self._update(MAPPING_STATE)
+            if self._log_fhand is not None:
+                self._log_fhand.write(line)
+                self._log_fhand.flush()
+        self._stderr.close()
+        self._update(MAPPED_STATE)
+
+
+def read_progress(status_dir, stuck_time=STUCK_TIME):
+    """It reads the status of all the samples.
+
+    The samples still mapping that have not reported progress in stuck_time
+    seconds are marked as stuck.
+    """
+    now = time.time()
+    statuses = []
+    for fpath in sorted(Path(status_dir).glob('*' + STATUS_SUFFIX)):
+        try:
+            with fpath.open() as fhand:
+                status = json.load(fhand)
+        except (FileNotFoundError, ValueError):
+            continue
+        status['stuck'] = (status['state'] == MAPPING_STATE and
+                           now - status['update_time'] > stuck_time)
+        statuses.append(status)
+    return statuses
+
+
+def _format_seconds(seconds):
+    if seconds is None:
+        return '-'
+    seconds = int(seconds)
+    return '{}:{:02d}:{:02d}'.format(seconds // 3600, seconds % 3600 // 60,
+                                     seconds % 60)
+
+
+def write_progress(statuses, out_fhand):
+    'It writes a line per sample with its progress'
+    for status in statuses:
+        if status['expected_reads']:
+            percent = '{:.1f}%'.format(100 * status['reads'] /
+                                       status['expected_reads'])
+        else:
+            percent = '-'
+        reads_per_sec = status['reads_per_sec']
+        reads_per_sec = '-' if reads_per_sec is None else int(reads_per_sec)
+        state = 'stuck' if status['stuck'] else status['state']
+        items = [status['sample'], state, str(status['reads']), percent,
+                 str(reads_per_sec), _format_seconds(status['eta'])]
+        out_fhand.write('\t'.join(items) + '\n')
+    out_fhand.flush()
@@ -0,0 +1,125 @@
+import os
+import subprocess
+from contextlib import contextmanager
+from pathlib import Path
+
+from dora.mapping.utils import (estimate_bwa_index_memory, get_total_memory,
+                                DEFAULT_SORT_MEMORY, MB)
+
+SHM_DIR = '/dev/shm'
+
+
+def list_shm_indexes():
+    'It returns the names and sizes of the bwa indexes loaded in memory'
+    process = subprocess.run(['bwa', 'shm', '-l'], stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL)
+    indexes = {}
+    if process.returncode:
+        return indexes
+    for line in process.stdout.decode().splitlines():
+        items = line.split('\t')
+        if len(items) == 2:
+            indexes[items[0]] = int(items[1])
+    return indexes
+
+
+def get_shm_index_name(index_fpath):
+    'bwa identifies the indexes in shared memory by their file name'
+    return Path(str(index_fpath)).name
+
+
+def get_available_memory():
+    'It returns the memory, in megabytes, available for new allocations'
+    try:
+        with open('/proc/meminfo') as fhand:
+            for line in fhand:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    return get_total_memory()
+
+
+def get_shm_free_space():
+    'It returns the free space, in megabytes, of the shared memory filesystem'
+    if not os.path.isdir(SHM_DIR):
+        return 0
+    stat = os.statvfs(SHM_DIR)
+    return stat.f_bavail * stat.f_frsize // MB
+
+
+def load_index_to_shm(index_fpath, log_fhand=None):
+    'It loads a bwa index in shared memory, it returns True if it succeeds'
+    process = subprocess.run(['bwa', 'shm', str(index_fpath)],
+                             stdout=log_fhand, stderr=log_fhand)
+    return not process.returncode
+
+
+def drop_shm_indexes(log_fhand=None):
+    'bwa can only drop all the indexes loaded in shared memory at once'
+    subprocess.run(['bwa', 'shm', '-d'], stdout=log_fhand, stderr=log_fhand)
+
+
+def _log(log_fhand, msg):
+    if log_fhand is not None:
+        log_fhand.write(msg + '\n')
+        log_fhand.flush()
+
+
+@contextmanager
+def shared_bwa_indexes(index_fpaths, memory=None, log_fhand=None):
+    """It keeps the bwa indexes in shared memory during the context.
+
+    bwa mem uses an index in shared memory instead of loading its own copy,
+    so all the samples mapped against it share one copy. An index is only
+    loaded if the memory, in megabytes, left for the samples after loading
+    it can still hold one sample and the shared memory filesystem has room
+    for it. Otherwise the samples load the index as usual.
+    It yields the indexes that are in shared memory and the memory that
+    they take. At the end the indexes are dropped if they were loaded here
+    and no other index was already in shared memory, as bwa can not drop a
+    single index.
+    """
+    if memory is None:
+        memory = get_total_memory()
+    try:
+        preloaded = list_shm_indexes()
+    except OSError:
+        _log(log_fhand, 'bwa shm not available, indexes not shared')
+        yield set(), 0
+        return
+
+    shared = set()
+    shared_memory = 0
+    loaded_here = False
+    for index_fpath in sorted(set(map(str, index_fpaths))):
+        index_memory = estimate_bwa_index_memory(index_fpath)
+        if get_shm_index_name(index_fpath) in preloaded:
+            shared.add(index_fpath)
+            shared_memory += index_memory
+            continue
+        enough_memory = (
+            shared_memory + index_memory + DEFAULT_SORT_MEMORY <= memory and
+            index_memory <= min(get_available_memory(), get_shm_free_space()))
+        if not enough_memory:
+            msg = 'Not enough memory to share the index {}, {}MB required'
+            _log(log_fhand, msg.format(index_fpath, index_memory))
+            continue
+        if load_index_to_shm(index_fpath, log_fhand=log_fhand):
+            loaded_here = True
+            shared.add(index_fpath)
+            shared_memory += index_memory
+            _log(log_fhand, 'Index {} loaded in shared memory'.format(
+                index_fpath))
+        else:
+            _log(log_fhand, 'Index {} could not be loaded in shared memory'
+                 .format(index_fpath))
+    try:
+        yield shared, shared_memory
+    finally:
+        if loaded_here and not preloaded:
+            drop_shm_indexes(log_fhand=log_fhand)
+            _log(log_fhand, 'Indexes dropped from shared memory')
+        elif loaded_here:
+            _log(log_fhand, 'Other indexes were in shared memory, run '
+                 '"bwa shm -d" to drop them all')
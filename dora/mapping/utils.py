@@ -1,9 +1,32 @@
+import heapq
 import os
-import multiprocessing as mp
+import queue
+import re
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from copy import deepcopy
-from tempfile import NamedTemporaryFile, gettempdir
-from subprocess import Popen
+from functools import partial
+from tempfile import gettempdir, mkdtemp
+from subprocess import PIPE, Popen
 from pathlib import Path
+from threading import Thread
+
+from dora.mapping.manifest import read_manifest
+from dora.mapping.metrics import rusage_to_usage, write_metrics
+
+MB = 1024 * 1024
+MIN_SORT_MEMORY_PER_THREAD = 100
+DEFAULT_SORT_MEMORY = 2048
+MIN_THREADS_PER_SAMPLE = 4
+# the threads of a sample divided by this go to sort
+SORT_THREADS_FRACTION = 4
+# bytes of compressed reads mapped per second and thread
+DEFAULT_MAPPING_RATE = 50 * 1024
+BWA_INDEX_EXTENSIONS = ('.bwt', '.sa', '.pac', '.ann', '.amb')
+CRAM_SUFFIX = '.cram'
+SORT_MERGE_REGEX = re.compile(r'merging from (\d+) files?'
+                              r'(?: and (\d+) in-memory blocks?)?')
 
 
 def get_num_threads(threads):
@@ -23,56 +46,518 @@ def get_num_threads(threads):
 
 
 def map_process_to_sortedbam(map_process, out_fpath, key='coordinate',
-                             stderr_fhand=None, tempdir=None):
-    if stderr_fhand is None:
-        stderr = NamedTemporaryFile(suffix='.stderr')
-    else:
-        stderr = stderr_fhand
+                             stderr_fhand=None, tempdir=None, threads=1,
+                             memory=None, index_fpath=None, in_stream=None):
+    """It sorts the output of the mapping process.
 
+    memory is the total memory budget for the sort in megabytes, it is
+    divided among the sort threads. The spill files are written in tempdir.
+    With an index_fpath the sort indexes the bam while writing it.
+    in_stream, if given, is read instead of the mapping process stdout.
+    It returns the sort stats: spill files created and merge time.
+    """
     if tempdir is None:
         tempdir = gettempdir()
+    if in_stream is None:
+        in_stream = map_process.stdout
 
-    cmd = ['samtools', 'sort', '-o', out_fpath]
-    sort = Popen(cmd, stdin=map_process.stdout, stderr=stderr)
-    map_process.stdout.close()
-    sort.communicate()
+    sort, monitor = start_sort(in_stream, out_fpath, key=key,
+                               stderr_fhand=stderr_fhand, threads=threads,
+                               memory=memory, tempdir=tempdir,
+                               index_fpath=index_fpath)
+    in_stream.close()
+    sort.wait()
+    stats = monitor.stats
     if map_process.returncode:
         raise RuntimeError('Error in mapping process')
 
     if sort.returncode:
         raise RuntimeError('Error in Sort process')
+    return stats
+
+
+def sort_process(in_stream, out_fpath=None, key='coordinate',
+                 stderr_fhand=None, threads=1, memory=None,
+                 tmp_prefix=None, reference_fpath=None, index_fpath=None):
+    """It starts a samtools sort process reading from the given stream.
+
+    If no out_fpath is given the sorted reads are written as an uncompressed
+    bam to the stdout of the process, so it can be piped to the next stage.
+    With a reference_fpath the out_fpath is written as a cram and with an
+    index_fpath it is indexed while it is written.
+    """
+    cmd = sort_cmd(out_fpath, key=key, threads=threads, memory=memory,
+                   tmp_prefix=tmp_prefix, reference_fpath=reference_fpath,
+                   index_fpath=index_fpath)
+    stdout = PIPE if out_fpath is None else None
+    return Popen(cmd, stdin=in_stream, stdout=stdout, stderr=stderr_fhand)
+
+
+def sort_cmd(out_fpath=None, key='coordinate', threads=1, memory=None,
+             tmp_prefix=None, reference_fpath=None, index_fpath=None):
+    """It returns the samtools sort command that reads from stdin.
+
+    memory is the total memory in megabytes, samtools uses it per thread.
+    """
+    threads = get_num_threads(threads)
+    cmd = ['samtools', 'sort', '-@', str(threads)]
+    if memory:
+        cmd.extend(['-m', '{}M'.format(max(memory // threads,
+                                           MIN_SORT_MEMORY_PER_THREAD))])
+    if tmp_prefix is not None:
+        cmd.extend(['-T', str(tmp_prefix)])
+    if key == 'queryname':
+        cmd.append('-n')
+    if out_fpath is None:
+        cmd.extend(['-u', '-o', '-'])
+    else:
+        if reference_fpath is not None:
+            cmd.extend(cram_output_params(reference_fpath))
+        if index_fpath is not None:
+            cmd.append('--write-index')
+        cmd.extend(['-o', indexed_output(out_fpath, index_fpath)])
+    cmd.append('-')
+    return cmd
+
+
+def cram_output_params(reference_fpath):
+    'It returns the samtools parameters to write a cram'
+    return ['-O', 'cram', '--reference', str(reference_fpath)]
+
+
+def indexed_output(out_fpath, index_fpath=None):
+    """It returns the output name that tells samtools, with --write-index,
+    where to write the index.
+
+    The index type is taken from the index_fpath extension.
+    """
+    if index_fpath is None:
+        return str(out_fpath)
+    return '{}##idx##{}'.format(out_fpath, index_fpath)
+
+
+def is_cram(path):
+    return str(path).endswith(CRAM_SUFFIX)
+
+
+def get_index_fpath(path, do_csi_index=False):
+    'It returns the path of the index of a bam or a cram'
+    if is_cram(path):
+        return str(path) + '.crai'
+    return str(path) + ('.csi' if do_csi_index else '.bai')
+
+
+def start_sort(in_stream, out_fpath=None, key='coordinate', stderr_fhand=None,
+               threads=1, memory=None, tempdir=None, reference_fpath=None,
+               index_fpath=None):
+    """It starts a sort process with its spill files in a private directory
+    inside tempdir and a SortMonitor that follows it.
+
+    It returns the process and the monitor
+    """
+    spill_dir = mkdtemp(prefix='dora_sort.', dir=tempdir)
+    sort = sort_process(in_stream, out_fpath, key=key, stderr_fhand=PIPE,
+                        threads=threads, memory=memory,
+                        tmp_prefix=os.path.join(spill_dir, 'spill'),
+                        reference_fpath=reference_fpath,
+                        index_fpath=index_fpath)
+    monitor = SortMonitor(sort.stderr, log_fhand=stderr_fhand,
+                          spill_dir=spill_dir)
+    monitor.start()
+    return sort, monitor
+
+
+class SortMonitor(Thread):
+    """It follows the stderr of a samtools sort process.
+
+    The stderr is copied to the log and the merge message is used to know how
+    many spill files were created and how long the merge took.
+    Once the sort is finished the spill directory is removed.
+    """
+
+    def __init__(self, stderr, log_fhand=None, spill_dir=None):
+        super().__init__(daemon=True)
+        self._stderr = stderr
+        self._log_fhand = log_fhand
+        self._spill_dir = spill_dir
+        self._spill_files = 0
+        self._in_memory_blocks = 0
+        self._merge_start = None
+        self._start = time.time()
+        self._end = None
+
+    def run(self):
+        for line in self._stderr:
+            now = time.time()
+            line = line.decode(errors='replace')
+            match = SORT_MERGE_REGEX.search(line)
+            if match:
+                self._merge_start = now
+                self._spill_files = int(match.group(1))
+                if match.group(2):
+                    self._in_memory_blocks = int(match.group(2))
+            if self._log_fhand is not None:
+                self._log_fhand.write(line)
+                self._log_fhand.flush()
+        self._end = time.time()
+        self._stderr.close()
+        if self._spill_dir is not None:
+            shutil.rmtree(self._spill_dir, ignore_errors=True)
+
+    @property
+    def stats(self):
+        self.join()
+        if self._merge_start is None:
+            merge_time = 0
+        else:
+            merge_time = self._end - self._merge_start
+        return {'spill_files': self._spill_files,
+                'in_memory_blocks': self._in_memory_blocks,
+                'merge_time': merge_time,
+                'sort_time': self._end - self._start}
+
+
+def write_sort_stats(stats, log_fhand):
+    msg = 'Sort: {} spill files, {} in memory blocks, merge took {:.1f}s of '
+    msg += '{:.1f}s\n'
+    log_fhand.write(msg.format(stats['spill_files'], stats['in_memory_blocks'],
+                               stats['merge_time'], stats['sort_time']))
+    log_fhand.flush()
+
+
+def wait_process(process):
+    """It waits for the process and returns its cpu time and peak RSS.
+
+    It returns None if the process had already been waited for.
+    """
+    if process.returncode is not None:
+        return None
+    try:
+        _, status, rusage = os.wait4(process.pid, 0)
+    except ChildProcessError:
+        process.wait()
+        return None
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    usage = rusage_to_usage(rusage)
+    usage['end_time'] = time.time()
+    return usage
+
+
+def wait_processes(processes, usages=None):
+    """It waits for all the piped processes and returns the name of the first
+    one that failed or None if all of them finished correctly.
+
+    processes is a list of (name, process) tuples ordered as in the pipe.
+    If a usages dict is given the usage of every process is stored in it.
+    """
+    failed = None
+    for name, process in processes:
+        usage = wait_process(process)
+        if usages is not None and usage is not None:
+            usages[name] = usage
+        if process.returncode and failed is None:
+            failed = name
+    return failed
+
+
+def kill_processes(processes):
+    for _, process in processes:
+        if process.poll() is None:
+            process.kill()
+    wait_processes(processes)
+
+
+def run_multiprocesses(func, confs, num_processes, log_fhand,
+                       mapping_rate=DEFAULT_MAPPING_RATE, metrics_fhand=None):
+    start = time.time()
+    some_fail = False
+    with ProcessPoolExecutor(max_workers=num_processes) as executor:
+        futures = [executor.submit(func, conf) for conf in confs]
+        for future in as_completed(futures):
+            result = future.result()
+            if _write_result(result, log_fhand):
+                some_fail = True
+            if metrics_fhand is not None:
+                write_metrics(result, metrics_fhand)
+
+    if some_fail:
+        log_fhand.write('ERROR: One or more mapping process hace failed\n')
+
+    sample_rates = [mapping_rate * get_num_threads(conf.get('threads'))
+                    for conf in confs]
+    _write_makespan(confs, num_processes, sample_rates, time.time() - start,
+                    log_fhand)
+
+
+def _write_result(result, log_fhand):
+    failed = result['fail']
+    sample = result['sample']
+    msg = result['error_msg']
+    if failed:
+        log_fhand.write('ERROR: {}, {}\n'.format(sample, msg))
+    else:
+        log_fhand.write('OK: {}\n'.format(sample))
+    log_fhand.flush()
+    return failed
+
+
+def get_total_memory():
+    'It returns the physical memory of the host in megabytes'
+    return (os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')) // MB
+
+
+def estimate_bwa_index_memory(index_fpath):
+    'It estimates the memory, in megabytes, bwa mem uses to load the index'
+    size = 0
+    for extension in BWA_INDEX_EXTENSIONS:
+        path = Path(str(index_fpath) + extension)
+        if path.exists():
+            size += path.stat().st_size
+    return size // MB + 1
+
+
+class ResourceBudget:
+    """It shares a fixed number of threads and megabytes among samples.
+
+    The threads given to a new sample are the free threads divided among the
+    samples that could start now, so when the queue drains the last samples
+    get the threads left by the finished ones. The threads of a sample are
+    fixed when it starts, the ones freed later are not given to the samples
+    already running.
+    """
+
+    def __init__(self, threads, memory, min_threads=MIN_THREADS_PER_SAMPLE,
+                 max_samples=None):
+        if threads < 1:
+            raise ValueError('At least one thread is required')
+        if max_samples is not None and max_samples < 1:
+            raise ValueError('At least one sample has to be run at once')
+        self.threads = threads
+        self.memory = memory
+        self.min_threads = min(min_threads, threads)
+        self.max_samples = max_samples
+        self.free_threads = threads
+        self.free_memory = memory
+        self.running = 0
+
+    def allocate(self, sample_memory, num_pending):
+        """It reserves the resources for a new sample.
+
+        It returns the number of threads for the sample or None if there are
+        not enough free resources to start it now
+        """
+        if self.free_threads < self.min_threads:
+            return None
+        if self.free_memory < sample_memory:
+            return None
+        free_slots = self.free_threads // self.min_threads
+        if sample_memory:
+            free_slots = min(free_slots, self.free_memory // sample_memory)
+        if self.max_samples is not None:
+            free_slots = min(free_slots, self.max_samples - self.running)
+        if free_slots < 1:
+            return None
+        threads = self.free_threads // min(free_slots, num_pending)
+        self.free_threads -= threads
+        self.free_memory -= sample_memory
+        self.running += 1
+        return threads
+
+    def release(self, threads, sample_memory):
+        self.free_threads += threads
+        self.free_memory += sample_memory
+        self.running -= 1
 
 
-def run_multiprocesses(func, confs, num_processes, log_fhand):
-    pool = mp.Pool(processes=num_processes)
-    results = pool.imap_unordered(func, confs)
+def split_sample_threads(threads):
+    """It splits the threads of a sample between bwa and sort.
+
+    sort compresses the bam while bwa maps, it gets a quarter of the threads.
+    A sample with one thread can not be split, both get it.
+    """
+    if threads < 2:
+        return 1, 1
+    sort_threads = max(1, threads // SORT_THREADS_FRACTION)
+    return threads - sort_threads, sort_threads
+
+
+def run_multiprocesses_with_budget(func, confs, log_fhand, threads=None,
+                                   memory=None,
+                                   min_threads=MIN_THREADS_PER_SAMPLE,
+                                   max_samples=None,
+                                   mapping_rate=DEFAULT_MAPPING_RATE,
+                                   metrics_fhand=None, shared_indexes=None):
+    """It runs func for every conf sharing the threads and the memory (in
+    megabytes) of the host.
+
+    Every sample gets its threads and its sort memory from the budget when
+    it starts, its threads are split between bwa and sort, that run at the
+    same time. It needs the memory to load its bwa index plus its sort
+    memory. The threads freed by a finished sample go to the next samples,
+    not to the ones already running.
+    """
+    start = time.time()
+    if threads is None:
+        threads = os.sysconf('SC_NPROCESSORS_ONLN')
+    if memory is None:
+        memory = get_total_memory()
+    budget = ResourceBudget(threads, memory, min_threads=min_threads,
+                            max_samples=max_samples)
+    num_processes = max(1, min(len(confs), threads // budget.min_threads))
+    if max_samples is not None:
+        num_processes = min(num_processes, max_samples)
+    executor = ProcessPoolExecutor(max_workers=num_processes)
+    finished = queue.Queue()
+    # the indexes in shared memory are not loaded again by every sample
+    index_memories = {index: 0 for index in (shared_indexes or [])}
+
+    pending = list(confs)
+    running = 0
     some_fail = False
-    for result in results:
-        failed = result['fail']
-        sample = result['sample']
-        msg = result['error_msg']
-        if failed:
-            log_fhand.write('ERROR: {}, {}\n'.format(sample, msg))
+    while pending or running:
+        while pending:
+            conf = pending[0]
+            sample_memory = _get_sample_memory(conf, index_memories)
+            if sample_memory > memory:
+                pending.pop(0)
+                msg = 'Not enough memory, {}MB required'.format(sample_memory)
+                result = {'fail': True, 'sample': _get_sample_name(conf),
+                          'error_msg': msg}
+                if _write_result(result, log_fhand):
+                    some_fail = True
+                continue
+            sample_threads = budget.allocate(sample_memory, len(pending))
+            if sample_threads is None:
+                if not running:
+                    # nothing will free resources, it would wait forever
+                    executor.shutdown()
+                    msg = 'The budget can not run the sample {}'
+                    raise ValueError(msg.format(_get_sample_name(conf)))
+                break
+            pending.pop(0)
+            conf = deepcopy(conf)
+            conf['threads'], conf['sort_threads'] = split_sample_threads(
+                sample_threads)
+            conf['sort_memory'] = sample_memory - index_memories[conf.get('index')]
+            allocation = (sample_threads, sample_memory)
+            future = executor.submit(func, conf)
+            future.add_done_callback(partial(_put_result, finished,
+                                             allocation, conf))
+            running += 1
+
+        if not running:
+            continue
+        result, allocation = finished.get()
+        budget.release(*allocation)
+        running -= 1
+        if _write_result(result, log_fhand):
             some_fail = True
-        else:
-            log_fhand.write('OK: {}\n'.format(sample))
-        log_fhand.flush()
+        if metrics_fhand is not None:
+            write_metrics(result, metrics_fhand, threads=allocation[0],
+                          memory=allocation[1])
 
+    executor.shutdown()
     if some_fail:
         log_fhand.write('ERROR: One or more mapping process hace failed\n')
 
+    sample_rates = [mapping_rate * threads / num_processes] * len(confs)
+    _write_makespan(confs, num_processes, sample_rates, time.time() - start,
+                    log_fhand)
+
+
+def _get_sample_memory(conf, index_memories):
+    index = conf.get('index')
+    if index not in index_memories:
+        index_memories[index] = estimate_bwa_index_memory(index)
+    sort_memory = conf.get('sort_memory')
+    if sort_memory is None:
+        sort_memory = DEFAULT_SORT_MEMORY
+    return index_memories[index] + sort_memory
+
+
+def _get_sample_name(conf):
+    'The mapping names the results by read group, library or sample'
+    return conf.get('read_group', conf.get('library', conf.get('sample')))
+
+
+def _put_result(finished, allocation, conf, future):
+    error = future.exception()
+    if error is None:
+        result = future.result()
+    else:
+        result = {'fail': True, 'sample': _get_sample_name(conf),
+                  'error_msg': str(error)}
+    finished.put((result, allocation))
+
+
+def estimate_sample_work(conf):
+    'It estimates the work needed to map a sample as the size of its reads'
+    work = 0
+    for key in ('read1_fpath', 'read2_fpath'):
+        fpath = conf.get(key)
+        if fpath and os.path.exists(fpath):
+            work += os.path.getsize(fpath)
+    return work
+
+
+def order_confs_largest_first(confs):
+    """It sorts the confs by their estimated work, the largest first.
+
+    Dispatching the longest samples first (LPT) prevents a big sample
+    started at the end from defining the makespan of the whole project.
+    """
+    for conf in confs:
+        conf['work'] = estimate_sample_work(conf)
+    return sorted(confs, key=lambda conf: conf['work'], reverse=True)
+
+
+def predict_makespan(works, num_workers, rates):
+    """It predicts the makespan, in seconds, of a list scheduling of the works
+    in the given order over num_workers.
+
+    rates are the bytes per second that each work is processed at
+    """
+    workers = [0] * max(1, num_workers)
+    for work, rate in zip(works, rates):
+        worker_end = heapq.heappop(workers)
+        heapq.heappush(workers, worker_end + work / rate)
+    return max(workers)
+
+
+def _write_makespan(confs, num_workers, sample_rates, actual, log_fhand):
+    if not all('work' in conf for conf in confs):
+        return
+    works = [conf['work'] for conf in confs]
+    predicted = predict_makespan(works, num_workers, sample_rates)
+    msg = 'Makespan predicted: {:.0f}s, actual: {:.0f}s\n'
+    log_fhand.write(msg.format(predicted, actual))
+    log_fhand.flush()
+
 
 def generate_bwa_confs_from_project(samples_fpath, bwa_index, do_duplicates,
                                     do_downgrade_edges, tmp_dir, read_dir,
                                     out_dir, downgrade_edges_conf, threads=1,
                                     pair_def_format='', paired=True,
-                                    do_csi_index=False):
+                                    do_csi_index=False, sort_memory=None,
+                                    sort_tmpdir=None, checkpoint=False,
+                                    do_cram=False, cache_dir=None,
+                                    cache_size=None, progress_dir=None,
+                                    min_mapping_rate=None):
     confs = []
     tmp_dirpath = Path(tmp_dir)
     skeleton = {'threads': threads, 'do_downgrade_edges': do_downgrade_edges,
                 'do_duplicates': do_duplicates, 'index': bwa_index,
                 'tmpdir': str(tmp_dirpath.absolute()), 'do_csi_index': do_csi_index,
-                'downgrade_edges_conf': downgrade_edges_conf}
+                'downgrade_edges_conf': downgrade_edges_conf,
+                'sort_memory': sort_memory, 'checkpoint': checkpoint,
+                'do_cram': do_cram, 'cache_dir': cache_dir,
+                'cache_size': cache_size, 'progress_dir': progress_dir,
+                'min_mapping_rate': min_mapping_rate}
+    if sort_tmpdir is not None:
+        skeleton['sort_tmpdir'] = str(Path(sort_tmpdir).absolute())
     out_dirpath = Path(out_dir)
     read_dirpath = Path(read_dir)
 
@@ -107,7 +592,8 @@ def generate_bwa_confs_from_project(samples_fpath, bwa_index, do_duplicates,
             read1_path = read_dirpath.joinpath('{}.fastq.gz'.format(read_group))
             conf['read1_fpath'] = str(read1_path.absolute())
 
-        out_path = out_dirpath.joinpath('{}.bam'.format(read_group))
+        out_suffix = '.cram' if do_cram else '.bam'
+        out_path = out_dirpath.joinpath(read_group + out_suffix)
         conf['out_fpath'] = str(out_path.absolute())
         conf['sample'] = sample
         conf['library'] = library
@@ -117,6 +603,19 @@ def generate_bwa_confs_from_project(samples_fpath, bwa_index, do_duplicates,
     return confs
 
 
+def write_checkpoint_status(confs, log_fhand):
+    'It writes the stages already completed by every sample'
+    for conf in confs:
+        sample = _get_sample_name(conf)
+        manifest = read_manifest(conf['out_fpath'])
+        if manifest is None or not manifest['stages']:
+            log_fhand.write('{}: no completed stages\n'.format(sample))
+            continue
+        stages = ', '.join(stage['name'] for stage in manifest['stages'])
+        log_fhand.write('{}: completed stages: {}\n'.format(sample, stages))
+    log_fhand.flush()
+
+
 def remove_fhand(fhand):
     fpath = fhand.name
     fhand.close()
@@ -0,0 +1,195 @@
+import json
+import os
+import re
+import time
+from pathlib import Path
+
+from dora.mapping.bwa import map_mp_bwamem
+from dora.mapping.lease import (claim_lease, holds_lease, get_leases,
+                                get_lease_fpath, get_worker_id, Heartbeat,
+                                HEARTBEAT_INTERVAL, LEASE_TIMEOUT)
+from dora.mapping.metrics import write_metrics
+from dora.mapping.utils import (_get_sample_name, _write_result,
+                                get_index_fpath)
+
+JOBS_DIR = 'jobs'
+LEASES_DIR = 'leases'
+RESULTS_DIR = 'results'
+CLOCKS_DIR = 'clocks'
+JOB_SUFFIX = '.json'
+POLL_INTERVAL = 10
+
+
+def _write_json_atomically(content, fpath):
+    tmp_fpath = fpath.with_name('.{}.{}.tmp'.format(fpath.name, os.getpid()))
+    with tmp_fpath.open('w') as fhand:
+        json.dump(content, fhand, indent=2, default=str)
+    os.replace(str(tmp_fpath), str(fpath))
+
+
+def _read_json(fpath):
+    with fpath.open() as fhand:
+        return json.load(fhand)
+
+
+def get_job_id(index, conf):
+    'The job ids keep the order of the confs'
+    name = re.sub(r'[^\w.-]', '_', str(_get_sample_name(conf)))
+    return '{:05d}_{}'.format(index, name)
+
+
+def write_jobs(confs, queue_dir):
+    """It writes a job file for every conf in the queue dir.
+
+    The jobs are claimed in the order of the confs. The jobs already in the
+    queue are kept, so a driver can be run again on the same queue.
+    It returns the job ids.
+    """
+    queue_dir = Path(queue_dir)
+    for dir_name in (JOBS_DIR, LEASES_DIR, RESULTS_DIR, CLOCKS_DIR):
+        queue_dir.joinpath(dir_name).mkdir(parents=True, exist_ok=True)
+    job_ids = []
+    for index, conf in enumerate(confs):
+        job_id = get_job_id(index, conf)
+        job_fpath = queue_dir.joinpath(JOBS_DIR, job_id + JOB_SUFFIX)
+        if not job_fpath.exists():
+            _write_json_atomically(conf, job_fpath)
+        job_ids.append(job_id)
+    return job_ids
+
+
+def get_job_ids(queue_dir):
+    jobs_dir = Path(queue_dir, JOBS_DIR)
+    return sorted(fpath.name[:-len(JOB_SUFFIX)]
+                  for fpath in jobs_dir.iterdir()
+                  if fpath.name.endswith(JOB_SUFFIX))
+
+
+def read_result(queue_dir, job_id):
+    'It returns the result of a finished job or None'
+    result_fpath = Path(queue_dir, RESULTS_DIR, job_id + JOB_SUFFIX)
+    if not result_fpath.exists():
+        return None
+    return _read_json(result_fpath)
+
+
+def claim_job(queue_dir, worker_id, lease_timeout=LEASE_TIMEOUT):
+    """It claims the first job without result that is not leased.
+
+    The jobs whose lease heartbeat is older than lease_timeout seconds are
+    claimed again, see claim_lease.
+    It returns the job id, the conf and the lease generation or None.
+    """
+    lease_dir = Path(queue_dir, LEASES_DIR)
+    clock_fpath = Path(queue_dir, CLOCKS_DIR, worker_id)
+    for job_id in get_job_ids(queue_dir):
+        if read_result(queue_dir, job_id) is not None:
+            continue
+        generation = claim_lease(lease_dir, job_id, worker_id, clock_fpath,
+                                 lease_timeout=lease_timeout)
+        if generation is None:
+            continue
+        conf = _read_json(Path(queue_dir, JOBS_DIR, job_id + JOB_SUFFIX))
+        return job_id, conf, generation
+    return None
+
+
+def _remove_partial_outputs(conf):
+    'The outputs of a job without result were left by a dead worker'
+    out_fpath = conf.get('out_fpath')
+    if out_fpath is None:
+        return
+    index_fpath = get_index_fpath(out_fpath, conf.get('do_csi_index', False))
+    for fpath in (Path(out_fpath), Path(index_fpath)):
+        if fpath.exists():
+            fpath.unlink()
+
+
+def run_worker(queue_dir, func=map_mp_bwamem, worker_id=None,
+               log_fhand=None, lease_timeout=LEASE_TIMEOUT,
+               heartbeat_interval=HEARTBEAT_INTERVAL,
+               poll_interval=POLL_INTERVAL, wait=True):
+    """It runs the jobs of the queue until all of them have a result.
+
+    Any number of workers, in any node that mounts the queue dir, can run at
+    the same time. While there is no job to claim the worker waits for the
+    running jobs, so it can claim them again if their workers die. Without
+    wait it returns as soon as there is nothing to claim.
+    It returns the number of jobs run.
+    """
+    if worker_id is None:
+        worker_id = get_worker_id()
+    num_jobs = 0
+    while True:
+        job = claim_job(queue_dir, worker_id, lease_timeout=lease_timeout)
+        if job is None:
+            if not wait or get_queue_status(queue_dir)['pending'] == 0:
+                break
+            time.sleep(poll_interval)
+            continue
+        job_id, conf, generation = job
+        if generation:
+            _remove_partial_outputs(conf)
+        lease_dir = Path(queue_dir, LEASES_DIR)
+        heartbeat = Heartbeat(get_lease_fpath(lease_dir, job_id, generation),
+                              interval=heartbeat_interval)
+        heartbeat.start()
+        try:
+            result = func(conf)
+        except Exception as error:
+            result = {'fail': True, 'sample': _get_sample_name(conf),
+                      'error_msg': '{}: {}'.format(type(error).__name__,
+                                                   error)}
+        finally:
+            heartbeat.stop()
+        num_jobs += 1
+        if not holds_lease(lease_dir, job_id, generation):
+            # a slow worker whose job was claimed again
+            continue
+        result['worker'] = worker_id
+        _write_json_atomically(result, Path(queue_dir, RESULTS_DIR,
+                                            job_id + JOB_SUFFIX))
+        if log_fhand is not None:
+            _write_result(result, log_fhand)
+    return num_jobs
+
+
+def get_queue_status(queue_dir):
+    'It counts the jobs done, running and pending, the last include running'
+    status = {'done': 0, 'failed': 0, 'running': 0, 'pending': 0}
+    for job_id in get_job_ids(queue_dir):
+        result = read_result(queue_dir, job_id)
+        if result is None:
+            status['pending'] += 1
+            if get_leases(Path(queue_dir, LEASES_DIR), job_id):
+                status['running'] += 1
+        elif result['fail']:
+            status['failed'] += 1
+        else:
+            status['done'] += 1
+    return status
+
+
+def wait_for_jobs(queue_dir, job_ids, log_fhand, metrics_fhand=None,
+                  poll_interval=POLL_INTERVAL):
+    """It writes the results of the jobs as the workers finish them.
+
+    It returns when all the jobs have a result.
+    """
+    pending = list(job_ids)
+    some_fail = False
+    while pending:
+        for job_id in list(pending):
+            result = read_result(queue_dir, job_id)
+            if result is None:
+                continue
+            pending.remove(job_id)
+            if _write_result(result, log_fhand):
+                some_fail = True
+            if metrics_fhand is not None:
+                write_metrics(result, metrics_fhand)
+        if pending:
+            time.sleep(poll_interval)
+    if some_fail:
+        log_fhand.write('ERROR: One or more mapping process hace failed\n')
+    return not some_fail
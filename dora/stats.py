@@ -1,6 +1,22 @@
-from collections import OrderedDict
+import os
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
+from pysam import AlignmentFile
+
+DEPTH_CHUNK_SIZE = 16 * 1024 * 1024
+DEPTH_COLUMN = 2
+NEW_LINE = ord('\n')
+TAB = ord('\t')
+COMMENT = ord('#')
+ZERO = ord('0')
+# positions whose depth is calculated at once from the reads of a bam
+DEPTH_WINDOW_SIZE = 10000000
+UNMAPPED_FLAG = 0x4
+SECONDARY_FLAG = 0x100
+QC_FAIL_FLAG = 0x200
+DUPLICATE_FLAG = 0x400
 
 
 def calc_coverage_stats(depths, is_counter=True,
@@ -102,3 +118,269 @@ def write_coverage_stats(stats, sample, out_fhand, genome_size=None):
         stdout += f'{min_cov}\t{count_bases}\t{percent_total_bases:.2%}\n'
 
     out_fhand.write(stdout)
+
+
+class DepthHistogram:
+    """It counts the positions of every depth.
+
+    The counts are kept in an array indexed by depth that grows up to the
+    largest depth found.
+    """
+
+    def __init__(self):
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def add(self, depths):
+        counts = np.bincount(depths, minlength=len(self.counts))
+        counts[:len(self.counts)] += self.counts
+        self.counts = counts
+
+    def add_counts(self, counts):
+        if len(counts) > len(self.counts):
+            counts = counts.copy()
+            counts[:len(self.counts)] += self.counts
+            self.counts = counts
+        else:
+            self.counts[:len(counts)] += counts
+
+    def to_counter(self):
+        'It returns a Counter with the depths sorted'
+        depths = np.flatnonzero(self.counts)
+        return Counter(dict(zip(depths.tolist(),
+                                self.counts[depths].tolist())))
+
+
+def parse_depth_chunk(chunk, column=DEPTH_COLUMN):
+    """It returns the depths of the lines of a samtools depth chunk.
+
+    The chunk has to end in a complete line. The fields are separated by
+    tabs, the empty lines and the ones starting with # are ignored.
+    All the lines are parsed at once, the digits of the depth column are
+    added up by their position from the end of the field.
+    """
+    data = np.frombuffer(chunk, dtype=np.uint8)
+    ends = np.flatnonzero(data == NEW_LINE)
+    if len(data) and data[-1] != NEW_LINE:
+        ends = np.append(ends, len(data))
+    if not len(ends):
+        return np.zeros(0, dtype=np.int64)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    with_data = starts < ends
+    with_data[with_data] = data[starts[with_data]] != COMMENT
+    starts = starts[with_data]
+    ends = ends[with_data]
+    if not len(starts):
+        return np.zeros(0, dtype=np.int64)
+    # the windows line ends
+    ends = ends - (data[ends - 1] == ord('\r'))
+
+    tabs = np.flatnonzero(data == TAB)
+    field_tab = np.searchsorted(tabs, starts) + column - 1
+    if not len(tabs) or field_tab.max() >= len(tabs) or \
+       np.any(tabs[field_tab] >= ends):
+        raise ValueError('Depth line without column {}'.format(column + 1))
+    field_starts = tabs[field_tab] + 1
+    next_tab = tabs[np.minimum(field_tab + 1, len(tabs) - 1)]
+    field_ends = np.where((field_tab + 1 < len(tabs)) & (next_tab < ends),
+                          next_tab, ends)
+
+    widths = field_ends - field_starts
+    if np.any(widths <= 0):
+        raise ValueError('Empty depth field')
+    depths = np.zeros(len(starts), dtype=np.int64)
+    for position in range(int(widths.max())):
+        in_field = widths > position
+        digits = data[field_ends[in_field] - 1 - position].astype(np.int64)
+        digits -= ZERO
+        if np.any((digits < 0) | (digits > 9)):
+            raise ValueError('Depth field that is not an integer')
+        depths[in_field] += digits * 10 ** position
+    return depths
+
+
+def read_depth_histogram(fhand, chunk_size=DEPTH_CHUNK_SIZE, size=None):
+    """It counts the depths of a samtools depth binary file handler.
+
+    The file is read in chunks of chunk_size bytes, so the memory used does
+    not depend on the file size. With a size only those bytes are read.
+    """
+    histogram = DepthHistogram()
+    remainder = b''
+    while size is None or size > 0:
+        to_read = chunk_size if size is None else min(chunk_size, size)
+        chunk = fhand.read(to_read)
+        if not chunk:
+            break
+        if size is not None:
+            size -= len(chunk)
+        last_line_end = chunk.rfind(b'\n')
+        if last_line_end == -1:
+            remainder += chunk
+            continue
+        histogram.add(parse_depth_chunk(remainder +
+                                        chunk[:last_line_end + 1]))
+        remainder = chunk[last_line_end + 1:]
+    if remainder:
+        histogram.add(parse_depth_chunk(remainder))
+    return histogram
+
+
+def get_depth_file_ranges(fpath, num_ranges):
+    'It splits the file in byte ranges that start at the start of a line'
+    size = os.path.getsize(fpath)
+    boundaries = [0]
+    with open(fpath, 'rb') as fhand:
+        for index in range(1, num_ranges):
+            fhand.seek(max(size * index // num_ranges - 1, boundaries[-1]))
+            fhand.readline()
+            boundary = fhand.tell()
+            if boundary >= size:
+                break
+            if boundary > boundaries[-1]:
+                boundaries.append(boundary)
+    boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def _read_depth_range(fpath, start, end, chunk_size):
+    with open(fpath, 'rb') as fhand:
+        fhand.seek(start)
+        return read_depth_histogram(fhand, chunk_size=chunk_size,
+                                    size=end - start).counts
+
+
+def calc_depth_histogram(fpath, processes=1, chunk_size=DEPTH_CHUNK_SIZE):
+    """It returns a Counter with the positions of every depth of a samtools
+    depth file.
+
+    With several processes every one counts the depths of a byte range of
+    the file.
+    """
+    fpath = str(fpath)
+    if processes <= 1:
+        with open(fpath, 'rb') as fhand:
+            return read_depth_histogram(fhand, chunk_size).to_counter()
+    histogram = DepthHistogram()
+    ranges = get_depth_file_ranges(fpath, processes)
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(_read_depth_range, fpath, start, end,
+                                   chunk_size)
+                   for start, end in ranges]
+        for future in futures:
+            histogram.add_counts(future.result())
+    return histogram.to_counter()
+
+
+def get_depth_windows(contigs, window_size=DEPTH_WINDOW_SIZE):
+    """It splits the contigs in tasks with window_size positions at most.
+
+    contigs are (name, length) tuples. The long contigs are split in
+    windows and the short ones are grouped in the same task.
+    It returns the tasks as lists of (contig, start, end) windows.
+    """
+    tasks = []
+    task = []
+    task_size = 0
+    for contig, length in contigs:
+        for start in range(0, length, window_size):
+            end = min(start + window_size, length)
+            if task_size + end - start > window_size:
+                tasks.append(task)
+                task = []
+                task_size = 0
+            task.append((contig, start, end))
+            task_size += end - start
+    if task:
+        tasks.append(task)
+    return tasks
+
+
+def _get_window_depths(reads, start, end, exclude_flags, min_mapq,
+                       read_groups):
+    'It returns the depth of every position of the window'
+    block_starts = []
+    block_ends = []
+    for read in reads:
+        if read.flag & exclude_flags or read.mapping_quality < min_mapq:
+            continue
+        if read_groups is not None and (not read.has_tag('RG') or
+                                        read.get_tag('RG') not in read_groups):
+            continue
+        for block_start, block_end in read.get_blocks():
+            block_starts.append(block_start)
+            block_ends.append(block_end)
+    length = end - start
+    # the blocks out of the window add and remove a read at the same edge
+    block_starts = np.clip(np.array(block_starts, dtype=np.int64) - start, 0,
+                           length)
+    block_ends = np.clip(np.array(block_ends, dtype=np.int64) - start, 0,
+                         length)
+    differences = (np.bincount(block_starts, minlength=length + 1) -
+                   np.bincount(block_ends, minlength=length + 1))
+    return np.cumsum(differences[:length])
+
+
+def _count_windows_depths(bam_fpath, windows, exclude_flags, min_mapq,
+                          read_groups, reference_fpath):
+    histogram = DepthHistogram()
+    with AlignmentFile(bam_fpath, reference_filename=reference_fpath) as sam:
+        for contig, start, end in windows:
+            depths = _get_window_depths(sam.fetch(contig, start, end), start,
+                                        end, exclude_flags, min_mapq,
+                                        read_groups)
+            histogram.add(depths)
+    return histogram.counts
+
+
+def get_sample_read_groups(header, sample):
+    'It returns the ids of the read groups of the sample in a bam header'
+    return [read_group['ID'] for read_group in header.to_dict().get('RG', [])
+            if read_group.get('SM') == sample]
+
+
+def calc_bam_depth_histogram(bam_fpath, min_mapq=0, rm_dups=False,
+                             sample=None, processes=1,
+                             reference_fpath=None,
+                             window_size=DEPTH_WINDOW_SIZE):
+    """It returns a Counter with the positions of every depth of an indexed
+    bam or cram.
+
+    All the positions of the contigs are counted, as samtools depth -a
+    does. The aligned blocks of every read are added to a difference array
+    of the window, so the depths are the cumulative sum of the window. The
+    deletions and the skipped regions are not counted.
+    The unmapped, secondary and QC failed reads, the duplicates with
+    rm_dups and the reads with a mapping quality lower than min_mapq or out
+    of the read groups of the sample, the SM of the header, are excluded.
+    The windows are processed in parallel by processes.
+    """
+    bam_fpath = str(bam_fpath)
+    exclude_flags = UNMAPPED_FLAG | SECONDARY_FLAG | QC_FAIL_FLAG
+    if rm_dups:
+        exclude_flags |= DUPLICATE_FLAG
+    read_groups = None
+    with AlignmentFile(bam_fpath, reference_filename=reference_fpath) as sam:
+        if not sam.has_index():
+            raise ValueError('The bam has to be indexed: {}'.format(bam_fpath))
+        contigs = list(zip(sam.references, sam.lengths))
+        if sample is not None:
+            read_groups = set(get_sample_read_groups(sam.header, sample))
+            if not read_groups:
+                msg = 'The bam has no read groups of the sample {}: {}'
+                raise ValueError(msg.format(sample, bam_fpath))
+    tasks = get_depth_windows(contigs, window_size=window_size)
+    task_args = (exclude_flags, min_mapq, read_groups, reference_fpath)
+
+    histogram = DepthHistogram()
+    if processes <= 1:
+        for windows in tasks:
+            histogram.add_counts(_count_windows_depths(bam_fpath, windows,
+                                                       *task_args))
+        return histogram.to_counter()
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(_count_windows_depths, bam_fpath, windows,
+                                   *task_args)
+                   for windows in tasks]
+        for future in futures:
+            histogram.add_counts(future.result())
+    return histogram.to_counter()
@@ -0,0 +1,13 @@
+import os
+
+
+def fake_mapping(conf):
+    """It maps a sample conf without running bwa.
+
+    It writes its pid in the out file of the conf, if any, so the tests can
+    check which process has mapped the sample.
+    """
+    if 'out_fpath' in conf:
+        with open(conf['out_fpath'], 'a') as fhand:
+            fhand.write('{}\n'.format(os.getpid()))
+    return {'fail': False, 'sample': conf['sample'], 'error_msg': 'OK'}
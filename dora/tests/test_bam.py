@@ -0,0 +1,266 @@
+import unittest
+from array import array
+from collections import namedtuple
+from pathlib import Path
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+
+from pysam import AlignedSegment, AlignmentFile, AlignmentHeader
+
+from dora.benchmark import generate_aligned_reads, generate_reference
+from dora.mapping.bam import (parse_duplicates_metrics, PICARD, SAMTOOLS,
+                              downgrade_edge_qualities,
+                              _downgrade_edge_qualities_python,
+                              downgrade_read_edges, split_contigs_in_regions,
+                              restore_read_edges, restore_edge_qualities,
+                              bam_to_cram, index_bam, count_indexed_reads,
+                              markdup_cmd, write_bam_cmd, BYTES_TAG_TYPE)
+from dora.mapping.utils import get_index_fpath
+
+PICARD_METRICS = '''## htsjdk.samtools.metrics.StringHeader
+# MarkDuplicates INPUT=[in.bam] OUTPUT=out.bam METRICS_FILE=metrics
+## htsjdk.samtools.metrics.StringHeader
+# Started on: Mon Jan 01 00:00:00 CET 2024
+
+## METRICS CLASS\tpicard.sam.DuplicationMetrics
+LIBRARY\tUNPAIRED_READS_EXAMINED\tREAD_PAIRS_EXAMINED\tSECONDARY_OR_SUPPLEMENTARY_RDS\tUNMAPPED_READS\tUNPAIRED_READ_DUPLICATES\tREAD_PAIR_DUPLICATES\tREAD_PAIR_OPTICAL_DUPLICATES\tPERCENT_DUPLICATION\tESTIMATED_LIBRARY_SIZE
+lib1\t10\t45\t0\t2\t2\t4\t1\t0.1\t300
+
+## HISTOGRAM\tjava.lang.Double
+BIN\tCoverageMult
+1.0\t1.0
+'''
+
+SAMTOOLS_METRICS = '''COMMAND: samtools markdup -f metrics - out.bam
+READ: 102
+WRITTEN: 102
+EXCLUDED: 2
+EXAMINED: 100
+PAIRED: 90
+SINGLE: 10
+DUPLICATE PAIR: 8
+DUPLICATE SINGLE: 2
+DUPLICATE PAIR OPTICAL: 2
+DUPLICATE SINGLE OPTICAL: 0
+DUPLICATE NON PRIMARY: 0
+DUPLICATE NON PRIMARY OPTICAL: 0
+DUPLICATE PRIMARY TOTAL: 10
+DUPLICATE TOTAL: 10
+ESTIMATED_LIBRARY_SIZE: 300
+'''
+
+
+class DuplicatesMetricsTest(unittest.TestCase):
+
+    def _parse(self, content):
+        with NamedTemporaryFile(mode='wt', suffix='.metrics') as fhand:
+            fhand.write(content)
+            fhand.flush()
+            return parse_duplicates_metrics(fhand.name)
+
+    def test_both_backends_are_comparable(self):
+        picard = self._parse(PICARD_METRICS)
+        samtools = self._parse(SAMTOOLS_METRICS)
+        self.assertEqual(picard['backend'], PICARD)
+        self.assertEqual(samtools['backend'], SAMTOOLS)
+        for metrics in (picard, samtools):
+            self.assertEqual(metrics['examined_reads'], 100)
+            self.assertEqual(metrics['duplicate_reads'], 10)
+            self.assertEqual(metrics['optical_duplicate_reads'], 2)
+            self.assertAlmostEqual(metrics['duplication_rate'], 0.1)
+
+
+class IndexOnWriteTest(unittest.TestCase):
+
+    def test_index_on_write_cmds(self):
+        cmd = markdup_cmd('out.bam', index_fpath='out.bam.bai')
+        self.assertIn('--write-index', cmd)
+        self.assertEqual(cmd[-1], 'out.bam##idx##out.bam.bai')
+        self.assertNotIn('--write-index', markdup_cmd('out.bam'))
+        # the uncompressed stream to the next stage is not indexed
+        self.assertNotIn('--write-index',
+                         markdup_cmd(None, index_fpath='out.bam.bai'))
+
+        cmd = write_bam_cmd('out.cram', reference_fpath='ref.fasta',
+                            index_fpath=get_index_fpath('out.cram'))
+        self.assertEqual(cmd[-6:], ['--reference', 'ref.fasta',
+                                    '--write-index', '-o',
+                                    'out.cram##idx##out.cram.crai', '-'])
+
+
+class DowngradeEdgeQualitiesTest(unittest.TestCase):
+
+    def test_same_reads_as_base_by_base(self):
+        reads = generate_aligned_reads(500, read_length=50, seed=1)
+        for sizes in ((3, 3), (0, 5), (30, 30), (60, 0)):
+            for qual_to_substract in (0, 20, 60):
+                for read in reads:
+                    read1 = AlignedSegment.fromstring(read.to_string(),
+                                                      read.header)
+                    read2 = AlignedSegment.fromstring(read.to_string(),
+                                                      read.header)
+                    downgrade_edge_qualities(read1, *sizes,
+                                             qual_to_substract)
+                    _downgrade_edge_qualities_python(read2, *sizes,
+                                                     qual_to_substract)
+                    self.assertEqual(read1.to_string(), read2.to_string())
+
+    def test_downgrade(self):
+        read = generate_aligned_reads(1, read_length=10, seed=1)[0]
+        read.flag = 0
+        read.cigarstring = '10M'
+        read.query_qualities = array('B', [10, 30, 40, 40, 40, 40, 40, 40,
+                                           40, 5])
+        downgrade_edge_qualities(read, 2, 1, qual_to_substract=20)
+        self.assertEqual(list(read.query_qualities),
+                         [0, 10, 40, 40, 40, 40, 40, 40, 40, 0])
+        self.assertEqual(read.get_tag('dl'), '+?')
+        self.assertEqual(read.get_tag('dr'), '&')
+
+    def test_restore_edge_qualities(self):
+        read = generate_aligned_reads(1, read_length=10, seed=1)[0]
+        read.query_qualities = array('B', [0, 10, 40, 40, 40, 40, 40, 40,
+                                           40, 0])
+        read.set_tag('dl', '+?', value_type='Z')
+        read.set_tag('dr', '&', value_type='Z')
+        restore_edge_qualities(read)
+        self.assertEqual(list(read.query_qualities),
+                         [10, 30, 40, 40, 40, 40, 40, 40, 40, 5])
+        self.assertFalse(read.has_tag('dl'))
+        self.assertFalse(read.has_tag('dr'))
+
+    def test_bytes_tags(self):
+        read = generate_aligned_reads(1, read_length=10, seed=1)[0]
+        read.flag = 0
+        read.cigarstring = '10M'
+        quals = [10, 30, 40, 40, 40, 40, 40, 40, 40, 5]
+        read.query_qualities = array('B', quals)
+        downgrade_edge_qualities(read, 2, 1, qual_to_substract=20,
+                                 tag_type=BYTES_TAG_TYPE)
+        self.assertEqual(list(read.query_qualities),
+                         [0, 10, 40, 40, 40, 40, 40, 40, 40, 0])
+        self.assertEqual(list(read.get_tag('dl')), [10, 30])
+        self.assertEqual(list(read.get_tag('dr')), [5])
+        restore_edge_qualities(read)
+        self.assertEqual(list(read.query_qualities), quals)
+        self.assertFalse(read.has_tag('dl'))
+
+        with self.assertRaises(ValueError):
+            downgrade_edge_qualities(read, 2, 1, qual_to_substract=20,
+                                     tag_type='H')
+
+
+IndexStats = namedtuple('IndexStats', ['contig', 'mapped', 'unmapped',
+                                       'total'])
+
+
+def _get_read_fields(read):
+    # the cram decoder adds the MD and NM tags
+    return (read.query_name, read.reference_name, read.reference_start,
+            read.cigarstring, read.query_sequence,
+            list(read.query_qualities), read.get_tag('dl'),
+            read.get_tag('dr'))
+
+
+def _write_sorted_bam(fpath, num_reads, contig_length=10000000):
+    header = AlignmentHeader.from_dict({
+        'HD': {'VN': '1.6', 'SO': 'coordinate'},
+        'SQ': [{'SN': 'contig{}'.format(index + 1), 'LN': contig_length}
+               for index in range(3)]})
+    reads = []
+    for read_index, read in enumerate(generate_aligned_reads(num_reads,
+                                                             seed=1)):
+        read = AlignedSegment.fromstring(read.to_string(), header)
+        read.reference_id = read_index % 3
+        read.reference_start %= contig_length - read.query_length
+        reads.append(read)
+    unmapped = AlignedSegment(header)
+    unmapped.query_name = 'unmapped'
+    unmapped.query_sequence = 'ACGT'
+    unmapped.query_qualities = array('B', [30, 30, 30, 30])
+    unmapped.flag = 4
+    reads.append(unmapped)
+    reads.sort(key=lambda read: (read.reference_id < 0, read.reference_id,
+                                 read.reference_start))
+    with AlignmentFile(str(fpath), 'wb', header=header) as out_sam:
+        for read in reads:
+            out_sam.write(read)
+
+
+class DowngradeReadEdgesTest(unittest.TestCase):
+
+    def test_by_contigs_as_sequential(self):
+        with TemporaryDirectory() as tmp_dir:
+            in_fpath = Path(tmp_dir, 'in.bam')
+            _write_sorted_bam(in_fpath, 1000)
+            outs = []
+            for workers in (1, 2):
+                out_fpath = Path(tmp_dir, 'out{}.bam'.format(workers))
+                num_reads = downgrade_read_edges(in_fpath, out_fpath, 3, 3,
+                                                 workers=workers, threads=2,
+                                                 tmp_dir=tmp_dir)
+                self.assertEqual(num_reads, 1001)
+                with AlignmentFile(str(out_fpath)) as out_sam:
+                    outs.append([read.to_string() for read in out_sam])
+            self.assertEqual(outs[0], outs[1])
+            self.assertEqual(outs[1][-1].split('\t')[0], 'unmapped')
+            self.assertEqual(len(list(Path(tmp_dir).iterdir())), 3)
+
+    def test_restore(self):
+        with TemporaryDirectory() as tmp_dir:
+            in_fpath = Path(tmp_dir, 'in.bam')
+            _write_sorted_bam(in_fpath, 1000)
+            with AlignmentFile(str(in_fpath)) as in_sam:
+                expected = [read.to_string() for read in in_sam]
+            for tag_type in ('Z', BYTES_TAG_TYPE):
+                downgraded_fpath = Path(tmp_dir, 'downgraded.bam')
+                downgrade_read_edges(in_fpath, downgraded_fpath, 3, 5,
+                                     tag_type=tag_type)
+                for workers in (1, 2):
+                    out_fpath = Path(tmp_dir, 'restored.bam')
+                    num_reads = restore_read_edges(downgraded_fpath,
+                                                   out_fpath, workers=workers,
+                                                   tmp_dir=tmp_dir)
+                    self.assertEqual(num_reads, 1001)
+                    with AlignmentFile(str(out_fpath)) as out_sam:
+                        restored = [read.to_string() for read in out_sam]
+                    self.assertEqual(restored, expected)
+
+    def test_cram(self):
+        with TemporaryDirectory() as tmp_dir:
+            reference_fpath = Path(tmp_dir, 'reference.fasta')
+            generate_reference(reference_fpath, 3000, num_contigs=3, seed=1)
+            in_fpath = Path(tmp_dir, 'in.bam')
+            _write_sorted_bam(in_fpath, 300, contig_length=1000)
+            expected_fpath = Path(tmp_dir, 'expected.bam')
+            downgrade_read_edges(in_fpath, expected_fpath, 3, 3)
+            with AlignmentFile(str(expected_fpath)) as out_sam:
+                expected = [_get_read_fields(read) for read in out_sam]
+
+            for workers in (1, 2):
+                out_fpath = Path(tmp_dir, 'out{}.cram'.format(workers))
+                downgrade_read_edges(in_fpath, out_fpath, 3, 3,
+                                     workers=workers, tmp_dir=tmp_dir,
+                                     reference_fpath=str(reference_fpath))
+                with AlignmentFile(str(out_fpath),
+                                   reference_filename=str(reference_fpath)
+                                   ) as out_sam:
+                    self.assertTrue(out_sam.is_cram)
+                    reads = [_get_read_fields(read) for read in out_sam]
+                self.assertEqual(reads, expected)
+
+            out_fpath = Path(tmp_dir, 'converted.cram')
+            bam_to_cram(expected_fpath, out_fpath, reference_fpath)
+            index_bam(out_fpath, do_csi_index=True)
+            self.assertTrue(Path(get_index_fpath(out_fpath)).exists())
+            self.assertEqual(count_indexed_reads(out_fpath), 301)
+
+    def test_split_contigs_in_regions(self):
+        stats = [IndexStats('c1', 10, 0, 10), IndexStats('c2', 0, 0, 0),
+                 IndexStats('c3', 5, 0, 5), IndexStats('c4', 4, 1, 5)]
+        regions = split_contigs_in_regions(stats, num_regions=2)
+        self.assertEqual(regions, [['c1'], ['c3', 'c4']])
+        self.assertEqual(split_contigs_in_regions([], num_regions=2), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import json
+import unittest
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from dora.benchmark import (generate_dataset, get_stage_combinations,
+                            get_combination_name, compare_benchmarks,
+                            DATASET_FNAME, READ1_FNAME, READ2_FNAME,
+                            REFERENCE_FNAME)
+from dora.mapping.fastq import open_fastq
+
+
+class GenerateDatasetTest(unittest.TestCase):
+
+    def test_generate_dataset(self):
+        with TemporaryDirectory() as tmp_dir:
+            dataset = generate_dataset(tmp_dir, genome_size=3000, depth=10,
+                                       duplicate_rate=0.5, num_contigs=2,
+                                       read_length=100, seed=1, index=False)
+            self.assertEqual(dataset['reads'], 300)
+            with Path(tmp_dir, DATASET_FNAME).open() as fhand:
+                self.assertEqual(json.load(fhand), dataset)
+            reference = Path(tmp_dir, REFERENCE_FNAME).read_text()
+            self.assertEqual(reference.count('>'), 2)
+
+            lines1 = open_fastq(Path(tmp_dir, READ1_FNAME)).readlines()
+            lines2 = open_fastq(Path(tmp_dir, READ2_FNAME)).readlines()
+            self.assertEqual(len(lines1), 150 * 4)
+            self.assertEqual(len(lines2), 150 * 4)
+            self.assertEqual(lines1[0], '@pair0/1\n')
+            self.assertEqual(lines2[0], '@pair0/2\n')
+            self.assertEqual(len(lines1[1].strip()), 100)
+            pairs = list(zip(lines1[1::4], lines2[1::4]))
+            self.assertLess(len(set(pairs)), len(pairs))
+
+            dataset2 = generate_dataset(Path(tmp_dir, 'again'),
+                                        genome_size=3000, depth=10,
+                                        duplicate_rate=0.5, num_contigs=2,
+                                        read_length=100, seed=1, index=False)
+            self.assertEqual(dataset, dataset2)
+            lines_again = open_fastq(Path(tmp_dir, 'again',
+                                          READ1_FNAME)).readlines()
+            self.assertEqual(lines1, lines_again)
+
+
+class CompareBenchmarksTest(unittest.TestCase):
+
+    def test_stage_combinations(self):
+        combinations = get_stage_combinations()
+        self.assertEqual(len(combinations), 16)
+        names = {get_combination_name(comb) for comb in combinations}
+        self.assertEqual(len(names), 16)
+        self.assertIn('mapping', names)
+
+    def test_compare(self):
+        dataset = {'reads': 100}
+        reference = {'dataset': dataset,
+                     'runs': [{'combination': 'mapping', 'fail': False,
+                               'reads_per_second': 100},
+                              {'combination': 'do_duplicates', 'fail': False,
+                               'reads_per_second': 100}]}
+        current = {'dataset': dataset,
+                   'runs': [{'combination': 'mapping', 'fail': False,
+                             'reads_per_second': 95},
+                            {'combination': 'do_duplicates', 'fail': False,
+                             'reads_per_second': 50}]}
+        regressions = compare_benchmarks(reference, current, tolerance=0.1)
+        self.assertEqual(regressions, [('do_duplicates', 100, 50)])
+
+        with self.assertRaises(ValueError):
+            compare_benchmarks(reference, {'dataset': {'reads': 1},
+                                           'runs': []})
+
+
+if __name__ == "__main__":
+    unittest.main()
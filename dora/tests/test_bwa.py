@@ -1,17 +1,26 @@
 
+import json
 import os
 from pathlib import Path
 import unittest
 import dora.mapping
-from tempfile import NamedTemporaryFile, gettempdir
+from tempfile import NamedTemporaryFile, TemporaryDirectory, gettempdir
 from subprocess import run, PIPE
 
-from dora.mapping.bwa import map_with_bwamem, map_mp_bwamem
+from dora.mapping.bam import parse_duplicates_metrics, PICARD, SAMTOOLS
+from dora.mapping.bwa import (map_with_bwamem, map_mp_bwamem, map_shard,
+                              SHARD_LEASES_DIR)
+from dora.mapping.lease import claim_lease, get_lease_fpath, get_leases
+from dora.mapping.manifest import read_manifest
 from dora.mapping.utils import map_process_to_sortedbam
 
 TEST_DATA_PATHDIR = Path(dora.mapping.__file__).parent.parent.joinpath('tests').joinpath('data')
 
 
+def _get_status(result):
+    return {key: result[key] for key in ('fail', 'sample', 'error_msg')}
+
+
 class BwaTest(unittest.TestCase):
 
     def test_map_with_bwa(self):
@@ -36,7 +45,7 @@ class BwaTest(unittest.TestCase):
             conf['do_duplicates'] = True
             conf['do_downgrade_edges'] = False
             result = map_mp_bwamem(conf)
-            self.assertEqual(result, {'fail': False, 'sample': 'tests', 'error_msg': 'OK'})
+            self.assertEqual(_get_status(result), {'fail': False, 'sample': 'tests', 'error_msg': 'OK'})
             out = run(['samtools', 'view', '-h', out_tmp_fpath], stdout=PIPE)
             self.assertIn(b'TTCTGATTCAATCTACTTCAAAGTTGGCTTTATCAATAAG', out.stdout)
         finally:
@@ -55,7 +64,7 @@ class BwaTest(unittest.TestCase):
             conf['do_duplicates'] = False
             conf['do_downgrade_edges'] = False
             result = map_mp_bwamem(conf)
-            self.assertEqual(result, {'fail': False, 'sample': 'tests', 'error_msg': 'OK'})
+            self.assertEqual(_get_status(result), {'fail': False, 'sample': 'tests', 'error_msg': 'OK'})
             out = run(['samtools', 'view', '-h', out_tmp_fpath], stdout=PIPE)
             self.assertIn(b'SQ\tSN:AT1G55265.1', out.stdout)
         finally:
@@ -73,13 +82,170 @@ class BwaTest(unittest.TestCase):
             conf['do_duplicates'] = False
             conf['do_downgrade_edges'] = False
             result = map_mp_bwamem(conf)
-            assert result == {'fail': False, 'sample': 'tests', 'error_msg': 'OK'}
+            assert _get_status(result) == {'fail': False, 'sample': 'tests', 'error_msg': 'OK'}
             out = run(['samtools', 'view', '-h', out_tmp_fpath], stdout=PIPE)
             assert b'SQ\tSN:AT1G55265.1' in out.stdout
         finally:
             if os.path.exists(out_tmp_fpath):
                 os.remove(out_tmp_fpath)
 
+    def test_map_process_metrics(self):
+        out_dir = TemporaryDirectory()
+        try:
+            for streaming in (True, False):
+                out_fpath = os.path.join(out_dir.name, '{}.bam'.format(streaming))
+                conf = {}
+                conf['index'] = str(TEST_DATA_PATHDIR.joinpath('arabidopsis_genes'))
+                conf['read1_fpath'] = str(TEST_DATA_PATHDIR.joinpath('arabidopsis_reads.fastq'))
+                conf['out_fpath'] = out_fpath
+                conf['sample'] = 'tests'
+                conf['tmpdir'] = out_dir.name
+                conf['do_downgrade_edges'] = True
+                conf['downgrade_edges_conf'] = {'read_start_size': 3,
+                                                'read_end_size': 3}
+                conf['streaming'] = streaming
+                result = map_mp_bwamem(conf)
+                self.assertFalse(result['fail'])
+                self.assertEqual(result['reads'], 4)
+                self.assertEqual(result['stages']['downgrade_edges']['reads'], 4)
+                self.assertIn('index', result['stages'])
+                for metrics in result['stages'].values():
+                    self.assertIsNotNone(metrics['wall_time'])
+                    self.assertIsNotNone(metrics['cpu_time'])
+        finally:
+            out_dir.cleanup()
+
+    def test_streaming_map_process_matches_staged(self):
+        out_dir = TemporaryDirectory()
+        try:
+            views = []
+            for streaming in (True, False):
+                out_fpath = os.path.join(out_dir.name, '{}.bam'.format(streaming))
+                conf = {}
+                conf['index'] = str(TEST_DATA_PATHDIR.joinpath('arabidopsis_genes'))
+                conf['read1_fpath'] = str(TEST_DATA_PATHDIR.joinpath('arabreads_1.fastq'))
+                conf['read2_fpath'] = str(TEST_DATA_PATHDIR.joinpath('arabreads_2.fastq'))
+                conf['out_fpath'] = out_fpath
+                conf['sample'] = 'tests'
+                conf['tmpdir'] = out_dir.name
+                conf['filter_supplementary'] = True
+                conf['do_duplicates'] = True
+                conf['do_downgrade_edges'] = True
+                conf['downgrade_edges_conf'] = {'read_start_size': 3,
+                                                'read_end_size': 3}
+                conf['streaming'] = streaming
+                result = map_mp_bwamem(conf)
+                self.assertEqual(_get_status(result), {'fail': False, 'sample': 'tests', 'error_msg': 'OK'})
+                self.assertTrue(os.path.exists(out_fpath + '.bai'))
+                out = run(['samtools', 'view', out_fpath], stdout=PIPE)
+                views.append(out.stdout)
+            self.assertEqual(views[0], views[1])
+        finally:
+            out_dir.cleanup()
+
+    def test_downgrade_before_sort(self):
+        out_dir = TemporaryDirectory()
+        try:
+            views = []
+            for before_sort in (True, False):
+                out_fpath = os.path.join(out_dir.name, '{}.bam'.format(before_sort))
+                conf = {}
+                conf['index'] = str(TEST_DATA_PATHDIR.joinpath('arabidopsis_genes'))
+                conf['read1_fpath'] = str(TEST_DATA_PATHDIR.joinpath('arabreads_1.fastq'))
+                conf['read2_fpath'] = str(TEST_DATA_PATHDIR.joinpath('arabreads_2.fastq'))
+                conf['out_fpath'] = out_fpath
+                conf['sample'] = 'tests'
+                conf['tmpdir'] = out_dir.name
+                conf['filter_supplementary'] = True
+                conf['do_downgrade_edges'] = True
+                conf['downgrade_edges_conf'] = {'read_start_size': 3,
+                                                'read_end_size': 3}
+                conf['downgrade_before_sort'] = before_sort
+                result = map_mp_bwamem(conf)
+                self.assertEqual(_get_status(result), {'fail': False, 'sample': 'tests', 'error_msg': 'OK'})
+                out = run(['samtools', 'view', out_fpath], stdout=PIPE)
+                views.append(out.stdout)
+            self.assertIn(b'dl:Z:', views[0])
+            self.assertEqual(views[0], views[1])
+        finally:
+            out_dir.cleanup()
+
+    def test_samtools_duplicates_backend(self):
+        out_dir = TemporaryDirectory()
+        try:
+            rates = {}
+            for backend in (PICARD, SAMTOOLS):
+                out_fpath = os.path.join(out_dir.name, '{}.bam'.format(backend))
+                metric_fpath = os.path.join(out_dir.name, '{}.metrics'.format(backend))
+                conf = {}
+                conf['index'] = str(TEST_DATA_PATHDIR.joinpath('arabidopsis_genes'))
+                conf['read1_fpath'] = str(TEST_DATA_PATHDIR.joinpath('arabreads_1.fastq'))
+                conf['read2_fpath'] = str(TEST_DATA_PATHDIR.joinpath('arabreads_2.fastq'))
+                conf['out_fpath'] = out_fpath
+                conf['sample'] = 'tests'
+                conf['tmpdir'] = out_dir.name
+                conf['do_duplicates'] = True
+                conf['do_downgrade_edges'] = False
+                conf['duplicates_backend'] = backend
+                conf['duplicates_metric_fpath'] = metric_fpath
+                result = map_mp_bwamem(conf)
+                self.assertEqual(_get_status(result), {'fail': False, 'sample': 'tests', 'error_msg': 'OK'})
+                metrics = parse_duplicates_metrics(metric_fpath)
+                rates[backend] = metrics['duplication_rate']
+            self.assertAlmostEqual(rates[PICARD], rates[SAMTOOLS], places=2)
+        finally:
+            out_dir.cleanup()
+
+    def test_checkpointed_map_process(self):
+        out_dir = TemporaryDirectory()
+        try:
+            out_fpath = os.path.join(out_dir.name, 'sample.bam')
+            conf = {}
+            conf['index'] = str(TEST_DATA_PATHDIR.joinpath('arabidopsis_genes'))
+            conf['read1_fpath'] = str(TEST_DATA_PATHDIR.joinpath('arabreads_1.fastq'))
+            conf['read2_fpath'] = str(TEST_DATA_PATHDIR.joinpath('arabreads_2.fastq'))
+            conf['out_fpath'] = out_fpath
+            conf['sample'] = 'tests'
+            conf['tmpdir'] = out_dir.name
+            conf['do_duplicates'] = True
+            conf['do_downgrade_edges'] = True
+            conf['downgrade_edges_conf'] = {'read_start_size': 3,
+                                            'read_end_size': 3}
+            conf['checkpoint'] = True
+            result = map_mp_bwamem(conf)
+            self.assertEqual(_get_status(result), {'fail': False, 'sample': 'tests', 'error_msg': 'OK'})
+            manifest = read_manifest(out_fpath)
+            self.assertEqual([stage['name'] for stage in manifest['stages']],
+                             ['mapping', 'duplicates', 'downgrade_edges',
+                              'index'])
+            result = map_mp_bwamem(conf)
+            self.assertTrue(result['fail'])
+            self.assertIn('already mapped', result['error_msg'])
+        finally:
+            out_dir.cleanup()
+
+    def test_sharded_map_process(self):
+        out_dir = TemporaryDirectory()
+        try:
+            out_fpath = os.path.join(out_dir.name, 'sample.bam')
+            conf = {}
+            conf['index'] = str(TEST_DATA_PATHDIR.joinpath('arabidopsis_genes'))
+            conf['read1_fpath'] = str(TEST_DATA_PATHDIR.joinpath('arabidopsis_reads.fastq'))
+            conf['out_fpath'] = out_fpath
+            conf['sample'] = 'tests'
+            conf['tmpdir'] = out_dir.name
+            conf['do_duplicates'] = False
+            conf['do_downgrade_edges'] = False
+            conf['shard_workers'] = 2
+            conf['reads_per_shard'] = 2
+            result = map_mp_bwamem(conf)
+            self.assertEqual(_get_status(result), {'fail': False, 'sample': 'tests', 'error_msg': 'OK'})
+            out = run(['samtools', 'view', '-h', out_fpath], stdout=PIPE)
+            self.assertEqual(out.stdout.count(b'@RG\t'), 1)
+            self.assertIn(b'TTCTGATTCAATCTACTTCAAAGTTGGCTTTATCAATAAG', out.stdout)
+        finally:
+            out_dir.cleanup()
+
     def test_map_with_bwa_extra_conf(self):
         index_fpath = str(TEST_DATA_PATHDIR.joinpath('arabidopsis_genes'))
         reads_path = TEST_DATA_PATHDIR.joinpath('arabidopsis_reads.fastq')
@@ -89,6 +255,49 @@ class BwaTest(unittest.TestCase):
             map_mp_bwamem(conf)
 
 
+def _write_shard_conf(shard_dir):
+    reads_path = TEST_DATA_PATHDIR.joinpath('arabidopsis_reads.fastq')
+    shard_conf = {'name': 'shard00000',
+                  'index_fpath': str(TEST_DATA_PATHDIR.joinpath(
+                      'arabidopsis_genes')),
+                  'threads': 1, 'unpaired_path': str(reads_path),
+                  'out_fpath': str(Path(shard_dir, 'shard00000.bam')),
+                  'log_fpath': str(Path(shard_dir, 'shard00000.stderr')),
+                  'sort': {'threads': 1, 'memory': None,
+                           'tmpdir': str(shard_dir)}}
+    shard_conf_fpath = Path(shard_dir, 'shard00000.json')
+    with shard_conf_fpath.open('w') as fhand:
+        json.dump(shard_conf, fhand)
+    return shard_conf_fpath
+
+
+class ShardLeaseTest(unittest.TestCase):
+
+    def test_claimed_shard(self):
+        with TemporaryDirectory() as tmp_dir:
+            shard_conf_fpath = _write_shard_conf(tmp_dir)
+            lease_dir = Path(tmp_dir, SHARD_LEASES_DIR)
+            lease_dir.mkdir()
+            claim_lease(lease_dir, 'shard00000', 'other',
+                        lease_dir.joinpath('.clock.other'))
+            result = map_shard(shard_conf_fpath)
+            self.assertTrue(result['claimed'])
+            self.assertFalse(Path(tmp_dir, 'shard00000.bam.done').exists())
+
+            # the lease of a dead worker expires
+            lease_fpath = get_lease_fpath(lease_dir, 'shard00000', 0)
+            os.utime(str(lease_fpath), (0, 0))
+            result = map_shard(shard_conf_fpath)
+            self.assertFalse(result.get('claimed', False))
+            if result['fail']:
+                # without bwa the new lease is released
+                self.assertEqual(get_leases(lease_dir, 'shard00000'),
+                                 [lease_fpath])
+            else:
+                self.assertTrue(Path(tmp_dir,
+                                     'shard00000.bam.done').exists())
+
+
 if __name__ == '__main__':
     # import sys;sys.argv = ['', 'Bowtie2Test.test_map_with_bowtie2']
     unittest.main()
@@ -0,0 +1,108 @@
+import os
+import unittest
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from dora.mapping.cache import MappingCache, get_metrics_key, get_stage_key
+from dora.mapping.utils import MB
+
+
+class MappingCacheTest(unittest.TestCase):
+
+    def test_stage_keys(self):
+        reads = [{'path': 'reads.fastq', 'size': 10, 'mtime_ns': 1}]
+        mapping_key = get_stage_key('mapping', reads, {'index': 'genome'})
+        self.assertEqual(mapping_key,
+                         get_stage_key('mapping', reads, {'index': 'genome'}))
+        other_mapping_key = get_stage_key('mapping', reads, {'index': 'other'})
+        self.assertNotEqual(mapping_key, other_mapping_key)
+
+        # a stage depends on the stages before it
+        downgrade_params = {'read_start_size': 3}
+        downgrade_key = get_stage_key('downgrade_edges', [mapping_key],
+                                      downgrade_params)
+        self.assertNotEqual(downgrade_key,
+                            get_stage_key('downgrade_edges',
+                                          [other_mapping_key],
+                                          downgrade_params))
+
+    def test_fetch_and_put(self):
+        with TemporaryDirectory() as tmp_dir:
+            cache = MappingCache(Path(tmp_dir, 'cache'))
+            out_fpath = Path(tmp_dir, 'out.bam')
+            self.assertFalse(cache.fetch('key', out_fpath))
+
+            stage_out = Path(tmp_dir, 'stage.bam')
+            stage_out.write_bytes(b'bam')
+            mtime_ns = stage_out.stat().st_mtime_ns
+            cache.put('key', stage_out)
+            stage_out.unlink()
+            self.assertTrue(cache.fetch('key', out_fpath))
+            self.assertEqual(out_fpath.read_bytes(), b'bam')
+            # the fingerprint of the file does not change
+            self.assertEqual(out_fpath.stat().st_mtime_ns, mtime_ns)
+
+    def test_lru_eviction(self):
+        with TemporaryDirectory() as tmp_dir:
+            cache = MappingCache(Path(tmp_dir, 'cache'), max_size=2)
+            fpath = Path(tmp_dir, 'stage.bam')
+            for index, key in enumerate(('key1', 'key2')):
+                fpath.write_bytes(b'0' * MB)
+                cache.put(key, fpath)
+                fpath.unlink()
+                _set_atime(cache, key, index)
+            out_fpath = Path(tmp_dir, 'out.bam')
+            self.assertTrue(cache.fetch('key1', out_fpath))
+            out_fpath.unlink()
+
+            fpath.write_bytes(b'0' * MB)
+            cache.put('key3', fpath)
+            fpath.unlink()
+            cache.evict()
+            cached = [fpath.name for fpath, _ in cache.get_entries()]
+            self.assertEqual(sorted(cached), ['key1', 'key3'])
+
+    def test_linked_files_are_not_counted(self):
+        with TemporaryDirectory() as tmp_dir:
+            cache = MappingCache(Path(tmp_dir, 'cache'), max_size=1)
+            # the final bam stays linked out of the cache
+            out_fpath = Path(tmp_dir, 'out.bam')
+            out_fpath.write_bytes(b'0' * 2 * MB)
+            cache.put('out', out_fpath)
+            self.assertEqual(cache.get_entries(),
+                             [(cache.cache_dir.joinpath('out'), 0)])
+
+            fpath = Path(tmp_dir, 'stage.bam')
+            fpath.write_bytes(b'0' * MB)
+            cache.put('stage', fpath)
+            fpath.unlink()
+            cached = [fpath.name for fpath, _ in cache.get_entries()]
+            self.assertEqual(sorted(cached), ['out', 'stage'])
+
+            # once the final bam is removed its space counts
+            out_fpath.unlink()
+            cache.evict()
+            cached = [fpath.name for fpath, _ in cache.get_entries()]
+            self.assertEqual(len(cached), 1)
+
+    def test_copied_files(self):
+        with TemporaryDirectory() as tmp_dir:
+            cache = MappingCache(Path(tmp_dir, 'cache'))
+            metric_fpath = Path(tmp_dir, 'dup_metrics')
+            metric_fpath.write_text('metrics')
+            cache.put(get_metrics_key('key'), metric_fpath, link=False)
+            # the metrics are written in place, the cached ones do not change
+            metric_fpath.write_text('other metrics')
+            self.assertTrue(cache.fetch(get_metrics_key('key'), metric_fpath,
+                                        link=False))
+            self.assertEqual(metric_fpath.read_text(), 'metrics')
+            self.assertEqual(metric_fpath.stat().st_nlink, 1)
+
+
+def _set_atime(cache, key, atime):
+    fpath = cache.cache_dir.joinpath(key)
+    os.utime(str(fpath), (atime, fpath.stat().st_mtime))
+
+
+if __name__ == "__main__":
+    unittest.main()
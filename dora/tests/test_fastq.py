@@ -0,0 +1,131 @@
+import gzip
+import os
+import random
+import shutil
+import unittest
+from pathlib import Path
+from subprocess import PIPE, Popen
+from tempfile import TemporaryDirectory
+
+from pysam.libcbgzf import BGZFile
+
+from dora.mapping.fastq import (split_fastqs, open_fastq, is_bgzf,
+                                decompress_cmd, start_decompressors,
+                                estimate_num_reads)
+
+
+def _write_fastq(fpath, num_reads, pair, name_prefix='read'):
+    with gzip.open(str(fpath), 'wt') as fhand:
+        for read_index in range(num_reads):
+            fhand.write('@{}{}/{}\nACGT\n+\nIIII\n'.format(name_prefix,
+                                                          read_index, pair))
+
+
+class SplitFastqTest(unittest.TestCase):
+
+    def test_split_pairs(self):
+        with TemporaryDirectory() as tmp_dir:
+            read1 = Path(tmp_dir, 'reads_1.fastq.gz')
+            read2 = Path(tmp_dir, 'reads_2.fastq.gz')
+            _write_fastq(read1, 25, 1)
+            _write_fastq(read2, 25, 2)
+            chunks = split_fastqs([read1, read2], Path(tmp_dir, 'chunks'),
+                                  reads_per_chunk=10)
+            self.assertEqual(len(chunks), 3)
+            num_lines = []
+            for chunk_read1, chunk_read2 in chunks:
+                lines1 = open_fastq(chunk_read1).readlines()
+                lines2 = open_fastq(chunk_read2).readlines()
+                self.assertEqual(lines1[0].split('/')[0],
+                                 lines2[0].split('/')[0])
+                num_lines.append(len(lines1))
+            self.assertEqual(num_lines, [40, 40, 20])
+
+    def test_out_of_sync(self):
+        with TemporaryDirectory() as tmp_dir:
+            read1 = Path(tmp_dir, 'reads_1.fastq.gz')
+            read2 = Path(tmp_dir, 'reads_2.fastq.gz')
+            _write_fastq(read1, 5, 1)
+            _write_fastq(read2, 4, 2)
+            with self.assertRaises(RuntimeError):
+                split_fastqs([read1, read2], Path(tmp_dir, 'chunks'),
+                             reads_per_chunk=10)
+
+            _write_fastq(read2, 5, 2, name_prefix='other')
+            with self.assertRaises(RuntimeError):
+                split_fastqs([read1, read2], Path(tmp_dir, 'chunks'),
+                             reads_per_chunk=10)
+
+
+class DecompressTest(unittest.TestCase):
+
+    def test_detect_bgzf(self):
+        with TemporaryDirectory() as tmp_dir:
+            gzip_fpath = Path(tmp_dir, 'reads.fastq.gz')
+            _write_fastq(gzip_fpath, 5, 1)
+            bgzf_fpath = Path(tmp_dir, 'reads.bgzf.fastq.gz')
+            with BGZFile(str(bgzf_fpath), 'wb') as fhand:
+                fhand.write(b'@read/1\nACGT\n+\nIIII\n')
+            plain_fpath = Path(tmp_dir, 'reads.fastq')
+            plain_fpath.write_text('@read/1\nACGT\n+\nIIII\n')
+            self.assertFalse(is_bgzf(gzip_fpath))
+            self.assertTrue(is_bgzf(bgzf_fpath))
+            self.assertFalse(is_bgzf(plain_fpath))
+            self.assertIsNone(decompress_cmd(plain_fpath))
+
+    @unittest.skipUnless(shutil.which('pigz'), 'pigz is not installed')
+    def test_decompressors(self):
+        with TemporaryDirectory() as tmp_dir:
+            fpaths = [Path(tmp_dir, 'reads_1.fastq.gz'),
+                      Path(tmp_dir, 'reads_2.fastq')]
+            _write_fastq(fpaths[0], 5, 1)
+            fpaths[1].write_text('@read/2\nACGT\n+\nIIII\n')
+            in_paths, pipe_fds, processes = start_decompressors(fpaths,
+                                                                threads=2)
+            try:
+                reader = Popen(['cat'] + [str(path) for path in in_paths],
+                               stdout=PIPE, pass_fds=pipe_fds)
+            finally:
+                for fd in pipe_fds:
+                    os.close(fd)
+            content = reader.communicate()[0].decode()
+            for process in processes:
+                self.assertEqual(process.wait(), 0)
+            self.assertEqual(content.count('@read'), 6)
+            self.assertEqual(in_paths[1], fpaths[1])
+            self.assertEqual(len(processes), 1)
+
+
+class EstimateReadsTest(unittest.TestCase):
+
+    def test_estimate_num_reads(self):
+        with TemporaryDirectory() as tmp_dir:
+            fpath = Path(tmp_dir, 'reads.fastq.gz')
+            _write_random_fastq(fpath, 200)
+            self.assertEqual(estimate_num_reads(fpath), 200)
+
+            _write_random_fastq(fpath, 20000)
+            num_reads = estimate_num_reads(fpath, sample_reads=5000)
+            self.assertLess(abs(num_reads - 20000), 1000)
+
+            # a bgzf file has many gzip members
+            bgzf_fpath = Path(tmp_dir, 'reads.bgzf.fastq.gz')
+            with open_fastq(fpath, 'rb') as in_fhand:
+                with BGZFile(str(bgzf_fpath), 'wb') as out_fhand:
+                    out_fhand.write(in_fhand.read())
+            num_reads = estimate_num_reads(bgzf_fpath, sample_reads=5000)
+            self.assertLess(abs(num_reads - 20000), 1000)
+
+
+def _write_random_fastq(fpath, num_reads, length=100):
+    rng = random.Random(1)
+    with gzip.open(str(fpath), 'wt') as fhand:
+        for read_index in range(num_reads):
+            seq = ''.join(rng.choice('ACGT') for _ in range(length))
+            qual = ''.join(rng.choice('#,:FI') for _ in range(length))
+            fhand.write('@read{}\n{}\n+\n{}\n'.format(read_index, seq,
+                                                       qual))
+
+
+if __name__ == '__main__':
+    unittest.main()
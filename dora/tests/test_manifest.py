@@ -0,0 +1,52 @@
+import unittest
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from dora.mapping.manifest import (StageManifest, fingerprint, read_manifest,
+                                   get_manifest_fpath, INDEX_STAGE)
+
+
+class ManifestTest(unittest.TestCase):
+
+    def test_stages_are_recorded_and_validated(self):
+        with TemporaryDirectory() as tmp_dir:
+            reads = Path(tmp_dir, 'reads.fastq')
+            reads.write_text('@read\nACGT\n+\nIIII\n')
+            mapped = Path(tmp_dir, 'mapping.bam')
+            mapped.write_bytes(b'bam')
+            out_fpath = Path(tmp_dir, 'sample.bam')
+            out_fpath.write_bytes(b'final bam')
+
+            manifest = StageManifest(get_manifest_fpath(out_fpath), 'sample')
+            params = {'index': 'genome', 'readgroup': {'ID': 'sample'}}
+            inputs = [fingerprint(reads)]
+            manifest.record('mapping', inputs, params, mapped)
+            manifest.record('downgrade_edges', [fingerprint(mapped)],
+                            {'read_start_size': 3}, out_fpath)
+
+            manifest = StageManifest(get_manifest_fpath(out_fpath))
+            self.assertEqual(manifest.completed_stages,
+                             ['mapping', 'downgrade_edges'])
+            self.assertTrue(manifest.is_done('mapping', inputs, params,
+                                             mapped))
+            self.assertFalse(manifest.is_done('mapping', inputs,
+                                              {'index': 'other'}, mapped))
+            self.assertFalse(manifest.is_complete())
+
+            # if the output changes the stage is not valid anymore
+            mapped.write_bytes(b'truncated')
+            self.assertFalse(manifest.is_done('mapping', inputs, params,
+                                              mapped))
+
+            # recording a stage again removes the stages after it
+            manifest.record('mapping', inputs, params, mapped)
+            self.assertEqual(manifest.completed_stages, ['mapping'])
+
+            manifest.record(INDEX_STAGE, [], {}, out_fpath)
+            self.assertTrue(manifest.is_complete())
+            self.assertEqual(read_manifest(out_fpath)['sample'], 'sample')
+            self.assertIsNone(read_manifest(Path(tmp_dir, 'other.bam')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import sys
+import unittest
+from subprocess import PIPE, Popen
+
+from dora.mapping.mapping_rate import MappingRateMonitor, LowMappingRateError
+
+SAM_HEADER = '@HD\tVN:1.6\n@SQ\tSN:chr1\tLN:1000\n'
+MAPPED = 'read{}\t0\tchr1\t1\t60\t4M\t*\t0\t0\tACGT\tIIII\n'
+UNMAPPED = 'read{}\t4\t*\t0\t0\t*\t*\t0\t0\tACGT\tIIII\n'
+SUPPLEMENTARY = 'read{}\t2048\tchr1\t1\t60\t4M\t*\t0\t0\tACGT\tIIII\n'
+
+
+def _start_fake_bwa(sam, forever=False):
+    code = 'import sys, time\nsys.stdout.write({!r})\nsys.stdout.flush()\n'
+    code = code.format(sam)
+    if forever:
+        code += 'time.sleep(60)\n'
+    return Popen([sys.executable, '-c', code], stdout=PIPE)
+
+
+def _build_sam(reads):
+    return SAM_HEADER + ''.join(line.format(index)
+                                for index, line in enumerate(reads))
+
+
+class MappingRateTest(unittest.TestCase):
+
+    def test_good_mapping_rate(self):
+        sam = _build_sam([MAPPED, UNMAPPED, SUPPLEMENTARY, MAPPED, MAPPED])
+        bwa = _start_fake_bwa(sam)
+        monitor = MappingRateMonitor(0.5, min_reads=2)
+        stream = monitor.follow(bwa)
+        self.assertEqual(stream.read().decode(), sam)
+        stream.close()
+        bwa.wait()
+        monitor.check()
+        self.assertEqual(monitor.mapping_rate, 0.5)
+
+    def test_low_mapping_rate(self):
+        sam = _build_sam([UNMAPPED, SUPPLEMENTARY, MAPPED, UNMAPPED,
+                          UNMAPPED, UNMAPPED])
+        bwa = _start_fake_bwa(sam, forever=True)
+        monitor = MappingRateMonitor(0.5, min_reads=4)
+        stream = monitor.follow(bwa)
+        # the sam is cut after the reads checked and bwa is killed
+        lines = stream.read().decode().splitlines()
+        stream.close()
+        self.assertEqual(len(lines), 7)
+        self.assertEqual(bwa.wait(), -9)
+        with self.assertRaises(LowMappingRateError) as context:
+            monitor.check()
+        self.assertIn('mapping rate 25.0% below 50.0%',
+                      str(context.exception))
+
+
+if __name__ == "__main__":
+    unittest.main()
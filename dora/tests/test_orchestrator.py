@@ -0,0 +1,105 @@
+import asyncio
+import os
+import sys
+import time
+import unittest
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import dora.mapping
+from dora.mapping.orchestrator import ProjectOrchestrator, CANCELLED
+
+TEST_DATA_PATHDIR = Path(dora.mapping.__file__).parent.parent.joinpath('tests').joinpath('data')
+
+
+def _run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class PipelineTest(unittest.TestCase):
+
+    def test_pipe(self):
+        orchestrator = ProjectOrchestrator()
+        with TemporaryDirectory() as tmp_dir:
+            log_fpath = Path(tmp_dir, 'log')
+            with log_fpath.open('w') as log_fhand:
+                cmds = [[sys.executable, '-c', 'print("a\\nb\\nc")'],
+                        ['grep', 'b'], ['wc', '-l']]
+                _run(orchestrator.run_pipeline(cmds, log_fhand))
+            self.assertEqual(log_fpath.read_text().strip(), '1')
+
+            with log_fpath.open('w') as log_fhand:
+                with self.assertRaises(RuntimeError):
+                    _run(orchestrator.run_pipeline([['false'], ['cat']],
+                                                   log_fhand))
+
+    def test_timeout_kills_processes(self):
+        orchestrator = ProjectOrchestrator()
+        num_fds = len(os.listdir('/proc/self/fd'))
+        with open(os.devnull, 'w') as log_fhand:
+            start = time.time()
+            with self.assertRaises(asyncio.TimeoutError):
+                _run(asyncio.wait_for(
+                    orchestrator.run_pipeline([['sleep', '10'], ['cat']],
+                                              log_fhand), 0.5))
+            self.assertLess(time.time() - start, 5)
+        self.assertEqual(len(os.listdir('/proc/self/fd')), num_fds)
+
+
+class OrchestratorTest(unittest.TestCase):
+
+    def _get_conf(self, out_dir, sample):
+        conf = {}
+        conf['index'] = str(TEST_DATA_PATHDIR.joinpath('arabidopsis_genes'))
+        conf['read1_fpath'] = str(TEST_DATA_PATHDIR.joinpath('arabreads_1.fastq'))
+        conf['read2_fpath'] = str(TEST_DATA_PATHDIR.joinpath('arabreads_2.fastq'))
+        conf['out_fpath'] = os.path.join(out_dir, '{}.bam'.format(sample))
+        conf['sample'] = sample
+        conf['tmpdir'] = out_dir
+        conf['threads'] = 1
+        conf['filter_supplementary'] = True
+        conf['do_downgrade_edges'] = True
+        conf['downgrade_edges_conf'] = {'read_start_size': 3,
+                                        'read_end_size': 3}
+        return conf
+
+    def test_cancel(self):
+        with TemporaryDirectory() as out_dir:
+            orchestrator = ProjectOrchestrator(stage_limits={'mapping': 1})
+
+            async def run_and_cancel():
+                run = asyncio.ensure_future(orchestrator.run_async(
+                    [self._get_conf(out_dir, 'sample1'),
+                     self._get_conf(out_dir, 'sample2')]))
+                await asyncio.sleep(0)
+                orchestrator.cancel('sample2')
+                return await run
+
+            results = _run(run_and_cancel())
+            results = {result['sample']: result for result in results}
+            self.assertTrue(results['sample2']['fail'])
+            self.assertEqual(orchestrator.get_status()['sample2']['state'],
+                             CANCELLED)
+            self.assertFalse(os.path.exists(os.path.join(out_dir,
+                                                         'sample2.bam')))
+
+    def test_map_samples(self):
+        with TemporaryDirectory() as out_dir:
+            orchestrator = ProjectOrchestrator(stage_limits={'mapping': 1})
+            confs = [self._get_conf(out_dir, 'sample1'),
+                     self._get_conf(out_dir, 'sample2')]
+            results = orchestrator.run(confs)
+            for result in results:
+                self.assertFalse(result['fail'], result['error_msg'])
+                self.assertIn('mapping', result['stages'])
+                self.assertGreater(result['reads'], 0)
+            for conf in confs:
+                self.assertTrue(os.path.exists(conf['out_fpath'] + '.bai'))
+
+
+if __name__ == "__main__":
+    unittest.main()
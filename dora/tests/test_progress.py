@@ -0,0 +1,66 @@
+import io
+import json
+import sys
+import unittest
+from pathlib import Path
+from subprocess import PIPE, Popen
+from tempfile import TemporaryDirectory
+
+from dora.mapping.progress import (BwaProgressMonitor, build_progress,
+                                   read_progress, write_progress,
+                                   get_status_fpath, MAPPED_STATE)
+
+BWA_STDERR = '''[M::bwa_idx_load_from_disk] read 0 ALT contigs
+[M::process] read 100 sequences (10000 bp)...
+[M::mem_process_seqs] Processed 100 reads in 0.1 CPU sec, 0.05 real sec
+[M::mem_process_seqs] Processed 50 reads in 0.05 CPU sec, 0.02 real sec
+[main] Real time: 0.2 sec; CPU: 0.2 sec
+'''
+
+
+class ProgressTest(unittest.TestCase):
+
+    def test_build_progress(self):
+        progress = build_progress('sample', 100, 400, start=10, now=20,
+                                  state='mapping')
+        self.assertEqual(progress['reads_per_sec'], 10)
+        self.assertEqual(progress['eta'], 30)
+
+    def test_monitor(self):
+        with TemporaryDirectory() as tmp_dir:
+            status_fpath = get_status_fpath(tmp_dir, 'sample')
+            log_fhand = io.StringIO()
+            monitor = BwaProgressMonitor(status_fpath, 'sample',
+                                         expected_reads=300,
+                                         log_fhand=log_fhand)
+            monitor.wait()
+            cmd = [sys.executable, '-c',
+                   'import sys; sys.stderr.write({!r})'.format(BWA_STDERR)]
+            process = Popen(cmd, stderr=PIPE)
+            monitor.follow(process.stderr)
+            process.wait()
+            monitor.wait()
+            self.assertEqual(log_fhand.getvalue(), BWA_STDERR)
+            with Path(status_fpath).open() as fhand:
+                status = json.load(fhand)
+            self.assertEqual(status['reads'], 150)
+            self.assertEqual(status['state'], MAPPED_STATE)
+
+            statuses = read_progress(tmp_dir)
+            self.assertFalse(statuses[0]['stuck'])
+            out_fhand = io.StringIO()
+            write_progress(statuses, out_fhand)
+            self.assertIn('sample\tmapped\t150\t50.0%',
+                          out_fhand.getvalue())
+
+    def test_stuck_sample(self):
+        with TemporaryDirectory() as tmp_dir:
+            status = build_progress('sample', 100, 400, start=10, now=20,
+                                    state='mapping')
+            with get_status_fpath(tmp_dir, 'sample').open('w') as fhand:
+                json.dump(status, fhand)
+            self.assertTrue(read_progress(tmp_dir)[0]['stuck'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+import io
+import shutil
+import unittest
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from dora.mapping.shm import shared_bwa_indexes, get_shm_index_name
+from dora.mapping.utils import run_multiprocesses_with_budget, MB
+from dora.tests import fake_mapping
+
+
+class SharedIndexTest(unittest.TestCase):
+
+    def test_budget_with_shared_index(self):
+        with TemporaryDirectory() as tmp_dir:
+            index = str(Path(tmp_dir).joinpath('ref.fasta'))
+            with open(index + '.bwt', 'wb') as fhand:
+                fhand.write(b'0' * 3 * MB)
+            confs = [{'sample': 'sample', 'index': index,
+                      'sort_memory': 1000}]
+
+            # the index does not fit with the sort memory
+            log_fhand = io.StringIO()
+            run_multiprocesses_with_budget(fake_mapping, confs, log_fhand,
+                                           threads=2, memory=1002)
+            self.assertIn('Not enough memory', log_fhand.getvalue())
+
+            # the samples do not load a shared index
+            log_fhand = io.StringIO()
+            run_multiprocesses_with_budget(fake_mapping, confs, log_fhand,
+                                           threads=2, memory=1002,
+                                           shared_indexes={index})
+            self.assertIn('OK: ', log_fhand.getvalue())
+            self.assertNotIn('ERROR', log_fhand.getvalue())
+
+    def test_shm_index_name(self):
+        self.assertEqual(get_shm_index_name('/genomes/ref.fasta'),
+                         'ref.fasta')
+
+    @unittest.skipIf(shutil.which('bwa'), 'bwa is installed')
+    def test_no_bwa_fallback(self):
+        log_fhand = io.StringIO()
+        with shared_bwa_indexes(['ref.fasta'], memory=10000,
+                                log_fhand=log_fhand) as (shared, memory):
+            self.assertEqual(shared, set())
+            self.assertEqual(memory, 0)
+        self.assertIn('not shared', log_fhand.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,40 @@
+import io
 import random
 import unittest
+from collections import Counter
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
 import numpy as np
+from pysam import AlignedSegment, AlignmentFile, AlignmentHeader, index
+
+from dora.stats import (calc_depth_histogram, read_depth_histogram,
+                        parse_depth_chunk, get_depth_file_ranges,
+                        calc_coverage_stats, calc_bam_depth_histogram,
+                        get_depth_windows)
+
+CIGARS = [[(0, 50)], [(4, 5), (0, 20), (2, 3), (0, 25)],
+          [(0, 10), (3, 100), (0, 30)], [(0, 40), (1, 2), (0, 8)]]
+SAMPLE_READ_GROUPS = {'sample1': ['rg1'], 'sample2': ['rg2']}
+
+
+def _count_depths_by_line(fhand):
+    depths = Counter()
+    for line in fhand:
+        line = line.strip()
+        if not line or line[0] == '#':
+            continue
+        depths[int(line.split()[2])] += 1
+    return depths
+
+
+def _write_depth_file(fpath, num_positions):
+    rng = random.Random(1)
+    with open(str(fpath), 'w') as fhand:
+        fhand.write('#CHROM\tPOS\tsample.bam\n')
+        for pos in range(num_positions):
+            depth = rng.choice([0, rng.randint(1, 40), rng.randint(1, 20000)])
+            fhand.write('chr{}\t{}\t{}\n'.format(pos // 1000, pos + 1, depth))
 class StatsTest(unittest.TestCase):
 
     def test_coveage_stats(self):
@@ -11,6 +45,142 @@ class StatsTest(unittest.TestCase):
         print(np.average(np_a))
 
 
+
+class DepthHistogramTest(unittest.TestCase):
+
+    def test_parse_chunk(self):
+        chunk = b'chr1\t1\t0\n\n#comment\nchr1\t2\t105\t3\r\nchr1\t3\t7'
+        self.assertEqual(parse_depth_chunk(chunk).tolist(), [0, 105, 7])
+        self.assertEqual(parse_depth_chunk(b'').tolist(), [])
+        with self.assertRaises(ValueError):
+            parse_depth_chunk(b'chr1\t1\n')
+        with self.assertRaises(ValueError):
+            parse_depth_chunk(b'chr1\t1\t1a\n')
+
+    def test_equal_to_counter(self):
+        with TemporaryDirectory() as tmp_dir:
+            fpath = Path(tmp_dir, 'depth.tsv')
+            _write_depth_file(fpath, 5000)
+            with fpath.open() as fhand:
+                expected = _count_depths_by_line(fhand)
+
+            # small chunks, lines are split among them
+            with fpath.open('rb') as fhand:
+                histogram = read_depth_histogram(fhand, chunk_size=1000)
+            self.assertEqual(histogram.to_counter(), expected)
+
+            for processes in (1, 3):
+                depths = calc_depth_histogram(fpath, processes=processes,
+                                              chunk_size=1000)
+                self.assertEqual(depths, expected)
+                self.assertEqual(list(depths), sorted(depths))
+            stats = calc_coverage_stats(depths, is_counter=True)
+            self.assertEqual(stats['length_analysed_regions'], 5000)
+
+    def test_file_ranges(self):
+        with TemporaryDirectory() as tmp_dir:
+            fpath = Path(tmp_dir, 'depth.tsv')
+            _write_depth_file(fpath, 100)
+            content = fpath.read_bytes()
+            ranges = get_depth_file_ranges(str(fpath), 4)
+            self.assertEqual(len(ranges), 4)
+            self.assertEqual(ranges[0][0], 0)
+            self.assertEqual(ranges[-1][1], len(content))
+            for start, end in ranges:
+                self.assertTrue(start == 0 or
+                                content[start - 1:start] == b'\n')
+            self.assertEqual(len(get_depth_file_ranges(str(fpath), 1000)),
+                             101)
+            histogram = read_depth_histogram(io.BytesIO(b''))
+            self.assertEqual(histogram.to_counter(), Counter())
+
+
+
+def _write_depth_bam(fpath, num_reads, contig_lengths=(3000, 500, 100)):
+    header = AlignmentHeader.from_dict({
+        'HD': {'VN': '1.6', 'SO': 'coordinate'},
+        'SQ': [{'SN': 'contig{}'.format(index + 1), 'LN': length}
+               for index, length in enumerate(contig_lengths)],
+        'RG': [{'ID': 'rg1', 'SM': 'sample1'},
+               {'ID': 'rg2', 'SM': 'sample2'}]})
+    rng = random.Random(1)
+    reads = []
+    for read_index in range(num_reads):
+        read = AlignedSegment(header)
+        read.query_name = 'read{}'.format(read_index)
+        read.cigartuples = rng.choice(CIGARS)
+        read.query_sequence = 'A' * read.query_length
+        read.reference_id = rng.randrange(2)
+        max_start = contig_lengths[read.reference_id] - 200
+        read.reference_start = rng.randrange(max_start)
+        read.mapping_quality = rng.choice((0, 20, 60))
+        read.flag = rng.choice((0, 16, 1024, 256, 512))
+        read.set_tag('RG', rng.choice(('rg1', 'rg2')))
+        reads.append(read)
+    reads.sort(key=lambda read: (read.reference_id, read.reference_start))
+    with AlignmentFile(str(fpath), 'wb', header=header) as out_sam:
+        for read in reads:
+            out_sam.write(read)
+    index(str(fpath))
+
+
+def _count_bam_depths(fpath, min_mapq, rm_dups, sample):
+    read_groups = SAMPLE_READ_GROUPS.get(sample)
+    with AlignmentFile(str(fpath)) as sam:
+        depths = [np.zeros(length, dtype=np.int64) for length in sam.lengths]
+        for read in sam:
+            if read.flag & (4 | 256 | 512) or read.mapping_quality < min_mapq:
+                continue
+            if rm_dups and read.flag & 1024:
+                continue
+            if read_groups and read.get_tag('RG') not in read_groups:
+                continue
+            for start, end in read.get_blocks():
+                depths[read.reference_id][start:end] += 1
+    return Counter(np.concatenate(depths).tolist())
+
+
+class BamDepthHistogramTest(unittest.TestCase):
+
+    def test_windows(self):
+        tasks = get_depth_windows([('c1', 25), ('c2', 3), ('c3', 4)],
+                                  window_size=10)
+        self.assertEqual(tasks, [[('c1', 0, 10)], [('c1', 10, 20)],
+                                 [('c1', 20, 25), ('c2', 0, 3)],
+                                 [('c3', 0, 4)]])
+
+    def test_bam_depths(self):
+        with TemporaryDirectory() as tmp_dir:
+            fpath = Path(tmp_dir, 'reads.bam')
+            _write_depth_bam(fpath, 300)
+            filters = [{'min_mapq': 0, 'rm_dups': False, 'sample': None},
+                       {'min_mapq': 20, 'rm_dups': True, 'sample': 'sample1'}]
+            for filter_ in filters:
+                expected = _count_bam_depths(fpath, **filter_)
+                for processes in (1, 2):
+                    depths = calc_bam_depth_histogram(
+                        fpath, processes=processes, window_size=700,
+                        **filter_)
+                    self.assertEqual(depths, expected)
+            stats = calc_coverage_stats(depths, is_counter=True)
+            self.assertEqual(stats['length_analysed_regions'], 3600)
+
+    def test_not_indexed(self):
+        with TemporaryDirectory() as tmp_dir:
+            fpath = Path(tmp_dir, 'reads.bam')
+            _write_depth_bam(fpath, 10)
+            Path(str(fpath) + '.bai').unlink()
+            with self.assertRaises(ValueError):
+                calc_bam_depth_histogram(fpath)
+
+    def test_unknown_sample(self):
+        with TemporaryDirectory() as tmp_dir:
+            fpath = Path(tmp_dir, 'reads.bam')
+            _write_depth_bam(fpath, 10)
+            with self.assertRaises(ValueError):
+                calc_bam_depth_histogram(fpath, sample='sample3')
+
+
 if __name__ == '__main__':
     # import sys;sys.argv = ['', 'Bowtie2Test.test_map_with_bowtie2']
     unittest.main()
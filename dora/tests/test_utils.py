@@ -0,0 +1,150 @@
+import io
+import json
+import unittest
+from pathlib import Path
+from subprocess import Popen, PIPE
+from tempfile import mkdtemp, TemporaryDirectory
+
+from dora.mapping.metrics import StageMeter, write_metrics
+from dora.mapping.utils import (SortMonitor, ResourceBudget, wait_processes,
+                                run_multiprocesses_with_budget,
+                                split_sample_threads,
+                                order_confs_largest_first, predict_makespan)
+from dora.tests import fake_mapping
+
+SORT_STDERR = ('echo "[bam_sort_core] merging from 12 files and 3 '
+               'in-memory blocks..." >&2; sleep 0.2')
+
+
+class SortMonitorTest(unittest.TestCase):
+
+    def test_sort_stats(self):
+        spill_dir = mkdtemp()
+        process = Popen(['sh', '-c', SORT_STDERR], stderr=PIPE)
+        log_fhand = io.StringIO()
+        monitor = SortMonitor(process.stderr, log_fhand=log_fhand,
+                              spill_dir=spill_dir)
+        monitor.start()
+        process.wait()
+        stats = monitor.stats
+        self.assertEqual(stats['spill_files'], 12)
+        self.assertEqual(stats['in_memory_blocks'], 3)
+        self.assertGreater(stats['merge_time'], 0.1)
+        self.assertIn('merging from 12 files', log_fhand.getvalue())
+        self.assertFalse(Path(spill_dir).exists())
+
+
+class ResourceBudgetTest(unittest.TestCase):
+
+    def test_allocation(self):
+        budget = ResourceBudget(threads=16, memory=10000, min_threads=4)
+        # memory only allows two samples at once
+        self.assertEqual(budget.allocate(4000, num_pending=10), 8)
+        self.assertEqual(budget.allocate(4000, num_pending=9), 8)
+        self.assertIsNone(budget.allocate(4000, num_pending=8))
+        budget.release(8, 4000)
+        budget.release(8, 4000)
+
+        # the last sample gets all the threads
+        self.assertEqual(budget.allocate(1000, num_pending=1), 16)
+        self.assertIsNone(budget.allocate(1000, num_pending=1))
+        budget.release(16, 1000)
+
+        # at the start threads are spread among the samples that can run
+        self.assertEqual(budget.allocate(1000, num_pending=10), 4)
+        self.assertEqual(budget.free_threads, 12)
+
+        self.assertRaises(ValueError, ResourceBudget, threads=0, memory=1000)
+        self.assertRaises(ValueError, ResourceBudget, threads=4, memory=1000,
+                          max_samples=0)
+
+    def test_split_threads(self):
+        # bwa and sort together use the threads of the sample
+        self.assertEqual(split_sample_threads(16), (12, 4))
+        self.assertEqual(split_sample_threads(4), (3, 1))
+        self.assertEqual(split_sample_threads(2), (1, 1))
+        self.assertEqual(split_sample_threads(1), (1, 1))
+
+    def test_run_with_budget(self):
+        confs = [{'sample': 'sample{}'.format(idx), 'sort_memory': 1000}
+                 for idx in range(3)]
+        log_fhand = io.StringIO()
+        run_multiprocesses_with_budget(fake_mapping, confs, log_fhand,
+                                       threads=4, memory=10000, min_threads=2)
+        log = log_fhand.getvalue()
+        self.assertEqual(log.count('OK: '), 3)
+        self.assertNotIn('ERROR', log)
+
+        self.assertRaises(ValueError, run_multiprocesses_with_budget,
+                          fake_mapping, confs, log_fhand, threads=4,
+                          memory=10000, max_samples=0)
+
+        confs = [{'sample': 'big', 'sort_memory': 20000}]
+        log_fhand = io.StringIO()
+        run_multiprocesses_with_budget(fake_mapping, confs, log_fhand,
+                                       threads=4, memory=10000)
+        self.assertIn('ERROR: big, Not enough memory', log_fhand.getvalue())
+
+
+class LargestFirstTest(unittest.TestCase):
+
+    def test_order_confs(self):
+        with TemporaryDirectory() as tmp_dir:
+            confs = []
+            for sample, size in (('small', 10), ('big', 1000), ('mid', 100)):
+                read1 = Path(tmp_dir).joinpath(sample + '_1.fastq.gz')
+                read2 = Path(tmp_dir).joinpath(sample + '_2.fastq.gz')
+                read1.write_bytes(b'A' * size)
+                read2.write_bytes(b'A' * size)
+                confs.append({'sample': sample, 'read1_fpath': str(read1),
+                              'read2_fpath': str(read2)})
+            confs = order_confs_largest_first(confs)
+            self.assertEqual([conf['sample'] for conf in confs],
+                             ['big', 'mid', 'small'])
+            self.assertEqual(confs[0]['work'], 2000)
+
+    def test_predict_makespan(self):
+        rates = [1] * 5
+        self.assertEqual(predict_makespan([6, 5, 4, 3, 3], 2, rates), 12)
+        # the largest sample at the end defines the makespan
+        self.assertEqual(predict_makespan([3, 3, 4, 5, 6], 2, rates), 13)
+
+
+class StageMetricsTest(unittest.TestCase):
+
+    def test_wait_processes_usage(self):
+        processes = [('ok', Popen(['sh', '-c', 'exit 0'])),
+                     ('fail', Popen(['sh', '-c', 'exit 3']))]
+        usages = {}
+        self.assertEqual(wait_processes(processes, usages), 'fail')
+        self.assertEqual(processes[1][1].returncode, 3)
+        self.assertEqual(set(usages), {'ok', 'fail'})
+        self.assertGreater(usages['ok']['max_rss'], 0)
+        # they have already been waited for
+        self.assertEqual(wait_processes(processes, {}), 'fail')
+
+    def test_stage_meter(self):
+        with TemporaryDirectory() as tmp_dir:
+            in_fpath = Path(tmp_dir, 'in.bam')
+            in_fpath.write_bytes(b'A' * 10)
+            with StageMeter('stage', in_fpaths=[in_fpath],
+                            out_fpaths=[Path(tmp_dir, 'pipe')]) as meter:
+                meter.reads = 5
+            metrics = meter.metrics
+            self.assertEqual(metrics['bytes_in'], 10)
+            self.assertIsNone(metrics['bytes_out'])
+            self.assertEqual(metrics['reads'], 5)
+            self.assertGreaterEqual(metrics['wall_time'], 0)
+
+        result = {'fail': False, 'sample': 's1', 'error_msg': 'OK',
+                  'wall_time': 3, 'reads': 5, 'stages': {'stage': metrics}}
+        fhand = io.StringIO()
+        write_metrics(result, fhand, threads=4)
+        line = json.loads(fhand.getvalue())
+        self.assertEqual(line['sample'], 's1')
+        self.assertEqual(line['threads'], 4)
+        self.assertEqual(line['stages']['stage']['reads'], 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
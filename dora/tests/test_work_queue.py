@@ -0,0 +1,87 @@
+import io
+import os
+import unittest
+from multiprocessing import Process
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from dora.mapping.work_queue import (write_jobs, run_worker, claim_job,
+                                     read_result, wait_for_jobs,
+                                     get_queue_status, LEASES_DIR)
+from dora.tests import fake_mapping
+
+
+def _failed_mapping(conf):
+    raise RuntimeError('bwa died')
+
+
+def _get_confs(out_dir, num_samples):
+    return [{'sample': 'sample{}'.format(index),
+             'read_group': 'rg{}'.format(index),
+             'out_fpath': str(Path(out_dir, 'sample{}.bam'.format(index)))}
+            for index in range(num_samples)]
+
+
+class WorkQueueTest(unittest.TestCase):
+
+    def test_workers(self):
+        with TemporaryDirectory() as tmp_dir:
+            queue_dir = Path(tmp_dir, 'queue')
+            confs = _get_confs(tmp_dir, 6)
+            job_ids = write_jobs(confs, queue_dir)
+            # the jobs already in the queue are kept
+            self.assertEqual(write_jobs(confs, queue_dir), job_ids)
+
+            workers = [Process(target=run_worker, args=(queue_dir,),
+                               kwargs={'func': fake_mapping,
+                                       'poll_interval': 0.1})
+                       for _ in range(3)]
+            for worker in workers:
+                worker.start()
+            log_fhand = io.StringIO()
+            self.assertTrue(wait_for_jobs(queue_dir, job_ids, log_fhand,
+                                          poll_interval=0.1))
+            for worker in workers:
+                worker.join()
+            self.assertEqual(log_fhand.getvalue().count('OK:'), 6)
+            # every job has been run once
+            for conf in confs:
+                with open(conf['out_fpath']) as fhand:
+                    self.assertEqual(len(fhand.readlines()), 1)
+            self.assertEqual(get_queue_status(queue_dir)['done'], 6)
+
+    def test_dead_worker(self):
+        with TemporaryDirectory() as tmp_dir:
+            queue_dir = Path(tmp_dir, 'queue')
+            confs = _get_confs(tmp_dir, 1)
+            job_id = write_jobs(confs, queue_dir)[0]
+
+            # a worker claims the job and dies leaving a partial output
+            self.assertEqual(claim_job(queue_dir, 'dead')[2], 0)
+            Path(confs[0]['out_fpath']).write_text('partial\n')
+            self.assertIsNone(claim_job(queue_dir, 'alive'))
+            self.assertEqual(run_worker(queue_dir, func=fake_mapping,
+                                        wait=False), 0)
+
+            # without heartbeat the lease expires and the job is claimed
+            lease_fpath = Path(queue_dir, LEASES_DIR, job_id + '.0')
+            os.utime(str(lease_fpath), (0, 0))
+            self.assertEqual(run_worker(queue_dir, func=fake_mapping,
+                                        wait=False), 1)
+            self.assertFalse(read_result(queue_dir, job_id)['fail'])
+            with open(confs[0]['out_fpath']) as fhand:
+                self.assertNotIn('partial', fhand.read())
+
+    def test_failed_job(self):
+        with TemporaryDirectory() as tmp_dir:
+            queue_dir = Path(tmp_dir, 'queue')
+            confs = [{'sample': 'sample', 'read_group': 'rg'}]
+            job_id = write_jobs(confs, queue_dir)[0]
+            run_worker(queue_dir, func=_failed_mapping, wait=False)
+            result = read_result(queue_dir, job_id)
+            self.assertTrue(result['fail'])
+            self.assertIn('RuntimeError: bwa died', result['error_msg'])
+
+
+if __name__ == "__main__":
+    unittest.main()